@@ -0,0 +1,82 @@
+"""Lines/sec of find_versionone_numbers over an IRC log like corpus.
+
+    python benchmarks/bench_matcher.py [lines]
+
+The corpus is generated (seeded, so runs compare) to look like a busy
+team channel: mostly chatter, some URLs, hyphenated words and dates, and
+a few lines with ticket numbers in either case.
+"""
+
+import random
+import re
+import sys
+import timeit
+
+import helga_versionone
+
+
+CHATTER = [
+    'morning all',
+    'anyone else seeing the build fail on master?',
+    'lunch?',
+    'I think the re-deploy fixed it',
+    'standup in 5',
+    'the follow-up meeting got moved to 2015-06-12',
+    'see https://github.com/aarcro/helga-versionone/pull/12 for the fix',
+    'k',
+    'that is a long-running query, try adding an index',
+    'brb',
+    'who owns the on-call pager this week?',
+    'ping me when you are back',
+]
+TICKETS = ['B-{0:05d}', 'D-{0:05d}', 'TK-{0:05d}', 'I-{0:04d}', 'b-{0:05d}', 'at-{0:05d}']
+TEMPLATES = [
+    'can someone look at {0}?',
+    '{0} is ready for review',
+    'I moved {0} and {1} to done',
+    'blocked on {0}, see {0} comments',
+]
+
+
+def old_find_versionone_numbers(message):
+    """The matcher before it was precompiled, for comparison"""
+    pat = r'\b(({0})-\d+)\b'.format('|'.join(helga_versionone.VERSIONONE_PATTERNS))
+    tickets = []
+    for ticket in re.findall(pat, message, re.IGNORECASE):
+        tickets.append(ticket[0])
+    return tickets
+
+
+def corpus(size, seed=1234):
+    rand = random.Random(seed)
+    lines = []
+    for _ in range(size):
+        # Roughly 1 in 10 lines mentions tickets
+        if rand.random() < 0.1:
+            numbers = [rand.choice(TICKETS).format(rand.randint(1, 30000)) for _ in range(2)]
+            lines.append(rand.choice(TEMPLATES).format(*numbers))
+        else:
+            lines.append(rand.choice(CHATTER))
+    return lines
+
+
+def bench(fn, lines, repeat=5):
+    def run():
+        for line in lines:
+            fn(line)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return len(lines) / best
+
+
+def main(size=20000):
+    lines = corpus(size)
+    before = bench(old_find_versionone_numbers, lines)
+    after = bench(helga_versionone.find_versionone_numbers, lines)
+    print('{0} lines'.format(len(lines)))
+    print('before: {0:>12,.0f} lines/sec'.format(before))
+    print('after:  {0:>12,.0f} lines/sec'.format(after))
+    print('speedup: {0:.1f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
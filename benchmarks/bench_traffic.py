@@ -0,0 +1,429 @@
+"""Messages/sec, latency and V1 requests per message, replaying recorded IRC traffic
+against a local fake VersionOne.
+
+    python benchmarks/bench_traffic.py [--latency MS] [--threads N] [--repeat N] [--log FILE] [--rate-limits]
+                                       [--no-save]
+
+Every line of the log (benchmarks/traffic.log by default) is fed to versionone()
+the way helga would: !v1 lines as commands, lines with ticket numbers as matches.
+All of it is sent at once, and timed until every message has its first answer.
+That is far faster than people type, so per nick and channel rate limits are off
+unless --rate-limits is given.
+
+The fake server answers /meta.v1 and /rest-1.v1/Data requests with generated XML,
+after sleeping --latency milliseconds, and counts them. Mongo is replaced by
+empty in memory collections, so nobody has credentials and the service user is used.
+
+Results are saved to benchmarks/results/, and compared to the last saved run
+with the same settings.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(HERE, 'results')
+CR_FIELD = 'Custom_CodeReview'
+NICKS = ['alice', 'bob', 'carol', 'dave']
+
+ASSET_TYPES = [
+    'Workitem', 'Story', 'Defect', 'Task', 'Test', 'Issue', 'Request',
+    'Member', 'Team', 'TeamRoom', 'TaskStatus', 'TestStatus', 'StoryStatus',
+]
+TEXT = ['Name', 'Number', 'Nickname', 'Username', 'IsInactive', 'Order', CR_FIELD]
+RELATIONS = {'Owners': True, 'Rooms': True, 'Status': False, 'Parent': False}
+
+
+def meta_xml(asset_type):
+    """Every type gets every attribute, the plugin only asks for the ones that make sense"""
+    definitions = [
+        '<AttributeDefinition name="{0}" attributetype="Text" ismultivalue="False"/>'.format(name)
+        for name in TEXT
+    ] + [
+        '<AttributeDefinition name="{0}" attributetype="Relation" ismultivalue="{1}"/>'.format(name, multi)
+        for name, multi in sorted(RELATIONS.items())
+    ]
+    return '<AssetType name="{0}">{1}</AssetType>'.format(asset_type, ''.join(definitions))
+
+
+def oid_for(value):
+    digits = re.sub(r'\D', '', value)
+    return int(digits) if digits else abs(hash(value)) % 100000
+
+
+class Asset(object):
+    def __init__(self, asset_type, oid, number=None, name=None):
+        self.asset_type = asset_type
+        self.oid = oid
+        self.number = number or '{0}-{1:05d}'.format(asset_type[0], oid)
+        self.name = name or 'Ticket {0}'.format(self.number)
+
+    def value(self, attr):
+        """(is_relation, value or idrefs) for attr"""
+        if attr in ('Owners', 'Rooms', 'Status', 'Parent'):
+            return True, {
+                'Owners': ['Member:20'],
+                'Rooms': ['TeamRoom:10', 'TeamRoom:11'],
+                'Status': ['{0}Status:1'.format(self.asset_type)],
+                'Parent': ['Story:{0}'.format(self.oid // 10)],
+            }[attr]
+        return False, {
+            'Name': self.name,
+            'Number': self.number,
+            'Nickname': self.name,
+            'Username': self.name,
+            'IsInactive': 'false',
+            'Order': '1',
+            'Status.Name': 'In Progress',
+            'Status.Order': '1',
+            CR_FIELD: 'https://github.com/aarcro/helga-versionone/pull/12',
+        }.get(attr, '')
+
+    def xml(self, attrs):
+        parts = []
+        for attr in attrs:
+            relation, value = self.value(attr)
+            if relation:
+                parts.append('<Relation name="{0}">{1}</Relation>'.format(
+                    attr, ''.join('<Asset idref="{0}"/>'.format(idref) for idref in value)))
+            else:
+                parts.append('<Attribute name="{0}">{1}</Attribute>'.format(attr, escape(value)))
+        return '<Asset id="{0}:{1}">{2}</Asset>'.format(self.asset_type, self.oid, ''.join(parts))
+
+
+def query(asset_type, where):
+    """Assets matching a where or filter string, for the few shapes of query the plugin makes"""
+    terms = re.findall(r"([\w.]+)='([^']*)'", where)
+    numbers = [v for k, v in terms if k == 'Number']
+    if numbers:
+        return [Asset(asset_type, oid_for(n), number=n) for n in numbers]
+    parents = [v for k, v in terms if k == 'Parent.Number']
+    if parents:
+        oid = oid_for(parents[0])
+        return [Asset(asset_type, oid * 10 + i) for i in range(3)]
+    if asset_type == 'Member':
+        if ('IsInactive', 'false') in terms:
+            return [Asset('Member', 20 + i, name=nick) for i, nick in enumerate(NICKS)]
+        return [Asset('Member', 20, name=terms[0][1])] if terms else []
+    if asset_type == 'Team' and terms:
+        return [Asset('Team', 3, name=terms[0][1])]
+    return []
+
+
+class FakeV1Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body):
+        self.server.count(self.command)
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((k.lower(), v[0]) for k, v in parse_qs(url.query).items())
+        parts = url.path.strip('/').split('/')
+        # [instance, api, ...]
+        if parts[1] == 'meta.v1':
+            return self.reply(meta_xml(parts[2]))
+
+        asset_type = parts[3]
+        attrs = [a for a in params.get('sel', '').split(',') if a] or TEXT + sorted(RELATIONS)
+        if len(parts) == 4:
+            assets = query(asset_type, params.get('where', ''))
+            return self.reply('<Assets total="{0}" pageSize="{0}" pageStart="0">{1}</Assets>'.format(
+                len(assets), ''.join(asset.xml(attrs) for asset in assets)))
+
+        asset = Asset(asset_type, int(parts[4]))
+        if len(parts) == 5:
+            return self.reply(asset.xml(attrs))
+        # A single attribute, that's the Asset without the wrapping
+        return self.reply(re.sub(r'^<Asset[^>]*>|</Asset>$', '', asset.xml([parts[5]])))
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        parts = urlparse(self.path).path.strip('/').split('/')
+        oid = parts[4] if len(parts) > 4 else '99999'
+        self.reply('<Asset id="{0}:{1}"/>'.format(parts[3], oid))
+
+
+class FakeV1Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeV1Handler)
+        self.latency = latency
+        self.requests = {'GET': 0, 'POST': 0}
+        self._lock = threading.Lock()
+
+    def count(self, method):
+        with self._lock:
+            self.requests[method] += 1
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/EnvKey'.format(self.server_address[1])
+
+
+class FakeCollection(object):
+    """Mongo collection with nothing in it, that accepts writes"""
+
+    def find_one(self, *args, **kwargs):
+        return None
+
+    def find(self, *args, **kwargs):
+        return []
+
+    def __getattr__(self, name):
+        # save, remove, create_index, update...
+        return lambda *args, **kwargs: None
+
+
+class FakeDB(object):
+    def __getattr__(self, name):
+        return FakeCollection()
+
+
+def load_traffic(path):
+    lines = []
+    with open(path) as f:
+        for line in f:
+            m = re.match(r'<([^>]+)> (.*)$', line.strip())
+            if m:
+                lines.append(m.groups())
+    return lines
+
+
+class Recorder(object):
+    """Stands in for the irc client, notes when a message is first answered"""
+
+    def __init__(self, bench, kind):
+        self.bench = bench
+        self.kind = kind
+        self.start = time.time()
+        self.answered = None
+
+    def msg(self, target, message):
+        if self.answered is None:
+            self.answered = time.time()
+            self.bench.answered(self)
+
+
+class Replay(object):
+    def __init__(self, plugin, traffic, timeout):
+        self.plugin = plugin
+        self.traffic = traffic
+        self.timeout = timeout
+        self.sent = []
+        self.waiting = 0
+        self.start = self.end = None
+
+    def dispatch(self):
+        from helga.plugins import ResponseNotReady
+
+        v1 = self.plugin
+        self.start = time.time()
+        for nick, message in self.traffic:
+            if message.startswith('!v1'):
+                words = message.split()
+                kind = words[1] if len(words) > 1 else 'usage'
+                args = ('v1', words[1:])
+            else:
+                matches = v1.find_versionone_numbers(message)
+                if not matches:
+                    continue
+                kind = 'match'
+                args = (matches,)
+
+            client = Recorder(self, kind)
+            self.sent.append(client)
+            self.waiting += 1
+            try:
+                res = v1.versionone(client, '#team', nick, message, *args)
+            except ResponseNotReady:
+                continue
+            # Answered right away, helga would send it
+            client.msg('#team', res)
+
+        self.check_done()
+
+    def answered(self, client):
+        self.waiting -= 1
+        if self.start is not None:
+            self.check_done()
+
+    def check_done(self):
+        from twisted.internet import reactor
+
+        if self.waiting == 0 and self.end is None:
+            self.end = time.time()
+            reactor.stop()
+
+    def run(self):
+        from twisted.internet import reactor
+
+        reactor.callWhenRunning(self.dispatch)
+        reactor.callLater(self.timeout, reactor.stop)
+        reactor.run()
+
+
+def summary(values):
+    from helga_versionone.stats import Histogram
+
+    h = Histogram()
+    for v in values:
+        h.add(v)
+    return dict((k, round(v, 1) if isinstance(v, float) else v) for k, v in h.summary().items())
+
+
+def version():
+    with open(os.path.join(HERE, '..', 'setup.py')) as f:
+        return re.search(r"version = '([^']+)'", f.read()).group(1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous(config):
+    """The newest saved result with the same config"""
+    for path in sorted(glob.glob(os.path.join(RESULTS, 'traffic-*.json')), reverse=True):
+        with open(path) as f:
+            result = json.load(f)
+        if result['config'] == config:
+            return path, result
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=20, help='ms the fake V1 takes per request')
+    parser.add_argument('--threads', type=int, default=0, help='VERSIONONE_WORKER_THREADS')
+    parser.add_argument('--repeat', type=int, default=5, help='times to replay the log')
+    parser.add_argument('--log', default=os.path.join(HERE, 'traffic.log'))
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--rate-limits', action='store_true', help='keep the default per nick/channel rate limits')
+    parser.add_argument('--no-save', dest='save', action='store_false')
+    opts = parser.parse_args()
+
+    server = FakeV1Server(opts.latency / 1000.0)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    # Settings are read at import, so set them first
+    from helga import settings
+    settings.VERSIONONE_URL = server.url
+    settings.VERSIONONE_AUTH = ('bench', 'bench')
+    settings.VERSIONONE_CR_FIELDS = [CR_FIELD]
+    settings.VERSIONONE_READONLY = True
+    settings.VERSIONONE_OAUTH_ENABLED = False
+    settings.VERSIONONE_WORKER_THREADS = opts.threads
+    settings.VERSIONONE_SHARED_TOKEN = None
+    if not opts.rate_limits:
+        settings.VERSIONONE_NICK_RATE = 0
+        settings.VERSIONONE_CHANNEL_RATE = 0
+        settings.VERSIONONE_MAX_QUEUED = 10000
+
+    import helga_versionone
+    from helga_versionone import stats, workers
+    logging.getLogger('helga_versionone').setLevel(logging.WARNING)
+    logging.getLogger('v1pysdk').setLevel(logging.WARNING)
+    helga_versionone.db = FakeDB()
+
+    # What signon would do, and the metadata every long running bot already has
+    helga_versionone.ALIASES.load()
+    helga_versionone.MEMBERS.load()
+    v1 = helga_versionone.get_system_v1()
+    for asset_type in ASSET_TYPES:
+        v1.asset_class(asset_type)
+    server.requests = {'GET': 0, 'POST': 0}
+    stats.registry.clear()
+
+    traffic = load_traffic(opts.log) * opts.repeat
+    replay = Replay(helga_versionone, traffic, opts.timeout)
+    replay.run()
+    workers.stop_pools()
+    server.shutdown()
+
+    answered = [c for c in replay.sent if c.answered is not None]
+    elapsed = (replay.end or time.time()) - replay.start
+    by_kind = {}
+    for c in answered:
+        by_kind.setdefault(c.kind, []).append((c.answered - c.start) * 1000)
+    http = sum(server.requests.values())
+
+    config = {
+        'latency_ms': opts.latency,
+        'threads': opts.threads,
+        'repeat': opts.repeat,
+        'log': os.path.basename(opts.log),
+    }
+    if opts.rate_limits:
+        config['rate_limits'] = True
+    result = {
+        'version': version(),
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': config,
+        'messages': len(replay.sent),
+        'unanswered': len(replay.sent) - len(answered),
+        'seconds': round(elapsed, 3),
+        'messages_per_sec': round(len(answered) / elapsed, 1),
+        'http_requests': dict(server.requests, total=http),
+        'http_per_message': round(float(http) / len(replay.sent), 2),
+        'latency_ms': dict((kind, summary(values)) for kind, values in sorted(by_kind.items())),
+        'v1_request_ms': dict(
+            (name, dict((k, round(v, 1)) for k, v in timer.items()))
+            for name, timer in stats.snapshot()['timers'].items() if name.startswith('v1.')
+        ),
+    }
+
+    print('{0} messages ({1} unanswered) in {2:.2f}s, latency {3}ms, {4} worker threads'.format(
+        result['messages'], result['unanswered'], elapsed, opts.latency, opts.threads))
+    print('{0:>12,.1f} messages/sec'.format(result['messages_per_sec']))
+    print('{0:>12.2f} HTTP requests/message ({1})'.format(result['http_per_message'], server.requests))
+    print('latency ms      count     p50     p95     p99     max')
+    for kind, s in sorted(result['latency_ms'].items()):
+        print('  {0:<12} {1:>6} {2:>7} {3:>7} {4:>7} {5:>7}'.format(
+            kind, s['count'], s['p50'], s['p95'], s['p99'], s['max']))
+
+    path, before = previous(config)
+    if before is not None:
+        print('vs {0} ({1} {2}):'.format(os.path.basename(path), before['version'], before['commit']))
+        for key in ('messages_per_sec', 'http_per_message'):
+            change = (result[key] - before[key]) / before[key] * 100 if before[key] else 0
+            print('  {0}: {1} -> {2} ({3:+.1f}%)'.format(key, before[key], result[key], change))
+
+    if opts.save:
+        if not os.path.isdir(RESULTS):
+            os.makedirs(RESULTS)
+        path = os.path.join(RESULTS, 'traffic-{0}-{1}.json'.format(
+            result['version'], time.strftime('%Y%m%d-%H%M%S')))
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print('saved {0}'.format(os.path.relpath(path)))
+
+
+if __name__ == '__main__':
+    main()
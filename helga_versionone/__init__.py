@@ -1,16 +1,34 @@
 import re
+import threading
+import time
+from copy import deepcopy
+from datetime import datetime, timedelta
 from functools import wraps, partial
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+
+import httplib2
+import smokesignal
 
 from oauth2client.client import OAuth2Credentials, OAuth2WebServerFlow, FlowExchangeError
 from twisted.internet import reactor, task
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import (
+    Deferred, DeferredList, DeferredSemaphore, FirstError, gatherResults, maybeDeferred,
+)
+from pymongo import UpdateOne
 from urllib2 import HTTPError
+from v1pysdk.client import V1Error, V1Server
+from xml.etree import ElementTree
 
 from helga import log, settings
 from helga.db import db
 from helga.plugins import command, match, random_ack, ResponseNotReady
 
+from helga_versionone import stats, workers
+from helga_versionone.cache import AssetCache, LRUCache, ResponseCache, TicketCache
+from helga_versionone.metadata import MetaSnapshot
+from helga_versionone.scheduler import FairScheduler, QueueFull
+from helga_versionone.v1_wrapper import HelgaV1Query, HelgaV1Server, first, stream_query
+
 
 USE_OAUTH = getattr(settings, 'VERSIONONE_OAUTH_ENABLED', False)
 if USE_OAUTH:
@@ -27,6 +45,204 @@ SPECIAL_PATTERNS = {
 }
 
 
+# V1Meta instances by credential identity, see get_v1
+CONNECTIONS = LRUCache(
+    max_len=getattr(settings, 'VERSIONONE_CONNECTION_POOL_SIZE', 20),
+    max_age_seconds=getattr(settings, 'VERSIONONE_CONNECTION_IDLE_SECONDS', 600),
+)
+
+# Every V1Meta's asset instances, Members and such change less often than Workitems
+ASSETS = AssetCache(
+    max_len=getattr(settings, 'VERSIONONE_ASSET_CACHE_SIZE', 1000),
+    max_age_seconds=getattr(settings, 'VERSIONONE_ASSET_CACHE_TTL', 10),
+    max_ages=getattr(settings, 'VERSIONONE_ASSET_CACHE_TTLS', {
+        'Member': 4 * 60 * 60,
+        'Team': 60 * 60,
+        'TeamRoom': 60 * 60,
+        'StoryStatus': 60 * 60,
+        'TaskStatus': 60 * 60,
+        'TestStatus': 60 * 60,
+    }),
+)
+
+# get_creds results by nick, None is a valid result so use _missing for misses
+_missing = object()
+CREDENTIALS = LRUCache(
+    max_len=getattr(settings, 'VERSIONONE_CREDENTIAL_CACHE_SIZE', 500),
+    max_age_seconds=getattr(settings, 'VERSIONONE_CREDENTIAL_TTL', 60),
+)
+
+# db.v1_channel_settings by channel name
+CHANNELS = LRUCache(
+    max_len=getattr(settings, 'VERSIONONE_CHANNEL_CACHE_SIZE', 200),
+    max_age_seconds=getattr(settings, 'VERSIONONE_CHANNEL_CACHE_TTL', 300),
+)
+
+# !v1 status answers by channel, so asking again at stand-up is instant
+DIGESTS = LRUCache(
+    max_len=getattr(settings, 'VERSIONONE_STATUS_CACHE_SIZE', 50),
+    max_age_seconds=getattr(settings, 'VERSIONONE_STATUS_TTL', 60),
+)
+
+# V1 responses to revalidate instead of downloading again, shared like ASSETS
+RESPONSES = ResponseCache(
+    max_len=getattr(settings, 'VERSIONONE_RESPONSE_CACHE_SIZE', 200),
+    max_bytes=getattr(settings, 'VERSIONONE_RESPONSE_CACHE_MAX_BYTES', 1024 * 1024),
+) if getattr(settings, 'VERSIONONE_RESPONSE_CACHE_SIZE', 200) else None
+
+# /meta.v1 documents asset classes are built from, saved across restarts if there's a file for them
+METADATA = MetaSnapshot(
+    instance_url=getattr(settings, 'VERSIONONE_URL', None),
+    path=getattr(settings, 'VERSIONONE_META_SNAPSHOT', None),
+)
+METADATA.load()
+
+# Asset types refresh_metadata fetches even if nobody has asked for them yet
+META_TYPES = ('Workitem', 'Member', 'Team', 'Task', 'Test', 'Issue', 'Request')
+
+# Ticket summaries shown by versionone_full_descriptions
+TICKETS = TicketCache(
+    max_len=getattr(settings, 'VERSIONONE_DESCRIPTION_CACHE_SIZE', 1000),
+    max_age_seconds=getattr(settings, 'VERSIONONE_DESCRIPTION_TTL', 300),
+    collection=lambda: db.v1_ticket_cache if getattr(settings, 'VERSIONONE_DESCRIPTION_CACHE_MONGO', False) else None,
+)
+
+
+class AliasIndex(object):
+    """irc_nick -> v1_nick from db.v1_user_map, kept in memory once loaded.
+       Until then (or with no bot signed on) lookups go to mongo.
+    """
+
+    def __init__(self):
+        self.aliases = None
+        # Writes made while load reads mongo, to apply over what it read
+        self._written = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        db.v1_user_map.create_index('irc_nick', unique=True)
+        with self._lock:
+            self._written = {}
+        aliases = dict(
+            (alias['irc_nick'], alias['v1_nick'])
+            for alias in db.v1_user_map.find({}, {'irc_nick': True, 'v1_nick': True})
+            if 'v1_nick' in alias
+        )
+        with self._lock:
+            for nick, v1_nick in self._written.items():
+                if v1_nick is None:
+                    aliases.pop(nick, None)
+                else:
+                    aliases[nick] = v1_nick
+            self._written = None
+            self.aliases = aliases
+        logger.debug('Loaded {0} V1 aliases'.format(len(aliases)))
+
+    def get(self, nick):
+        """The v1_nick for nick, or None"""
+        if self.aliases is not None:
+            return self.aliases.get(nick)
+        try:
+            with stats.timer('mongo.v1_user_map'):
+                alias = db.v1_user_map.find_one({'irc_nick': nick})
+            return alias['v1_nick']
+        except (TypeError, KeyError):
+            return None
+
+    def _write(self, nick, v1_nick):
+        with self._lock:
+            if self._written is not None:
+                self._written[nick] = v1_nick
+            if self.aliases is not None:
+                if v1_nick is None:
+                    self.aliases.pop(nick, None)
+                else:
+                    self.aliases[nick] = v1_nick
+
+    def set(self, nick, v1_nick):
+        self._write(nick, v1_nick)
+
+    def remove(self, nick):
+        self._write(nick, None)
+
+    def clear(self):
+        self.aliases = None
+
+
+ALIASES = AliasIndex()
+
+
+class MemberDirectory(object):
+    """Active V1 Members by lower cased Name, Nickname and Username,
+       so get_user doesn't need to search V1 for each lookup.
+    """
+
+    def __init__(self):
+        self.members = {}
+
+    def load(self):
+        members = {}
+        v1 = get_system_v1()
+        for m in stream_query(v1, v1.Member.filter(
+            "IsInactive='false'"
+        ).select(
+            'Name', 'Nickname', 'Username'
+        )):
+            member = {'intid': m.intid, 'Name': m.Name, 'Nickname': m.Nickname}
+            for key in (m.Username, m.Nickname, m.Name):
+                if key:
+                    members[key.lower()] = member
+        self.members = members
+        logger.debug('Loaded {0} V1 members'.format(len(members)))
+
+    def get(self, v1, name):
+        """Member asset for name in v1, or None if we haven't heard of them"""
+        member = self.members.get(name.lower())
+        if member is None:
+            return None
+        return v1.Member(member['intid']).with_data({
+            'Name': member['Name'],
+            'Nickname': member['Nickname'],
+        })
+
+    def clear(self):
+        self.members = {}
+
+
+MEMBERS = MemberDirectory()
+
+# Background work started at signon, by name
+LOOPS = {}
+
+# Every command and background task waits its turn here before talking to V1
+SCHEDULER = FairScheduler(
+    concurrency=getattr(settings, 'VERSIONONE_MAX_CONCURRENT', 8),
+    max_queued=getattr(settings, 'VERSIONONE_MAX_QUEUED', 100),
+    nick_rate=getattr(settings, 'VERSIONONE_NICK_RATE', 0.5),
+    nick_burst=getattr(settings, 'VERSIONONE_NICK_BURST', 5),
+    channel_rate=getattr(settings, 'VERSIONONE_CHANNEL_RATE', 2),
+    channel_burst=getattr(settings, 'VERSIONONE_CHANNEL_BURST', 10),
+)
+
+stats.configure(getattr(settings, 'VERSIONONE_STATS_SINK', None))
+
+
+def clear_caches():
+    """Forget everything cached in this process"""
+    ALIASES.clear()
+    MEMBERS.clear()
+    ASSETS.clear()
+    CHANNELS.clear()
+    DIGESTS.clear()
+    CONNECTIONS.clear()
+    CREDENTIALS.clear()
+    TICKETS.clear()
+    SCHEDULER.clear()
+    if RESPONSES is not None:
+        RESPONSES.clear()
+    METADATA.clear()
+
+
 class NotFound(Exception):
     pass
 
@@ -57,23 +273,73 @@ def quit_now(client, channel, nick, failure):
     client.msg(channel, failure.value.message.format(channel=channel, nick=nick))
 
 
+def too_busy(client, channel, nick, failure):
+    failure.trap(QueueFull)
+    logger.warning('VersionOne too busy for {0} in {1}: {2}'.format(nick, channel, failure.value))
+    client.msg(channel, u'Sorry {0}, I have too much to look up right now, try again in a minute'.format(nick))
+
+
+def blocking_call(fn, *args):
+    """Run fn (which does network IO) without blocking the reactor if possible.
+       With VERSIONONE_WORKER_THREADS set fn runs in the worker pool,
+       otherwise it is only delayed until the next reactor iteration.
+       Other threads may be using other connections at the same time, so fn must read with
+       stream_query or first and write with update_asset or create_object, which all take its v1.
+    """
+    pool = workers.get_pool('commands', getattr(settings, 'VERSIONONE_WORKER_THREADS', 0))
+    if pool is None:
+        return task.deferLater(reactor, 0, fn, *args)
+    return pool.run(fn, *args)
+
+
+def background_call(fn, *args):
+    """blocking_call for work not on behalf of any nick, once SCHEDULER has room for it"""
+    return SCHEDULER.submit(None, None, blocking_call, fn, *args)
+
+
+def send_response(client, target, message):
+    """Send message, VERSIONONE_LINES_PER_MESSAGE lines at a time with
+       VERSIONONE_MESSAGE_INTERVAL seconds between, so long answers don't get the bot kicked for flooding
+    """
+    lines = message.split('\n')
+    size = getattr(settings, 'VERSIONONE_LINES_PER_MESSAGE', 5)
+    interval = getattr(settings, 'VERSIONONE_MESSAGE_INTERVAL', 1)
+    for i, start in enumerate(range(0, len(lines), size)):
+        chunk = '\n'.join(lines[start:start + size])
+        if i == 0:
+            client.msg(target, chunk)
+        else:
+            reactor.callLater(i * interval, client.msg, target, chunk)
+
+
 class deferred_response(object):
-    def __init__(self, target):
+    """Send what fn returns to target (channel or nick), and handle errors.
+       fn waits its turn with SCHEDULER, then is run with blocking_call, unless
+       blocking is False, in which case it is called right away and should return a Deferred.
+    """
+    def __init__(self, target, blocking=True):
         self.target = target
+        self.blocking = blocking
 
     def __call__(self, fn):
         @wraps(fn)
         def wrapper(v1, client, channel, nick, *args):
-            d = task.deferLater(
-                reactor, 0, fn, v1, client, channel, nick, *args
+            run = blocking_call if self.blocking else maybeDeferred
+            start = time.time()
+            d = stats.registry.time_result(
+                'command.{0}'.format(fn.__name__),
+                SCHEDULER.submit(channel, nick, run, fn, v1, client, channel, nick, *args),
+                start,
             ).addCallback(
-                partial(client.msg, locals()[self.target])
+                partial(send_response, client, locals()[self.target])
             ).addErrback(
                 partial(bad_auth, v1, client, channel, nick)
             ).addErrback(
                 partial(bad_args, v1, client, channel, nick)
             ).addErrback(
                 partial(quit_now, client, channel, nick)
+            ).addErrback(
+                partial(too_busy, client, channel, nick)
             )
             logger.debug('Delaying exection of {0}'.format(fn.__name__))
             return d
@@ -83,38 +349,95 @@ deferred_to_channel = deferred_response('channel')
 deferred_to_nick = deferred_response('nick')
 
 
+def update_asset(v1, asset, data):
+    """Write data (attribute name to value) to asset through v1.
+       v1pysdk shares each asset class between connections, and setting attributes or
+       committing goes through whichever connection used the class last, maybe with someone else's credentials.
+    """
+    v1.update_asset(asset._v1_asset_type_name, asset._v1_oid, data)
+    # What we had is stale now, like after asset._v1_commit()
+    asset._v1_current_data = {}
+    asset._v1_needs_refresh = True
+    TICKETS.invalidate(asset.idref)
+
+
 def commit_changes(v1, *args):
     """Respect the READONLY setting, return ack, or no perms message
-       args is a list of 3-tuples, that will be passed to setattr iff we will write to V1
-
-       Because of the V1Meta caching, strange things happen if you make changes and don't actually commit
-       So only make the changes when commiting.
+       args is a list of 3-tuples (asset, attribute name, value), written to V1 through v1 iff we will write
     """
     if getattr(settings, 'VERSIONONE_READONLY', True):
         return 'I would, but I\'m not allowed to write :('
 
-    for call in args:
-        setattr(*call)
-
-    v1.commit()
+    window = getattr(settings, 'VERSIONONE_WRITE_BATCH_WINDOW', 0)
+    try:
+        if window and workers.current_pool() is not None:
+            # Wait for other commands' writes, raises this write's error if it failed
+            WRITES.submit((v1, args), window)
+            return random_ack()
+
+        updates = OrderedDict()
+        for asset, attr, value in args:
+            updates.setdefault(asset.idref, (asset, {}))[1][attr] = value
+        for asset, data in updates.values():
+            update_asset(v1, asset, data)
+    except V1Error:
+        logger.warning('Writing {0} changes failed'.format(len(args)), exc_info=True)
+        raise QuitNow('Sorry {nick}, writing that to VersionOne failed')
     return random_ack()
 
 
-def create_object(Klass, **kwargs):
+def _flush_writes(writes):
+    """Apply the changes from many commit_changes calls, with one update per asset.
+       writes is a list of (v1, changes), returns None or the exception for each write.
+       Values for the same attribute are merged if they are lists (relations only add),
+       otherwise the last one wins.
+    """
+    updates = OrderedDict()
+    for i, (v1, changes) in enumerate(writes):
+        for asset, attr, value in changes:
+            # Grouped by connection too, each is written with its own credentials
+            _, _, data, indexes = updates.setdefault((id(v1), asset.idref), (v1, asset, {}, set()))
+            if isinstance(value, list) and isinstance(data.get(attr), list):
+                data[attr] = data[attr] + [v for v in value if v not in data[attr]]
+            else:
+                data[attr] = value
+            indexes.add(i)
+
+    outcomes = [None] * len(writes)
+    for v1, asset, data, indexes in updates.values():
+        try:
+            update_asset(v1, asset, data)
+        except Exception as e:
+            logger.warning('Writing {0} failed'.format(asset.idref), exc_info=True)
+            TICKETS.invalidate(asset.idref)
+            for i in indexes:
+                outcomes[i] = e
+    return outcomes
+
+# Write-behind queue for commit_changes, see VERSIONONE_WRITE_BATCH_WINDOW
+WRITES = workers.Batcher(_flush_writes)
+
+
+def create_object(v1, Klass, **kwargs):
     """Respect the READONLY setting return the object or raise QuitNow
-       kwargs are passed to Klass.create()
+       kwargs are the new object's attributes, it is created through v1 (see update_asset)
 
     """
     if getattr(settings, 'VERSIONONE_READONLY', True):
         raise QuitNow('I\'m sorry {nick}, write access is disabled')
 
-    return Klass.create(**kwargs)
+    obj = v1.create_asset(Klass._v1_asset_type_name, kwargs)
+    TICKETS.invalidate(obj.idref)
+    return obj
 
 
-def _get_things(Klass, workitem, *args):
+def _get_things(Klass, number, *args):
+    """Children of workitem number, sorted by status, in one query"""
     if not args:
         args = ['Name', 'Status.Name', 'Status.Order']
-    return Klass.where(Parent=workitem.idref).select(*args)
+    return HelgaV1Query(Klass).filter(
+        "Parent.Number='{0}'".format(number)
+    ).select(*args).sort('Status.Order')
 
 
 def get_workitem(v1, number, *args):
@@ -122,25 +445,26 @@ def get_workitem(v1, number, *args):
        args are passed to select to pre-populate fields
     """
     try:
-        return v1.Workitem.where(Number=number).select(*args).first()
+        return first(v1, v1.Workitem.where(Number=number).select(*args))
     except IndexError:
         raise QuitNow('I\'m sorry {{nick}}, item "{0}" not found'.format(number))
 
 
 def get_user(v1, nick):
     o_nick = nick
-    try:
-        nick = db.v1_user_map.find_one({'irc_nick': nick})['v1_nick']
-    except (TypeError, KeyError):
-        # Lookup failed, no worries
-        pass
+    # Their V1 name, if they set an alias
+    nick = ALIASES.get(nick) or nick
+
+    user = MEMBERS.get(v1, nick)
+    if user is not None:
+        return user
 
     try:
-        return v1.Member.filter(
+        return first(v1, v1.Member.filter(
             "Name='{0}'|Nickname='{0}'|Username='{0}'".format(nick)
         ).select(
             'Name', 'Nickname'
-        ).first()
+        ))
     except IndexError:
         raise QuitNow(
             'I\'m sorry {{nick}}, couldn\'t find {0} in VersionOne as {1}. '
@@ -148,18 +472,40 @@ def get_user(v1, nick):
         )
 
 
+def _trim_nick(nick):
+    """Try to trim nick for usual things, like nick|away or nick_"""
+    if '|' in nick:
+        return nick.split('|', 1)[0].strip()
+    elif '_' in nick:
+        return nick.split('_', 1)[0].strip()
+    return nick
+
+
 def get_creds(nick):
     """returns simple token as string, OAuth2Credentials instance, or None
+       Results (even None) are cached for VERSIONONE_CREDENTIAL_TTL seconds
     """
+    creds = CREDENTIALS.get(nick, _missing)
+    if creds is _missing:
+        creds = _lookup_creds(nick)
+        CREDENTIALS.set(nick, creds)
+    return creds
+
+
+def forget_creds(nick):
+    """Drop cached credentials for nick, and any nick that trims to it"""
+    for key in CREDENTIALS.keys():
+        if nick in (key, _trim_nick(key)):
+            CREDENTIALS.pop(key)
+
 
-    auth_info = db.v1_oauth.find_one({'irc_nick': nick}) or None
-    # Try to trim nick for usual things
+def _lookup_creds(nick):
+    with stats.timer('mongo.v1_oauth'):
+        auth_info = db.v1_oauth.find_one({'irc_nick': nick}) or None
     if auth_info is None:
-        if '|' in nick:
-            nick = nick.split('|', 1)[0].strip()
-        elif '_' in nick:
-            nick = nick.split('_', 1)[0].strip()
-        auth_info = db.v1_oauth.find_one({'irc_nick': nick}) or {}
+        nick = _trim_nick(nick)
+        with stats.timer('mongo.v1_oauth'):
+            auth_info = db.v1_oauth.find_one({'irc_nick': nick}) or {}
 
     token = auth_info.get('api_token')
     if token:
@@ -167,15 +513,7 @@ def get_creds(nick):
 
     if USE_OAUTH:
         try:
-            return OAuth2Credentials(
-                auth_info['access_token'],
-                settings.VERSIONONE_OAUTH_CLIENT_ID,
-                settings.VERSIONONE_OAUTH_CLIENT_SECRET,
-                auth_info['refresh_token'],
-                auth_info['token_expiry'],
-                settings.VERSIONONE_URL + '/oauth.v1/token',
-                'helga (chatbot)',
-            )
+            return _oauth_credentials(auth_info)
         except Exception:
             # TODO - what can get raised here
             logger.warning('Problem getting OAuth creds for {0}'.format(nick), exc_info=True)
@@ -184,6 +522,69 @@ def get_creds(nick):
     return None
 
 
+def _oauth_credentials(auth_info):
+    return OAuth2Credentials(
+        auth_info['access_token'],
+        settings.VERSIONONE_OAUTH_CLIENT_ID,
+        settings.VERSIONONE_OAUTH_CLIENT_SECRET,
+        auth_info['refresh_token'],
+        auth_info['token_expiry'],
+        settings.VERSIONONE_URL + '/oauth.v1/token',
+        'helga (chatbot)',
+    )
+
+
+def refresh_oauth_tokens():
+    """Refresh OAuth access tokens that expire within VERSIONONE_OAUTH_REFRESH_AHEAD seconds,
+       before a command finds them expired and has to wait for it.
+       New tokens are saved in one bulk write, and get a connection ready in CONNECTIONS.
+    """
+    if not USE_OAUTH:
+        return
+
+    soon = datetime.utcnow() + timedelta(seconds=getattr(settings, 'VERSIONONE_OAUTH_REFRESH_AHEAD', 600))
+    with stats.timer('mongo.v1_oauth'):
+        expiring = list(db.v1_oauth.find({
+            # A token is used before oauth, see _lookup_creds
+            'api_token': {'$exists': False},
+            'refresh_token': {'$exists': True},
+            'token_expiry': {'$lt': soon},
+        }))
+
+    refreshed = []
+    for auth_info in expiring:
+        try:
+            creds = _oauth_credentials(auth_info)
+            with stats.timer('v1.oauth.refresh'):
+                creds.refresh(httplib2.Http())
+        except Exception:
+            # Revoked or such, leave it to fail where the user can see it
+            logger.warning('Could not refresh OAuth token for {0}'.format(auth_info['irc_nick']), exc_info=True)
+            continue
+        refreshed.append((auth_info, creds))
+
+    if not refreshed:
+        return
+
+    with stats.timer('mongo.v1_oauth'):
+        db.v1_oauth.bulk_write([
+            UpdateOne({'_id': auth_info['_id']}, {'$set': {
+                'access_token': creds.access_token,
+                'refresh_token': creds.refresh_token,
+                'token_expiry': creds.token_expiry,
+            }})
+            for auth_info, creds in refreshed
+        ], ordered=False)
+
+    for auth_info, creds in refreshed:
+        nick = auth_info['irc_nick']
+        forget_creds(nick)
+        CREDENTIALS.set(nick, creds)
+        # Replace rather than reuse, a pooled one would still have the old token
+        CONNECTIONS.set(_connection_key(creds), _connect(creds))
+    logger.debug('Refreshed {0} of {1} expiring OAuth tokens'.format(len(refreshed), len(expiring)))
+
+
 @deferred_to_channel
 def alias_command(v1, client, channel, nick, *args):
     # Populate subcmd, and target to continue
@@ -205,11 +606,7 @@ def alias_command(v1, client, channel, nick, *args):
                 subcmd = 'lookup'
 
     if subcmd == 'lookup':
-        lookup = {'irc_nick': target}
-        try:
-            v1_nick = db.v1_user_map.find_one(lookup)['v1_nick']
-        except (TypeError, KeyError):
-            v1_nick = target
+        v1_nick = ALIASES.get(target) or target
         return '{0} is known as {1} in V1'.format(target, v1_nick)
 
     elif subcmd == 'set':
@@ -217,12 +614,14 @@ def alias_command(v1, client, channel, nick, *args):
         alias = db.v1_user_map.find_one(lookup) or lookup
         alias['v1_nick'] = target
         db.v1_user_map.save(alias)
+        ALIASES.set(nick, target)
 
     elif subcmd == 'remove':
         if target != nick:
             return 'That\'s not nice {0}. You can\'t remove {1}'.format(nick, target)
         lookup = {'irc_nick': nick}
         db.v1_user_map.find_and_modify(lookup, remove=True)
+        ALIASES.remove(nick)
     else:
         return 'No {0}, you can\'t {1}!'.format(nick, subcmd)
 
@@ -245,6 +644,7 @@ def token_command(v1, client, channel, nick, reply_code=None):
             # update the token
             auth_info['api_token'] = reply_code
         db.v1_oauth.save(auth_info)
+        forget_creds(nick)
         return random_ack()
 
     # No reply_code - show step1 instructions
@@ -290,6 +690,7 @@ def oauth_command(v1, client, channel, nick, reply_code=None):
             auth_info['token_expiry'] = creds.token_expiry
 
         db.v1_oauth.save(auth_info)
+        forget_creds(nick)
         return random_ack()
 
     # No reply_code - show step1 link
@@ -297,42 +698,126 @@ def oauth_command(v1, client, channel, nick, reply_code=None):
         client.step1_get_authorize_url())
 
 
+def _connect(credentials):
+    """Build a new V1Meta for credentials, see get_creds"""
+
+    # Access Token is prefered, remove token to use OAUTH
+    if isinstance(credentials, basestring):
+        logger.debug('Using V1 token auth')
+        v1 = V1Meta(
+            instance_url=settings.VERSIONONE_URL,
+            password=credentials,
+            use_password_as_token=True,
+        )
+
+    # Use Oauth if provided
+    elif credentials:
+        logger.debug('Trying V1 oauth')
+        v1 = V1Meta(
+            instance_url=settings.VERSIONONE_URL,
+            credentials=credentials,
+        )
+
+    # System user if no creds
+    else:
+        logger.debug('Trying V1 service user auth')
+        v1 = V1Meta(
+            instance_url=settings.VERSIONONE_URL,
+            username=settings.VERSIONONE_AUTH[0],
+            password=settings.VERSIONONE_AUTH[1],
+        )
+
+    if type(v1.server) is V1Server:
+        # Same server, but with its requests timed
+        v1.server.__class__ = HelgaV1Server
+    if RESPONSES is not None:
+        v1.server.use_response_cache(RESPONSES)
+    v1.server.use_meta_snapshot(METADATA)
+
+    # We assume all users have the same read-access, so share assets
+    v1.global_cache = ASSETS
+    return v1
+
+
+def _connection_key(credentials, shared=False):
+    """Identify a pooled connection by the credentials it uses"""
+    if isinstance(credentials, basestring):
+        return ('shared' if shared else 'token', credentials)
+    elif credentials:
+        return ('oauth', credentials.refresh_token)
+    return ('service', settings.VERSIONONE_AUTH[0])
+
+
+def start_loop(name, interval, fn, *args):
+    """Call fn with background_call every interval seconds, unless name is already running.
+       Errors are logged, and don't stop the loop.
+    """
+    loop = LOOPS.get(name)
+    if loop is not None and loop.running:
+        return loop
+
+    def run():
+        return background_call(fn, *args).addErrback(
+            lambda failure: logger.error('VersionOne {0} failed: {1}'.format(name, failure.getTraceback())))
+
+    loop = LOOPS[name] = task.LoopingCall(run)
+    loop.clock = reactor
+    loop.start(interval, now=True)
+    return loop
+
+
+def stop_loops():
+    for name in list(LOOPS):
+        loop = LOOPS.pop(name)
+        if loop.running:
+            loop.stop()
+
+
+@smokesignal.on('signon')
+def start_background_tasks(client):
+    """Start keeping our in memory copies of things fresh"""
+    start_loop('aliases', getattr(settings, 'VERSIONONE_ALIAS_REFRESH', 300), ALIASES.load)
+    start_loop('members', getattr(settings, 'VERSIONONE_MEMBER_REFRESH', 3600), MEMBERS.load)
+    start_loop('metadata', getattr(settings, 'VERSIONONE_META_REFRESH', 3600), refresh_metadata)
+    global _prewarmed
+    # Once is enough, a reconnect doesn't forget what's cached
+    if getattr(settings, 'VERSIONONE_PREWARM', False) and not _prewarmed:
+        _prewarmed = True
+        prewarm_tickets().addErrback(
+            lambda failure: logger.error('VersionOne prewarm failed: {0}'.format(failure.getTraceback())))
+    interval = getattr(settings, 'VERSIONONE_CHANGE_FEED_INTERVAL', 60)
+    if interval:
+        # A reconnect signs on with a new client, the loop keeps running
+        FEED.client = client
+        start_loop('changes', interval, FEED.poll)
+    if USE_OAUTH:
+        start_loop('oauth', getattr(settings, 'VERSIONONE_OAUTH_REFRESH_INTERVAL', 300), refresh_oauth_tokens)
+
+
+def _pooled_v1(credentials, shared=False):
+    key = _connection_key(credentials, shared)
+    v1 = CONNECTIONS.get(key)
+    if v1 is None:
+        v1 = _connect(credentials)
+    # (Re)setting marks the connection as recently used
+    CONNECTIONS.set(key, v1)
+    return v1
+
+
 def get_v1(nick, use_shared_token=False):
     """Get the v1 connection. If use_shared_token is true, use
        what is given in settings.
+
+       Connections are pooled by credentials, so their sessions and
+       asset metadata are reused between messages.
     """
 
     try:
         credentials = getattr(settings, 'VERSIONONE_SHARED_TOKEN', None)
-        if not use_shared_token or not credentials:
+        shared = use_shared_token and bool(credentials)
+        if not shared:
             credentials = get_creds(nick)
-
-        # Access Token is prefered, remove token to use OAUTH
-        if isinstance(credentials, basestring):
-            logger.debug('Using V1 token auth')
-            v1 = V1Meta(
-                instance_url=settings.VERSIONONE_URL,
-                password=credentials,
-                use_password_as_token=True,
-            )
-
-        # Use Oauth if provided
-        elif credentials:
-            logger.debug('Trying V1 oauth')
-            v1 = V1Meta(
-                instance_url=settings.VERSIONONE_URL,
-                credentials=credentials,
-            )
-
-        # System user if no creds
-        else:
-            # Too much overhead, don't really need to re-init every call
-            logger.debug('Trying V1 service user auth')
-            v1 = V1Meta(
-                instance_url=settings.VERSIONONE_URL,
-                username=settings.VERSIONONE_AUTH[0],
-                password=settings.VERSIONONE_AUTH[1],
-            )
+        v1 = _pooled_v1(credentials, shared)
 
     except AttributeError:
         logger.error('VersionOne plugin misconfigured, check your settings')
@@ -344,6 +829,74 @@ def get_v1(nick, use_shared_token=False):
     return v1
 
 
+def refresh_metadata():
+    """Fetch every asset type in METADATA (and META_TYPES) from V1 again, saving it if anything changed.
+       Classes already built keep what they were built with, until the next restart.
+    """
+    server = get_system_v1().server
+    METADATA.refresh(
+        # Straight from V1, not the snapshot
+        lambda name: ElementTree.tostring(V1Server.get_meta_xml(server, name)),
+        getattr(settings, 'VERSIONONE_META_TYPES', META_TYPES),
+    )
+    METADATA.save()
+
+
+_prewarmed = False
+
+
+def prewarm_tickets():
+    """Fill TICKETS with the open workitems of every channel's teams, so the first pastes after a restart
+       don't all wait on V1. Pages of VERSIONONE_PREWARM_PAGE_SIZE are fetched VERSIONONE_PREWARM_DELAY
+       seconds apart, up to VERSIONONE_PREWARM_MAX workitems (no more than TICKETS holds), and kept for
+       VERSIONONE_PREWARM_TTL seconds. Returns a Deferred that fires with how many
+    """
+    page_size = getattr(settings, 'VERSIONONE_PREWARM_PAGE_SIZE', 100)
+    delay = getattr(settings, 'VERSIONONE_PREWARM_DELAY', 1)
+    # Any more would only push out the first pages
+    most = min(getattr(settings, 'VERSIONONE_PREWARM_MAX', 1000), TICKETS.local.max_len)
+    ttl = getattr(settings, 'VERSIONONE_PREWARM_TTL', 3600)
+    started = time.time()
+
+    def load(teams, start, warmed):
+        if not teams or start >= most:
+            return warmed
+        return background_call(warm_page, teams, start).addCallback(loaded, teams, start, warmed)
+
+    def warm_page(teams, start):
+        tickets = [
+            _ticket(w) for w in
+            _team_page(get_system_v1(), teams, DESCRIPTION_FIELDS, ('Number',), min(page_size, most - start), start)
+        ]
+        TICKETS.set_many(tickets, ttl)
+        return len(tickets)
+
+    def loaded(found, teams, start, warmed):
+        if found < page_size:
+            return warmed + found
+        return task.deferLater(reactor, delay, load, teams, start + page_size, warmed + found)
+
+    def done(warmed, teams):
+        logger.info('Warmed {0} tickets for {1} teams in {2:.1f}s'.format(warmed, len(teams), time.time() - started))
+        return warmed
+
+    def warm_all(teams):
+        return maybeDeferred(load, teams, 0, 0).addCallback(done, teams)
+
+    return background_call(lambda: set(
+        team
+        for channel_settings in db.v1_channel_settings.find({'teams': {'$exists': True}})
+        for team in channel_settings['teams']
+    )).addCallback(warm_all)
+
+
+def get_system_v1():
+    """The v1 connection for background work, not on behalf of any nick.
+       Uses the shared token if there is one, or the service user
+    """
+    return _pooled_v1(getattr(settings, 'VERSIONONE_SHARED_TOKEN', None), shared=True)
+
+
 def _get_review(item):
     for field in settings.VERSIONONE_CR_FIELDS:
         try:
@@ -390,6 +943,25 @@ def review_command(v1, client, channel, nick, number, *args):
     return 'Already got that one {0}'.format(nick)
 
 
+def get_channel_settings(channel):
+    """Settings for the named channel (from db.v1_channel_settings) or new ones.
+       Returns a copy, change it and pass it to save_channel_settings
+    """
+    channel_settings = CHANNELS.get(channel)
+    if channel_settings is None:
+        q = {'name': channel}
+        channel_settings = db.v1_channel_settings.find_one(q) or q
+        CHANNELS.set(channel, channel_settings)
+    return deepcopy(channel_settings)
+
+
+def save_channel_settings(channel_settings):
+    db.v1_channel_settings.save(channel_settings)
+    CHANNELS.set(channel_settings['name'], deepcopy(channel_settings))
+    # Its teams might have changed
+    DIGESTS.pop(channel_settings['name'])
+
+
 @deferred_to_channel
 def team_command(v1, client, channel, nick, *args):
     try:
@@ -398,9 +970,7 @@ def team_command(v1, client, channel, nick, *args):
     except IndexError:
         subcmd = 'list'
 
-    # Find the named channel or create new
-    q = {'name': channel}
-    channel_settings = db.v1_channel_settings.find_one(q) or q
+    channel_settings = get_channel_settings(channel)
     teams = channel_settings.get('teams', {})
     # NB: White space is lost in command parsing, hope for the best
     name = ' '.join(args)
@@ -411,7 +981,8 @@ def team_command(v1, client, channel, nick, *args):
         ]) if teams else 'No teams found for {0}'.format(channel)
     elif subcmd == 'add':
         try:
-            team = v1.Team.where(Name=name).first()
+            # Rooms come back as idrefs, which is all we need
+            team = first(v1, v1.Team.where(Name=name).select('Name', 'Rooms'))
         except IndexError:
             return 'I\'m sorry {0}, team name "{1}" not found'.format(nick, name)
         # Manually building a url is lame, but the url property on TeamRooms doesn't work
@@ -427,32 +998,43 @@ def team_command(v1, client, channel, nick, *args):
         return 'No {0}, you can\'t {1}!'.format(nick, subcmd)
     # If we didn't return by now, save teams back to DB, and ack the user
     channel_settings['teams'] = teams
-    db.v1_channel_settings.save(channel_settings)
+    save_channel_settings(channel_settings)
     return random_ack()
 
 
-@deferred_to_channel
+@deferred_response('channel', blocking=False)
 def take_command(v1, client, channel, nick, number):
-    w = get_workitem(v1, number, 'Owners')
-    user = get_user(v1, nick)
+    # The workitem and the user don't depend on each other, look them up at the same time
+    d = gatherResults([
+        blocking_call(get_workitem, v1, number, 'Owners'),
+        blocking_call(get_user, v1, nick),
+    ], consumeErrors=True)
+
+    def first_error(failure):
+        failure.trap(FirstError)
+        return failure.value.subFailure
+
+    def take(results):
+        w, user = results
+        # Owners are only idrefs from the select, compare those instead of loading each Member
+        if user.idref in set(owner.idref for owner in w.Owners):
+            return 'Dude {0}, you already own it!'.format(nick)
+        # Writing to Owners can only add values
+        return blocking_call(commit_changes, v1, (w, 'Owners', [user]))
 
-    if user in w.Owners:
-        return 'Dude {0}, you already own it!'.format(nick)
-    # Writing to Owners can only add values
-    return commit_changes(v1, (w, 'Owners', [user]))
+    return d.addErrback(first_error).addCallback(take)
 
 
 def _list_or_add_things(v1, class_name, number, action=None, *args):
     Klass = getattr(v1, class_name)
-    workitem = get_workitem(v1, number)
     if action is None:
-        things = list(_get_things(Klass, workitem))
-        things.sort(key=lambda t: t.Status.Order)
-
-        return '\n'.join([
+        # Each line is formatted as its thing is parsed
+        lines = [
             '[{0}] {1} {2}'.format(t.Status.Name, t.Name, t.url)
-            for t in things
-        ]) if things else 'Didn\'t find any {0}s for {1}'.format(class_name, number)
+            for t in stream_query(v1, _get_things(Klass, number))
+        ]
+
+        return '\n'.join(lines) if lines else 'Didn\'t find any {0}s for {1}'.format(class_name, number)
 
     if action != u'add':
         raise QuitNow('I can\'t just "{0}" that, {{nick}}'.format(action))
@@ -462,13 +1044,273 @@ def _list_or_add_things(v1, class_name, number, action=None, *args):
     if not name:
         raise QuitNow('I\'m going to need a title for that, {nick}')
 
+    workitem = get_workitem(v1, number)
     t = create_object(
+        v1,
         Klass,
         Name=name,
         Parent=workitem.idref,
     )
 
-    raise QuitNow('I created {0} {1} for you, {{nick}}'.format(t.Name, t.url))
+    raise QuitNow('I created {0} {1} for you, {{nick}}'.format(name, t.url))
+
+
+def _quoted(values):
+    return ','.join("'{0}'".format(v) for v in values)
+
+
+STATUS_FIELDS = ('Number', 'Status.Name', 'Status.Order', 'Owners.Name', 'Estimate')
+
+
+def _team_page(v1, teams, fields, sort, size, start):
+    """One page of the open workitems of teams"""
+    return stream_query(v1, HelgaV1Query(v1.Workitem).filter(
+        "Team.Name={0};AssetState='64'".format(_quoted(sorted(teams)))
+    ).select(*fields).sort(*sort).page(size, start))
+
+
+def _team_workitems(v1, teams):
+    """Open workitems of teams, fetched VERSIONONE_STATUS_PAGE_SIZE at a time,
+       and at most VERSIONONE_STATUS_MAX of them
+    """
+    page_size = getattr(settings, 'VERSIONONE_STATUS_PAGE_SIZE', 100)
+    most = getattr(settings, 'VERSIONONE_STATUS_MAX', 1000)
+    start = 0
+    while start < most:
+        found = 0
+        for w in _team_page(v1, teams, STATUS_FIELDS, ('Status.Order', 'Number'), min(page_size, most - start), start):
+            found += 1
+            yield w
+        if found < page_size:
+            return
+        start += page_size
+
+
+def _estimate(w):
+    try:
+        return float(w.Estimate or 0)
+    except ValueError:
+        return 0.0
+
+
+def _digest(v1, teams):
+    """Workitem counts, points and owners by status, one line each"""
+    by_status = OrderedDict()
+    for w in _team_workitems(v1, teams):
+        status = by_status.setdefault(w.Status.Name or 'No status', {'count': 0, 'points': 0.0, 'owners': {}})
+        status['count'] += 1
+        status['points'] += _estimate(w)
+        for owner in [o.Name for o in w.Owners] or ['nobody']:
+            status['owners'][owner] = status['owners'].get(owner, 0) + 1
+
+    if not by_status:
+        return 'No open workitems for {0}'.format(', '.join(sorted(teams)))
+
+    lines = ['{0}: {1} open, {2:g} points'.format(
+        ', '.join(sorted(teams)),
+        sum(s['count'] for s in by_status.values()),
+        sum(s['points'] for s in by_status.values()),
+    )]
+    for name, status in by_status.items():
+        owners = sorted(status['owners'].items(), key=lambda item: (-item[1], item[0]))
+        lines.append('{0}: {1} ({2:g} pts) {3}'.format(
+            name, status['count'], status['points'],
+            ', '.join('{0} {1}'.format(owner, count) for owner, count in owners),
+        ))
+    return '\n'.join(lines)
+
+
+@deferred_to_channel
+def status_command(v1, client, channel, nick, *args):
+    """Summary of open work for the channel's teams, cached for VERSIONONE_STATUS_TTL seconds.
+       "refresh" asks V1 again anyway
+    """
+    teams = get_channel_settings(channel).get('teams', {})
+    if not teams:
+        return 'No teams found for {0}, add some with "!v1 teams add <teamname>"'.format(channel)
+
+    digest = None if args[:1] == ('refresh',) else DIGESTS.get(channel)
+    if digest is None:
+        digest = _digest(v1, teams)
+        DIGESTS.set(channel, digest)
+    return digest
+
+
+FEED_FIELDS = ('Number', 'Name', 'Team.Name', 'Status.Name', 'Owners.Name', 'ChangeDate')
+
+
+class ChangeFeed(object):
+    """Announces changes to the workitems of watched channels' teams, found by their ChangeDate.
+       What was last seen of each workitem (db.v1_change_feed_tickets) and each channel's
+       newest ChangeDate (db.v1_change_feed) are kept in mongo, so restarts don't repeat or miss any.
+    """
+
+    def __init__(self):
+        self.indexed = False
+        # Who to announce with, set at each signon
+        self.client = None
+
+    def poll(self):
+        """Look for changes since the last poll, and tell channels about them"""
+        channels = dict(
+            (c['name'], c['teams'])
+            for c in db.v1_channel_settings.find({'watch': True})
+            if c.get('teams')
+        )
+        if not channels:
+            return
+        if not self.indexed:
+            db.v1_change_feed.create_index('channel', unique=True)
+            db.v1_change_feed_tickets.create_index('number', unique=True)
+            self.indexed = True
+        marks = dict(
+            (m['channel'], m['change_date'])
+            for m in db.v1_change_feed.find({'channel': {'$in': list(channels)}})
+            if m.get('change_date')
+        )
+        v1 = get_system_v1()
+
+        # Ask V1 about everyone before saving anything, so a new channel's snapshot
+        # can't hide changes from watched channels with the same teams
+        new = [name for name in channels if name not in marks]
+        snapshot = []
+        if new:
+            # Nothing to compare with yet, only remember how things are now
+            new_teams = set(t for name in new for t in channels[name])
+            snapshot = self._query(v1, new_teams, "AssetState='64'")
+            # Marked even if nothing is open, or the first new workitem would only be snapshotted
+            new_mark = max([w['change_date'] for w in snapshot] + [self._newest(v1, new_teams)])
+
+        watched = [name for name in channels if name in marks]
+        workitems = []
+        announcements = defaultdict(list)
+        if watched:
+            teams = set(t for name in watched for t in channels[name])
+            workitems = self._query(v1, teams, "ChangeDate>'{0}'".format(min(marks[name] for name in watched)))
+            known = self._known([w['number'] for w in workitems])
+            for w in workitems:
+                delta = self._delta(known.get(w['number']), w)
+                if not delta:
+                    continue
+                for name in watched:
+                    if w['team'] in channels[name] and w['change_date'] > marks[name]:
+                        announcements[name].append('{0} {1}: {2}'.format(w['number'], w['name'], delta))
+
+        # Watched channels' workitems were asked for last, they win
+        self._save(OrderedDict((w['number'], w) for w in snapshot + workitems).values())
+        if new:
+            self._mark(new, new_mark)
+        if workitems:
+            self._mark(watched, max(w['change_date'] for w in workitems))
+
+        for name, lines in announcements.items():
+            # Polls run in the worker pool, but the client is the reactor's
+            reactor.callFromThread(send_response, self.client, name, '\n'.join(lines))
+
+    def _query(self, v1, teams, where):
+        """Workitems of teams matching where, as dicts, oldest change first"""
+        fields = list(FEED_FIELDS)
+        # Review fields are custom, only ask for them where Workitem has them
+        reviews = [f for f in getattr(settings, 'VERSIONONE_CR_FIELDS', ()) if hasattr(v1.Workitem, f)]
+        workitems = []
+        with stats.timer('v1.change_feed'):
+            for w in stream_query(v1, HelgaV1Query(v1.Workitem).filter(
+                "Team.Name={0};{1}".format(_quoted(sorted(teams)), where)
+            ).select(*(fields + reviews)).sort('ChangeDate')):
+                workitems.append({
+                    'number': w.Number,
+                    'name': w.Name,
+                    'team': w.Team.Name,
+                    'status': w.Status.Name or None,
+                    'owners': sorted(o.Name for o in w.Owners),
+                    'reviews': ' '.join(getattr(w, f) or '' for f in reviews).strip(),
+                    'change_date': w.ChangeDate,
+                })
+        return workitems
+
+    def _newest(self, v1, teams):
+        """ChangeDate of the last change to any workitem of teams, open or not, or now if there's none"""
+        try:
+            return first(v1, HelgaV1Query(v1.Workitem).filter(
+                "Team.Name={0}".format(_quoted(sorted(teams)))
+            ).select('ChangeDate').sort('-ChangeDate').page(1)).ChangeDate
+        except IndexError:
+            return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000')
+
+    def _known(self, numbers):
+        if not numbers:
+            return {}
+        with stats.timer('mongo.v1_change_feed'):
+            return dict(
+                (t['number'], t) for t in db.v1_change_feed_tickets.find({'number': {'$in': numbers}})
+            )
+
+    def _save(self, workitems):
+        if not workitems:
+            return
+        with stats.timer('mongo.v1_change_feed'):
+            db.v1_change_feed_tickets.bulk_write([
+                UpdateOne({'number': w['number']}, {'$set': {
+                    'status': w['status'],
+                    'owners': w['owners'],
+                    'reviews': w['reviews'],
+                }}, upsert=True)
+                for w in workitems
+            ], ordered=False)
+
+    def _mark(self, channels, newest):
+        """Everything up to the ChangeDate newest has been seen for channels"""
+        with stats.timer('mongo.v1_change_feed'):
+            db.v1_change_feed.bulk_write([
+                UpdateOne({'channel': name}, {'$max': {'change_date': newest}}, upsert=True)
+                for name in channels
+            ], ordered=False)
+
+    def _delta(self, before, w):
+        """What changed between before (None if it's new to us) and w, or ''"""
+        owners = ', '.join(w['owners']) or 'nobody'
+        if before is None:
+            return 'new, {0}, owned by {1}'.format(w['status'] or 'no status', owners)
+
+        changes = []
+        if w['status'] != before.get('status'):
+            changes.append('now {0} (was {1})'.format(w['status'] or 'no status', before.get('status') or 'no status'))
+        added = [o for o in w['owners'] if o not in before.get('owners', [])]
+        if added:
+            changes.append(', '.join('+' + o for o in added))
+        old_reviews = before.get('reviews') or ''
+        if w['reviews'] != old_reviews and w['reviews']:
+            # Reviews are usually appended to
+            new_reviews = w['reviews'][len(old_reviews):] if w['reviews'].startswith(old_reviews) else w['reviews']
+            changes.append('CR {0}'.format(new_reviews.strip()))
+        return ', '.join(changes)
+
+    def forget(self, channel):
+        """Stop following channel, watching again starts from how things are then"""
+        db.v1_change_feed.remove({'channel': channel})
+
+
+FEED = ChangeFeed()
+
+
+@deferred_to_channel
+def watch_command(v1, client, channel, nick, *args):
+    """watch [on | off] - Announce changes to the channel's teams' workitems here, or stop"""
+    channel_settings = get_channel_settings(channel)
+    subcmd = args[0] if args else None
+    if subcmd is None:
+        return '{0} is {1}watching its teams'.format(channel, '' if channel_settings.get('watch') else 'not ')
+    elif subcmd == 'on':
+        if not channel_settings.get('teams'):
+            return 'No teams found for {0}, add some with "!v1 teams add <teamname>"'.format(channel)
+        channel_settings['watch'] = True
+    elif subcmd == 'off':
+        channel_settings.pop('watch', None)
+        FEED.forget(channel)
+    else:
+        return 'No {0}, you can\'t {1}!'.format(nick, subcmd)
+    save_channel_settings(channel_settings)
+    return random_ack()
 
 
 @deferred_to_channel
@@ -489,16 +1331,77 @@ def user_command(v1, client, channel, nick, *args):
     return '{0} [{1}] ({2})'.format(user.Name, user.Nickname, user.url)
 
 
+def _format_stats(name, values):
+    return '{0}: {1}'.format(name, ' '.join(
+        '{0}={1}'.format(k, '{0:.1f}'.format(v) if isinstance(v, float) else v)
+        for k, v in sorted(values.items())
+    ))
+
+
+@deferred_response('nick', blocking=False)
+def stats_command(v1, client, channel, nick, prefix=''):
+    """Timings, counters, and how the pools and caches are doing.
+       Sent to nick, it's long
+    """
+    snapshot = stats.snapshot()
+    lines = [
+        _format_stats(name, timer)
+        for name, timer in sorted(snapshot['timers'].items())
+        if name.startswith(prefix)
+    ]
+    counters = dict((k, v) for k, v in snapshot['counters'].items() if k.startswith(prefix))
+    if counters:
+        lines.append(_format_stats('counters', counters))
+    if not prefix:
+        lines.extend(_format_stats('pool ' + name, pool) for name, pool in sorted(workers.stats().items()))
+        lines.append(_format_stats('lookups', LOOKUPS.stats()))
+        lines.append(_format_stats('writes', WRITES.stats()))
+        lines.append(_format_stats('scheduler', SCHEDULER.stats()))
+        for name, cache in (
+            ('assets', ASSETS), ('channels', CHANNELS), ('connections', CONNECTIONS),
+            ('credentials', CREDENTIALS), ('digests', DIGESTS), ('metadata', METADATA),
+            ('responses', RESPONSES), ('tickets', TICKETS),
+        ):
+            if cache is None:
+                continue
+            values = cache.stats()
+            values.pop('by_type', None)
+            lines.append(_format_stats('cache ' + name, values))
+    return '\n'.join(lines) or 'No stats for {0} yet'.format(prefix)
+
+
+def _compile_matcher(extra_prefixes):
+    prefixes = VERSIONONE_PATTERNS.union(p.upper() for p in extra_prefixes)
+    # Longest first, so TK isn't shadowed by a shorter prefix
+    pat = r'\b(?:{0})-\d+\b'.format('|'.join(sorted(prefixes, key=len, reverse=True)))
+    return tuple(extra_prefixes), re.compile(pat, re.IGNORECASE)
+
+
+# (extra prefixes it was built with, compiled pattern), see find_versionone_numbers
+_matcher = _compile_matcher(getattr(settings, 'VERSIONONE_EXTRA_PREFIXES', ()))
+_dash_digit = re.compile(r'-\d')
+
+
 def find_versionone_numbers(message):
     """
-    Finds all versionone ticket numbers in a message. This will ignore any that already
-    appear in a URL
+    Finds all versionone ticket numbers in a message, upper cased and without duplicates.
+    Runs on every message, so keep it cheap.
     """
+    global _matcher
+
+    # Most chat has no ticket numbers, don't bother with the big pattern
+    if '-' not in message or not _dash_digit.search(message):
+        return []
+
+    extra = tuple(getattr(settings, 'VERSIONONE_EXTRA_PREFIXES', ()))
+    if extra != _matcher[0]:
+        _matcher = _compile_matcher(extra)
 
-    pat = r'\b(({0})-\d+)\b'.format('|'.join(VERSIONONE_PATTERNS))
     tickets = []
-    for ticket in re.findall(pat, message, re.IGNORECASE):
-        tickets.append(ticket[0])
+    for ticket in _matcher[1].findall(message):
+        ticket = ticket.upper()
+        if ticket not in tickets:
+            tickets.append(ticket)
 
     return tickets
 
@@ -515,12 +1418,15 @@ def versionone_command(v1, client, channel, nick, message, cmd, args):
             '!v1 alias [lookup | set | remove] - Lookup an alias, or set/remove your own',
             '!v1 oauth [<code> | forget] - Configure or remove your oauth tokens',
             '!v1 review <issue> [!]<text> - Lookup, append, or set codereview field (alias: cr)',
+            '!v1 stats [<prefix>] - Timings and counters (starting with prefix), pool and cache sizes',
+            '!v1 status [refresh] - Open workitems of the channel\'s teams, by status',
             '!v1 take <ticket-id> - Add yourself to the ticket\'s Owners',
             '!v1 tasks <ticket-id> (add <title>) - List tasks for ticket, or add one',
             '!v1 team[s] [add | remove | list] <teamname> -- add, remove, list team(s) for the channel',
             '!v1 tests <ticket-id> (add <title>) - List tests for ticket, or add one',
             '!v1 token [<code> | forget] - Configure or remove your v1 API token',
             '!v1 user <nick> - Lookup V1 user for an ircnick',
+            '!v1 watch [on | off] - Announce changes to the channel\'s teams\' workitems here',
         ]
     logger.debug('Calling VersionOne subcommand {0} with args {1}'.format(subcmd, args))
 
@@ -533,38 +1439,142 @@ def versionone_command(v1, client, channel, nick, message, cmd, args):
         return u'Umm... {0}, you might want to check the docs for {1}'.format(nick, subcmd)
 
 
-@deferred_to_channel
+# Keep query urls well under what V1 (and proxies) will take
+MAX_FILTER_LENGTH = 2000
+DESCRIPTION_FIELDS = ('Name', 'Number')
+# Identical lookups from many channels at once share one query
+LOOKUPS = workers.SingleFlight()
+
+
+def _batches(numbers):
+    """Split numbers into lists small enough for one query"""
+    size = getattr(settings, 'VERSIONONE_QUERY_BATCH_SIZE', 50)
+    batch, length = [], 0
+    for n in numbers:
+        # Number='n'|
+        term = len(n) + 10
+        if batch and (len(batch) >= size or length + term > MAX_FILTER_LENGTH):
+            yield batch
+            batch, length = [], 0
+        batch.append(n)
+        length += term
+    if batch:
+        yield batch
+
+
+def _ticket(w):
+    """What TICKETS keeps of a workitem"""
+    return {
+        'name': w.Name,
+        'number': w.Number,
+        'url': w.url,
+        'idref': w.idref,
+    }
+
+
+def _describe(v1, kind, numbers):
+    """Look up numbers, all of the same asset type, as ticket dicts.
+       Those in TICKETS (maybe in mongo, so not on the reactor) aren't asked for, the rest are kept there
+    """
+    cached = TICKETS.get_many([n.upper() for n in numbers])
+    missing = [n for n in numbers if n.upper() not in cached]
+    tickets = list(cached.values())
+    if missing:
+        fetched = [
+            _ticket(s)
+            # Use the right Endpoint
+            for s in stream_query(v1, getattr(v1, kind).filter(
+                # OR join on each number
+                '|'.join(["Number='{0}'".format(n) for n in missing])
+            ).select(*DESCRIPTION_FIELDS))
+        ]
+        TICKETS.set_many(fetched)
+        tickets.extend(fetched)
+    return tickets
+
+
+@deferred_response('channel', blocking=False)
 def versionone_full_descriptions(v1, client, channel, nick, message, matches):
     """
-    Meant to be run asynchronously because it uses the network
+    Looks up each asset type (in batches for big pastes) at the same time,
+    answers with whatever is back after VERSIONONE_DESCRIPTION_TIMEOUT seconds
     """
     specials = defaultdict(list)
+    found = {}
+    pending = set()
 
     for m in matches:
-        # Build lists of special lookup types
-        kind = m.split('-')[0]
-        if kind in SPECIAL_PATTERNS:
-            specials[SPECIAL_PATTERNS[kind]].append(m)
-        else:
-            # Or default to Workitem
-            specials['Workitem'].append(m)
-
-    descriptions = []
-    for kind, vals in specials.items():
-        descriptions += [
-            u'[{number}] {name} ({url})'.format(**{
-                'name': s.Name,
-                'number': s.Number,
-                'url': s.url,
-            })
-            # Use the right Endpoint
-            for s in getattr(v1, kind).filter(
-                # OR join on each number
-                '|'.join(["Number='{0}'".format(n) for n in vals])
-            ).select('Name', 'Number')
-        ]
+        number = m.upper()
+        # Only what's in process, mongo is asked with the lookups, off the reactor
+        ticket = TICKETS.peek(number)
+        if ticket is not None:
+            found[number] = ticket
+            continue
+        # Build lists of special lookup types, or default to Workitem
+        kind = SPECIAL_PATTERNS.get(number.split('-')[0], 'Workitem')
+        if number not in pending:
+            pending.add(number)
+            specials[kind].append(m)
+    # Big pastes get split into many queries, don't run them all at once
+    semaphore = DeferredSemaphore(getattr(settings, 'VERSIONONE_QUERY_CONCURRENCY', 4))
+
+    def store(tickets, numbers):
+        # _describe kept them in TICKETS
+        for ticket in tickets:
+            found[ticket['number'].upper()] = ticket
+        pending.difference_update(n.upper() for n in numbers)
+
+    def failed(failure, numbers):
+        # Not found is better than timed out
+        pending.difference_update(n.upper() for n in numbers)
+        return failure
+
+    def lookup(kind, batch):
+        key = (kind, tuple(sorted(n.upper() for n in batch)), DESCRIPTION_FIELDS)
+        return LOOKUPS.run(key, blocking_call, _describe, v1, kind, batch)
+
+    lookups = DeferredList([
+        semaphore.run(lookup, kind, batch).addCallbacks(
+            store, failed, callbackArgs=(batch,), errbackArgs=(batch,))
+        for kind, vals in specials.items()
+        for batch in _batches(vals)
+    ], consumeErrors=True)
+
+    done = Deferred()
+    timer = reactor.callLater(
+        getattr(settings, 'VERSIONONE_DESCRIPTION_TIMEOUT', 10),
+        lambda: done.called or done.callback(None),
+    )
 
-    return '\n'.join(descriptions)
+    def finished(results):
+        if timer.active():
+            timer.cancel()
+        failures = [res for ok, res in results if not ok]
+        if failures and len(failures) == len(results):
+            if found:
+                # Still answer with what was cached, then let the errbacks explain the rest
+                send_response(client, channel, describe(None))
+            failures[0].raiseException()
+        for failure in failures:
+            logger.warning('Lookup failed for some of {0}: {1}'.format(matches, failure.getErrorMessage()))
+        if not done.called:
+            done.callback(None)
+
+    lookups.addCallback(finished).addErrback(lambda failure: done.called or done.errback(failure))
+
+    def describe(_):
+        descriptions = []
+        for m in matches:
+            number = m.upper()
+            ticket = found.pop(number, None)
+            if ticket is not None:
+                descriptions.append(u'[{number}] {name} ({url})'.format(**ticket))
+            elif number in pending:
+                descriptions.append(u'[{0}] timed out'.format(number))
+                pending.discard(number)
+        return '\n'.join(descriptions)
+
+    return done.addCallback(describe)
 
 
 @match(find_versionone_numbers)
@@ -605,6 +1615,8 @@ COMMAND_MAP = {
     'cr': review_command,
     'oauth': oauth_command,
     'review': review_command,
+    'stats': stats_command,
+    'status': status_command,
     'take': take_command,
     'tasks': tasks_command,
     'team': team_command,
@@ -612,4 +1624,5 @@ COMMAND_MAP = {
     'tests': tests_command,
     'token': token_command,
     'user': user_command,
+    'watch': watch_command,
 }
@@ -0,0 +1,232 @@
+"""Small in-process caches with expiry and hit/miss counters"""
+
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pymongo import ReplaceOne
+
+
+class LRUCache(object):
+    """Thread safe LRU mapping, entries expire after max_age_seconds
+       (or the ttl given to set). A max_age_seconds of None never expires.
+    """
+
+    def __init__(self, max_len, max_age_seconds=None):
+        assert max_len >= 1
+        self.max_len = max_len
+        self.max_age = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._live(key) is not None
+
+    def _live(self, key):
+        """Return (value, expires) for key, dropping it if expired"""
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # Most recently used goes to the end
+            del self._data[key]
+            self._data[key] = item
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.max_age
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.max_len:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._data[key] = (value, expires)
+
+    def __getitem__(self, key):
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                raise KeyError(key)
+            return item[0]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._live(key)
+            self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def remove_if(self, predicate):
+        """Remove every entry whose value matches predicate"""
+        with self._lock:
+            for key, item in list(self._data.items()):
+                if predicate(item[0]):
+                    del self._data[key]
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_len': self.max_len,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class TicketCache(object):
+    """Ticket summaries (dicts with number, name, url and idref) by Number.
+       collection is a callable returning a Mongo collection to back the
+       local LRU with, or None to stay in process.
+    """
+
+    def __init__(self, max_len, max_age_seconds, collection=None):
+        self.local = LRUCache(max_len, max_age_seconds)
+        self.collection = collection or (lambda: None)
+        self.hits = 0
+        self.misses = 0
+        self._indexed = False
+
+    def _remote(self):
+        coll = self.collection()
+        if coll is not None and not self._indexed:
+            # Let Mongo throw away expired entries
+            coll.create_index('expires', expireAfterSeconds=0)
+            # For invalidate
+            coll.create_index('idref')
+            self._indexed = True
+        return coll
+
+    def peek(self, number):
+        """The ticket for number if it's in process, without asking mongo (so it's safe on the reactor).
+           A miss isn't counted, look for it again with get_many
+        """
+        ticket = self.local.get(number)
+        if ticket is not None:
+            self.hits += 1
+        return ticket
+
+    def get_many(self, numbers):
+        """Tickets by number for those of numbers we have, with one query to mongo"""
+        found = {}
+        for number in numbers:
+            ticket = self.local.get(number)
+            if ticket is not None:
+                found[number] = ticket
+        coll = self._remote()
+        missing = [n for n in numbers if n not in found]
+        if coll is not None and missing:
+            for doc in coll.find({'_id': {'$in': missing}, 'expires': {'$gt': datetime.utcnow()}}):
+                found[doc['_id']] = doc['ticket']
+                self.local.set(doc['_id'], doc['ticket'])
+        self.hits += len(found)
+        self.misses += len(set(numbers)) - len(found)
+        return found
+
+    def set_many(self, tickets, ttl=None):
+        """Keep each of tickets, with one write to mongo. They expire after ttl seconds, or max_age_seconds"""
+        if ttl is None:
+            ttl = self.local.max_age
+        for ticket in tickets:
+            self.local.set(ticket['number'], ticket, ttl)
+        coll = self._remote()
+        if coll is not None and tickets:
+            expires = datetime.utcnow() + timedelta(seconds=ttl)
+            coll.bulk_write([
+                ReplaceOne({'_id': ticket['number']}, {
+                    '_id': ticket['number'],
+                    'idref': ticket['idref'],
+                    'ticket': ticket,
+                    'expires': expires,
+                }, upsert=True)
+                for ticket in tickets
+            ], ordered=False)
+
+    def invalidate(self, idref):
+        """Drop the ticket for an asset that was just written to"""
+        self.local.remove_if(lambda ticket: ticket['idref'] == idref)
+        coll = self._remote()
+        if coll is not None:
+            coll.remove({'idref': idref})
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        stats = self.local.stats()
+        stats.update(hits=self.hits, misses=self.misses)
+        return stats
+
+
+class AssetCache(LRUCache):
+    """A V1Meta.global_cache that can be shared by every V1Meta.
+       Keys are (asset type name, oid), max_ages can give each asset type
+       its own max age in seconds, others use max_age_seconds.
+    """
+
+    def __init__(self, max_len, max_age_seconds, max_ages=None):
+        super(AssetCache, self).__init__(max_len, max_age_seconds)
+        self.max_ages = max_ages or {}
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.max_ages.get(key[0], self.max_age)
+        super(AssetCache, self).set(key, value, ttl)
+
+    def stats(self):
+        stats = super(AssetCache, self).stats()
+        by_type = {}
+        for asset_type, oid in self.keys():
+            by_type[asset_type] = by_type.get(asset_type, 0) + 1
+        stats['by_type'] = by_type
+        return stats
+
+
+class ResponseCache(LRUCache):
+    """HTTP responses kept to revalidate with ETag / Last-Modified, works as an httplib2 cache.
+       Values are strings (from httplib2) or tuples ending with the body, bodies over max_bytes aren't kept.
+    """
+
+    def __init__(self, max_len, max_bytes):
+        super(ResponseCache, self).__init__(max_len)
+        self.max_bytes = max_bytes
+
+    def set(self, key, value, ttl=None):
+        body = value if isinstance(value, basestring) else value[-1]
+        if len(body) > self.max_bytes:
+            self.pop(key)
+            return
+        super(ResponseCache, self).set(key, value, ttl)
+
+    def delete(self, key):
+        self.pop(key)
@@ -0,0 +1,132 @@
+"""/meta.v1 asset type documents, kept on disk so a restart doesn't have to fetch them again"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Bump when the file layout changes, older files are ignored
+FORMAT_VERSION = 1
+
+
+class MetaSnapshot(object):
+    """Meta XML by asset type name, for one V1 instance.
+       Saved to path (if given) as JSON, with FORMAT_VERSION and the instance url,
+       a file for another version or instance is ignored.
+    """
+
+    def __init__(self, instance_url, path=None):
+        self.instance_url = instance_url
+        self.path = path
+        self.types = {}
+        # Bumped by every change, so a saved snapshot can be told apart from the next one
+        self.revision = 0
+        self.saved = None
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Meta XML for asset type name, or None"""
+        with self._lock:
+            return self.types.get(name)
+
+    def set(self, name, xml):
+        """Remember xml for asset type name, returns True if it changed"""
+        with self._lock:
+            if self.types.get(name) == xml:
+                return False
+            self.types[name] = xml
+            self.revision += 1
+            self.dirty = True
+            return True
+
+    def names(self):
+        with self._lock:
+            return sorted(self.types)
+
+    def refresh(self, fetch, names=()):
+        """Fetch (a function of asset type name to XML) every known type and names again,
+           returns the names that changed. A type that can't be fetched is logged and skipped
+        """
+        changed = []
+        for name in sorted(set(self.names()).union(names)):
+            try:
+                xml = fetch(name)
+            except Exception:
+                # Not every instance has every type, don't let one stop the rest
+                logger.warning('Could not fetch V1 metadata for {0}'.format(name), exc_info=True)
+                continue
+            if self.set(name, xml):
+                changed.append(name)
+        if changed:
+            logger.info('V1 metadata changed for {0}'.format(', '.join(changed)))
+        return changed
+
+    def load(self):
+        """Replace what we have with the saved snapshot, returns True if there was a usable one"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            logger.warning('Could not read V1 metadata from {0}'.format(self.path), exc_info=True)
+            return False
+
+        if data.get('version') != FORMAT_VERSION or data.get('instance_url') != self.instance_url:
+            logger.info('Ignoring V1 metadata in {0}, it is for another version or instance'.format(self.path))
+            return False
+
+        with self._lock:
+            self.types = dict(data['types'])
+            self.revision = data.get('revision', 0)
+            self.saved = data.get('saved')
+            self.dirty = False
+        logger.debug('Loaded V1 metadata for {0} asset types'.format(len(self.types)))
+        return True
+
+    def save(self):
+        """Write the snapshot to path, if it changed since the last load or save"""
+        if not self.path or not self.dirty:
+            return False
+        with self._lock:
+            saved = time.time()
+            data = {
+                'version': FORMAT_VERSION,
+                'instance_url': self.instance_url,
+                'revision': self.revision,
+                'saved': saved,
+                'types': dict(self.types),
+            }
+            self.dirty = False
+
+        # Write then rename, so a crash can't leave half a file to load
+        tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            self.dirty = True
+            logger.warning('Could not save V1 metadata to {0}'.format(self.path), exc_info=True)
+            return False
+        self.saved = saved
+        return True
+
+    def clear(self):
+        with self._lock:
+            self.types = {}
+            self.revision = 0
+            self.dirty = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'types': len(self.types),
+                'revision': self.revision,
+                'age': int(time.time() - self.saved) if self.saved else None,
+            }
@@ -0,0 +1,183 @@
+"""Decide when commands get to talk to VersionOne, so one busy nick or channel can't starve the rest"""
+
+import logging
+
+from collections import deque, OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+
+from helga_versionone import stats
+
+
+logger = logging.getLogger(__name__)
+
+# Buckets kept before full (so forgettable) ones are dropped
+MAX_BUCKETS = 1000
+
+
+class QueueFull(Exception):
+    """The scheduler already has as much work waiting as it will hold"""
+
+
+class TokenBucket(object):
+    """rate tokens a second, holding at most burst"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _fill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now):
+        """Seconds until there is a token, 0 if there is one now"""
+        self._fill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._fill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._fill(now)
+        return self.tokens >= self.burst
+
+
+class FairScheduler(object):
+    """Runs jobs, at most concurrency at a time.
+       Waiting jobs are queued by channel, and channels take turns. A job also needs a token
+       from its nick's and its channel's bucket (a rate of 0 doesn't limit), a nick or channel of None
+       is background work and only waits for its turn. At most max_queued jobs wait, more fail with QueueFull.
+    """
+
+    def __init__(self, concurrency, max_queued, nick_rate=0, nick_burst=1, channel_rate=0, channel_burst=1,
+                 clock=None):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.limits = {'nick': (nick_rate, nick_burst), 'channel': (channel_rate, channel_burst)}
+        self.clock = clock
+        self.queues = OrderedDict()
+        self.buckets = {}
+        self.queued = 0
+        self.running = 0
+        self.started = 0
+        self.rejected = 0
+        self._timer = None
+        self._dispatching = False
+        self._again = False
+
+    def _now(self):
+        return (self.clock or reactor).seconds()
+
+    def submit(self, channel, nick, fn, *args):
+        """Call fn(*args) when channel and nick's turn comes, returns a Deferred of what it returns"""
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            stats.incr('scheduler.rejected')
+            return fail(QueueFull('{0} jobs already waiting'.format(self.queued)))
+        d = Deferred()
+        self.queues.setdefault(channel, deque()).append((d, channel, nick, fn, args, self._now()))
+        self.queued += 1
+        self._dispatch()
+        return d
+
+    def _bucket(self, kind, key, now):
+        rate, burst = self.limits[kind]
+        if key is None or not rate:
+            return None
+        bucket = self.buckets.get((kind, key))
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                # A full bucket is the same as a new one
+                for k, b in self.buckets.items():
+                    if b.full(now):
+                        del self.buckets[k]
+            bucket = self.buckets[(kind, key)] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _wait(self, job, now):
+        """Seconds until job's buckets both have a token"""
+        buckets = [self._bucket('nick', job[2], now), self._bucket('channel', job[1], now)]
+        return max([b.wait(now) for b in buckets if b is not None] or [0])
+
+    def _dispatch(self):
+        # Jobs that finish right away dispatch again, don't recurse
+        if self._dispatching:
+            self._again = True
+            return
+        self._dispatching = True
+        try:
+            self._again = True
+            while self._again:
+                self._again = False
+                self._dispatch_once()
+        finally:
+            self._dispatching = False
+
+    def _dispatch_once(self):
+        now = self._now()
+        soonest = None
+        while self.running < self.concurrency and self.queues:
+            for channel in list(self.queues):
+                queue = self.queues[channel]
+                waits = [(self._wait(job, now), i) for i, job in enumerate(queue)]
+                wait, i = min(waits)
+                if wait:
+                    soonest = wait if soonest is None else min(soonest, wait)
+                    continue
+                job = queue[i]
+                del queue[i]
+                # To the back of the line, for the next channel's turn
+                del self.queues[channel]
+                if queue:
+                    self.queues[channel] = queue
+                self._start(job, now)
+                break
+            else:
+                # Everyone left is waiting for tokens
+                break
+
+        if soonest is not None and self.running < self.concurrency:
+            self._wake_in(soonest, now)
+
+    def _wake_in(self, seconds, now):
+        clock = self.clock or reactor
+        if self._timer is not None and self._timer.active():
+            if self._timer.getTime() <= now + seconds:
+                return
+            self._timer.cancel()
+        self._timer = clock.callLater(seconds, self._dispatch)
+
+    def _start(self, job, now):
+        d, channel, nick, fn, args, queued_at = job
+        for bucket in (self._bucket('nick', nick, now), self._bucket('channel', channel, now)):
+            if bucket is not None:
+                bucket.take(now)
+        self.queued -= 1
+        self.running += 1
+        self.started += 1
+        stats.registry.timing('scheduler.wait', (now - queued_at) * 1000)
+
+        def finished(res):
+            self.running -= 1
+            self._dispatch()
+            return res
+
+        maybeDeferred(fn, *args).addBoth(finished).chainDeferred(d)
+
+    def clear(self):
+        """Forget how much everyone has asked for lately"""
+        self.buckets.clear()
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'started': self.started,
+            'rejected': self.rejected,
+            'channels': len(self.queues),
+        }
@@ -0,0 +1,181 @@
+"""Latency histograms and counters, kept in memory and reported through a sink"""
+
+import logging
+import socket
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from urlparse import urlparse
+
+from twisted.internet.defer import Deferred
+
+
+logger = logging.getLogger(__name__)
+
+# Percentiles are taken over this many of the most recent samples
+SAMPLES = 1000
+
+
+class Histogram(object):
+    """Count, max and percentiles of recent values"""
+
+    def __init__(self, size=SAMPLES):
+        self.count = 0
+        self.max = 0
+        self.samples = deque(maxlen=size)
+
+    def add(self, value):
+        self.count += 1
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def percentile(self, p, ordered=None):
+        """Nearest rank percentile, p from 0 to 100"""
+        ordered = ordered or sorted(self.samples)
+        if not ordered:
+            return 0
+        rank = int(round(p / 100.0 * len(ordered))) - 1
+        return ordered[max(0, min(rank, len(ordered) - 1))]
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        return {
+            'count': self.count,
+            'p50': self.percentile(50, ordered),
+            'p95': self.percentile(95, ordered),
+            'p99': self.percentile(99, ordered),
+            'max': self.max,
+        }
+
+
+class LogSink(object):
+    """Log every measurement"""
+
+    def __init__(self, log=logger):
+        self.log = log
+
+    def timing(self, name, ms):
+        self.log.info('stat {0} {1:.1f}ms'.format(name, ms))
+
+    def incr(self, name, count):
+        self.log.info('stat {0} +{1}'.format(name, count))
+
+
+class StatsdSink(object):
+    """Send measurements to a StatsD compatible server over UDP"""
+
+    def __init__(self, host='localhost', port=8125, prefix='helga.versionone.'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def send(self, line):
+        try:
+            self.socket.sendto(self.prefix + line, self.address)
+        except socket.error:
+            # Lost stats are better than failed commands
+            logger.debug('Could not send stat {0}'.format(line), exc_info=True)
+
+    def timing(self, name, ms):
+        self.send('{0}:{1:.3f}|ms'.format(name, ms))
+
+    def incr(self, name, count):
+        self.send('{0}:{1}|c'.format(name, count))
+
+
+def make_sink(spec):
+    """Sink for a VERSIONONE_STATS_SINK value:
+       None or 'memory' (only keep them here), 'log', or 'statsd://host:port'
+    """
+    if not spec or spec == 'memory':
+        return None
+    if spec == 'log':
+        return LogSink()
+    parsed = urlparse(spec)
+    if parsed.scheme == 'statsd':
+        return StatsdSink(parsed.hostname or 'localhost', parsed.port or 8125)
+    raise ValueError('Unknown stats sink {0}'.format(spec))
+
+
+class Registry(object):
+    """Timers (histograms of milliseconds) and counters by name, safe to use from any thread"""
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def timing(self, name, ms):
+        with self._lock:
+            if name not in self.timers:
+                self.timers[name] = Histogram()
+            self.timers[name].add(ms)
+        if self.sink is not None:
+            self.sink.timing(name, ms)
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+        if self.sink is not None:
+            self.sink.incr(name, count)
+
+    @contextmanager
+    def timer(self, name):
+        """Time the with block, errors are counted as name.errors"""
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.incr(name + '.errors')
+            raise
+        finally:
+            self.timing(name, (time.time() - start) * 1000)
+
+    def time_result(self, name, res_or_deferred, start):
+        """Record the time from start until res_or_deferred is ready, returns it"""
+        def done(res):
+            self.timing(name, (time.time() - start) * 1000)
+            return res
+
+        if isinstance(res_or_deferred, Deferred):
+            def failed(failure):
+                self.incr(name + '.errors')
+                return failure
+            return res_or_deferred.addErrback(failed).addBoth(done)
+        return done(res_or_deferred)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'timers': dict((name, h.summary()) for name, h in self.timers.items()),
+                'counters': dict(self.counters),
+            }
+
+    def clear(self):
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+
+
+# Everything reports here, see configure
+registry = Registry()
+
+
+def configure(spec):
+    registry.sink = make_sink(spec)
+
+
+def timer(name):
+    return registry.timer(name)
+
+
+def incr(name, count=1):
+    registry.incr(name, count)
+
+
+def snapshot():
+    return registry.snapshot()
@@ -1,4 +1,7 @@
-from mock import call
+from mock import call, patch
+from twisted.internet.task import Clock
+
+import helga_versionone
 
 from .util import V1TestCase
 
@@ -126,3 +129,72 @@ class TestAliasCommand(V1TestCase):
             'alias naughty fhqwhgads'
             'No {0}, you can\'t naughty!'.format(self.nick)
         )
+
+
+class TestAliasIndex(V1TestCase):
+    reactor = patch('helga_versionone.reactor', new_callable=Clock)
+
+    def setUp(self):
+        super(TestAliasIndex, self).setUp()
+        self.db.v1_user_map.find.return_value = [
+            {'irc_nick': self.nick, 'v1_nick': 'nickname'},
+            {'irc_nick': 'other'},
+        ]
+        self.addCleanup(helga_versionone.stop_loops)
+
+    def test_load(self):
+        helga_versionone.ALIASES.load()
+        self.db.v1_user_map.create_index.assert_called_once_with('irc_nick', unique=True)
+        self.assertEqual(helga_versionone.ALIASES.get(self.nick), 'nickname')
+        self.assertEqual(helga_versionone.ALIASES.get('other'), None)
+        self.assertFalse(self.db.v1_user_map.find_one.called)
+
+    def test_written_during_load(self):
+        def find(*args):
+            # Someone else's alias commands land while mongo is being read
+            helga_versionone.ALIASES.set('new', 'newnick')
+            helga_versionone.ALIASES.remove(self.nick)
+            return [{'irc_nick': self.nick, 'v1_nick': 'nickname'}]
+        self.db.v1_user_map.find.side_effect = find
+
+        helga_versionone.ALIASES.load()
+        self.assertEqual(helga_versionone.ALIASES.get('new'), 'newnick')
+        self.assertEqual(helga_versionone.ALIASES.get(self.nick), None)
+
+        # Only writes during a load are kept for it
+        self.db.v1_user_map.find.side_effect = None
+        self.db.v1_user_map.find.return_value = [{'irc_nick': self.nick, 'v1_nick': 'nickname'}]
+        helga_versionone.ALIASES.load()
+        self.assertEqual(helga_versionone.ALIASES.get(self.nick), 'nickname')
+
+    def test_write_through(self):
+        helga_versionone.ALIASES.load()
+        self.db.v1_user_map.find_one.return_value = None
+        d = self._test_command('alias set fhqwhgads')
+
+        def check(res):
+            self.assertEqual(helga_versionone.ALIASES.get(self.nick), 'fhqwhgads')
+            return self._test_command('alias remove')
+
+        d.addCallback(check)
+        d.addCallback(lambda _: self.assertEqual(helga_versionone.ALIASES.get(self.nick), None))
+        # Commands run on the patched reactor
+        self.reactor.advance(0)
+        self.reactor.advance(0)
+        return d
+
+    def test_signon_loads(self):
+        helga_versionone.start_background_tasks(self.client)
+        self.reactor.advance(0)
+        self.assertEqual(helga_versionone.ALIASES.get(self.nick), 'nickname')
+
+        # And refreshes
+        self.db.v1_user_map.find.return_value = []
+        self.reactor.advance(300)
+        self.assertEqual(helga_versionone.ALIASES.get(self.nick), None)
+
+    def test_signon_again(self):
+        helga_versionone.start_background_tasks(self.client)
+        loop = helga_versionone.LOOPS['aliases']
+        helga_versionone.start_background_tasks(self.client)
+        self.assertIs(helga_versionone.LOOPS['aliases'], loop)
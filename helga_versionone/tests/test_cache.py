@@ -0,0 +1,177 @@
+from datetime import datetime, timedelta
+from mock import MagicMock, call, patch
+import time
+from unittest import TestCase
+
+from helga_versionone.cache import AssetCache, LRUCache, ResponseCache, TicketCache
+
+
+class TestLRUCache(TestCase):
+    def test_miss(self):
+        c = LRUCache(max_len=2)
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(c.get('a', 'default'), 'default')
+        self.assertEqual(c.stats()['misses'], 2)
+
+    def test_hit(self):
+        c = LRUCache(max_len=2)
+        c['a'] = 1
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c['a'], 1)
+        self.assertIn('a', c)
+        self.assertEqual(c.stats()['hits'], 1)
+
+    def test_lru_eviction(self):
+        c = LRUCache(max_len=2)
+        c['a'] = 1
+        c['b'] = 2
+        # Touch a, so b is the oldest
+        c.get('a')
+        c['c'] = 3
+        self.assertEqual(sorted(c.keys()), ['a', 'c'])
+        self.assertEqual(c.stats()['evictions'], 1)
+
+    @patch('helga_versionone.cache.time')
+    def test_expiry(self, time):
+        time.time.return_value = 100
+        c = LRUCache(max_len=2, max_age_seconds=10)
+        c['a'] = 1
+        c.set('b', 2, ttl=30)
+        time.time.return_value = 115
+        self.assertEqual(c.get('a'), None)
+        self.assertNotIn('a', c)
+        self.assertEqual(c.get('b'), 2)
+        self.assertRaises(KeyError, c.__getitem__, 'a')
+
+    def test_pop(self):
+        c = LRUCache(max_len=2)
+        c['a'] = 1
+        self.assertEqual(c.pop('a'), 1)
+        self.assertEqual(c.pop('a', 'gone'), 'gone')
+        self.assertEqual(len(c), 0)
+
+
+class TestTicketCache(TestCase):
+    def setUp(self):
+        self.ticket = {'number': 'B-0010', 'name': 'A story', 'url': 'http://example.com', 'idref': 'Story:10'}
+        self.collection = MagicMock()
+
+    def test_local(self):
+        c = TicketCache(max_len=10, max_age_seconds=60)
+        self.assertEqual(c.get_many(['B-0010']), {})
+        c.set_many([self.ticket])
+        self.assertEqual(c.get_many(['B-0010']), {'B-0010': self.ticket})
+        self.assertEqual(c.stats()['hits'], 1)
+        self.assertEqual(c.stats()['misses'], 1)
+
+    def test_invalidate(self):
+        c = TicketCache(max_len=10, max_age_seconds=60)
+        c.set_many([self.ticket, dict(self.ticket, number='B-0011', idref='Story:11')])
+        c.invalidate('Story:10')
+        self.assertEqual(c.peek('B-0010'), None)
+        self.assertEqual(c.peek('B-0011')['idref'], 'Story:11')
+
+    def test_mongo_write_through(self):
+        c = TicketCache(max_len=10, max_age_seconds=60, collection=lambda: self.collection)
+        c.set_many([self.ticket])
+        self.assertEqual(self.collection.create_index.call_args_list, [
+            call('expires', expireAfterSeconds=0),
+            call('idref'),
+        ])
+        self.assertEqual(self.collection.bulk_write.call_args[0][0][0]._doc['idref'], 'Story:10')
+
+        c.invalidate('Story:10')
+        self.collection.remove.assert_called_once_with({'idref': 'Story:10'})
+
+    def test_set_many(self):
+        c = TicketCache(max_len=10, max_age_seconds=60, collection=lambda: self.collection)
+        other = dict(self.ticket, number='B-0011', idref='Story:11')
+        c.set_many([self.ticket, other])
+        self.assertEqual(c.peek('B-0011'), other)
+
+        writes = self.collection.bulk_write.call_args[0][0]
+        self.assertEqual([w._filter for w in writes], [{'_id': 'B-0010'}, {'_id': 'B-0011'}])
+        self.assertEqual(writes[0]._doc['ticket'], self.ticket)
+        self.assertFalse(self.collection.save.called)
+
+    def test_set_many_none(self):
+        c = TicketCache(max_len=10, max_age_seconds=60, collection=lambda: self.collection)
+        c.set_many([])
+        self.assertFalse(self.collection.bulk_write.called)
+
+    def test_set_many_ttl(self):
+        c = TicketCache(max_len=10, max_age_seconds=60, collection=lambda: self.collection)
+        c.set_many([self.ticket], ttl=3600)
+        self.assertGreater(c.local._data['B-0010'][1] - time.time(), 60)
+        expires = self.collection.bulk_write.call_args[0][0][0]._doc['expires']
+        self.assertGreater(expires - datetime.utcnow(), timedelta(seconds=60))
+
+    def test_mongo_hit(self):
+        self.collection.find.return_value = [{'_id': 'B-0010', 'ticket': self.ticket}]
+        c = TicketCache(max_len=10, max_age_seconds=60, collection=lambda: self.collection)
+        self.assertEqual(c.get_many(['B-0010']), {'B-0010': self.ticket})
+        # Now it's local
+        self.assertEqual(c.get_many(['B-0010']), {'B-0010': self.ticket})
+        self.assertEqual(self.collection.find.call_count, 1)
+
+    def test_peek(self):
+        c = TicketCache(max_len=10, max_age_seconds=60, collection=lambda: self.collection)
+        self.assertEqual(c.peek('B-0010'), None)
+        c.local.set('B-0010', self.ticket)
+        self.assertEqual(c.peek('B-0010'), self.ticket)
+        self.assertFalse(self.collection.method_calls)
+        self.assertEqual((c.stats()['hits'], c.stats()['misses']), (1, 0))
+
+    def test_get_many(self):
+        other = dict(self.ticket, number='B-0011', idref='Story:11')
+        self.collection.find.return_value = [{'_id': 'B-0011', 'ticket': other}]
+        c = TicketCache(max_len=10, max_age_seconds=60, collection=lambda: self.collection)
+        c.local.set('B-0010', self.ticket)
+
+        self.assertEqual(c.get_many(['B-0010', 'B-0011', 'B-0012']), {'B-0010': self.ticket, 'B-0011': other})
+        query = self.collection.find.call_args[0][0]
+        self.assertEqual(query['_id'], {'$in': ['B-0011', 'B-0012']})
+        # Now it's local
+        self.assertEqual(c.peek('B-0011'), other)
+        self.assertEqual((c.stats()['hits'], c.stats()['misses']), (3, 1))
+
+
+class TestAssetCache(TestCase):
+    @patch('helga_versionone.cache.time')
+    def test_max_age_by_type(self, time):
+        time.time.return_value = 100
+        c = AssetCache(max_len=10, max_age_seconds=10, max_ages={'Member': 3600})
+        c[('Member', 1)] = 'member'
+        c[('Story', 2)] = 'story'
+        time.time.return_value = 200
+        self.assertEqual(c.get(('Member', 1)), 'member')
+        self.assertEqual(c.get(('Story', 2)), None)
+
+    def test_stats(self):
+        c = AssetCache(max_len=10, max_age_seconds=10)
+        c[('Member', 1)] = 'one'
+        c[('Member', 2)] = 'two'
+        c[('Story', 3)] = 'story'
+        self.assertEqual(c.stats()['by_type'], {'Member': 2, 'Story': 1})
+
+
+class TestResponseCache(TestCase):
+    def test_too_big(self):
+        c = ResponseCache(max_len=10, max_bytes=5)
+        c.set('small', ('etag', None, {}, 'body'))
+        c.set('big', 'httplib2 response')
+        self.assertEqual(c.get('small'), ('etag', None, {}, 'body'))
+        self.assertEqual(c.get('big'), None)
+
+    def test_too_big_replaces(self):
+        c = ResponseCache(max_len=10, max_bytes=5)
+        c.set('a', 'old')
+        c.set('a', 'new but big')
+        self.assertEqual(c.get('a'), None)
+
+    def test_delete(self):
+        c = ResponseCache(max_len=10, max_bytes=5)
+        c.set('a', 'body')
+        c.delete('a')
+        c.delete('not there')
+        self.assertEqual(c.get('a'), None)
@@ -1,9 +1,18 @@
-from mock import MagicMock, patch
+from mock import MagicMock, call, patch
 from pretend import stub
+from twisted.internet.defer import Deferred, DeferredList, fail
+from twisted.internet.task import Clock
+from urllib2 import HTTPError
+from urlparse import parse_qs
+from v1pysdk.client import V1Error
 
 import helga_versionone
+from helga_versionone import stats
+from helga_versionone.cache import TicketCache
+from helga_versionone.metadata import MetaSnapshot
+from helga_versionone.scheduler import QueueFull
 
-from .util import V1TestCase
+from .util import META_WORKITEM, PatchedTestCase, V1TestCase, fake_v1, settings_stub, writeable_settings_stub
 
 
 class TestCommands(V1TestCase):
@@ -20,8 +29,16 @@ class TestCommands(V1TestCase):
     def test_bad_command(self):
         return self._test_command('notreal', u'Umm... notreal, Never heard of it?')
 
+    @patch('helga_versionone.SCHEDULER')
+    def test_too_busy(self, scheduler):
+        scheduler.submit.return_value = fail(QueueFull('100 jobs already waiting'))
+        return self._test_command(
+            'alias',
+            u'Sorry {0}, I have too much to look up right now, try again in a minute'.format(self.nick),
+        )
+
     def test_get_workitem_found(self):
-        self.v1.Workitem.where().select().first.return_value = 'foo'
+        self.v1.Workitem.where().select().__iter__.return_value = iter(['foo'])
         f = helga_versionone.get_workitem(self.v1, 'B-00010')
         self.assertEquals(f, 'foo')
 
@@ -30,7 +47,7 @@ class TestCommands(V1TestCase):
         self.assertRaises(helga_versionone.QuitNow, helga_versionone.get_workitem, self.v1, 'B-00010')
 
     def test_get_user_found(self):
-        self.v1.Member.filter().select().first.return_value = 'foo'
+        self.v1.Member.filter().select().__iter__.return_value = iter(['foo'])
         u = helga_versionone.get_user(self.v1, self.nick)
         self.assertEquals(u, 'foo')
 
@@ -40,10 +57,32 @@ class TestCommands(V1TestCase):
 
     def test_get_user_with_no_alias(self):
         self.db.v1_user_map.find_one.side_effect = KeyError
-        self.v1.Member.filter().select().first.return_value = 'foo'
+        self.v1.Member.filter().select().__iter__.return_value = iter(['foo'])
         u = helga_versionone.get_user(self.v1, self.nick)
         self.assertEquals(u, 'foo')
 
+    def test_get_user_from_directory(self):
+        self.db.v1_user_map.find_one.return_value = None
+        self.v1.Member.filter().select.return_value = [
+            stub(intid='20', Name='Joe Bloggs', Nickname='joe', Username='jbloggs'),
+        ]
+        helga_versionone.MEMBERS.load()
+        self.v1.Member.filter.reset_mock()
+
+        with_data = self.v1.Member.return_value.with_data
+        for name in ['Joe Bloggs', 'JOE', 'jbloggs']:
+            u = helga_versionone.get_user(self.v1, name)
+            self.v1.Member.assert_called_with('20')
+            with_data.assert_called_with({'Name': 'Joe Bloggs', 'Nickname': 'joe'})
+            self.assertEquals(u, with_data.return_value)
+        self.assertFalse(self.v1.Member.filter.called)
+
+    def test_get_user_directory_miss(self):
+        self.db.v1_user_map.find_one.return_value = None
+        helga_versionone.MEMBERS.members = {'joe': {'intid': '20', 'Name': 'Joe Bloggs', 'Nickname': 'joe'}}
+        self.v1.Member.filter().select().__iter__.return_value = iter(['foo'])
+        self.assertEquals(helga_versionone.get_user(self.v1, self.nick), 'foo')
+
     @patch('helga_versionone.OAuth2Credentials')
     @patch('helga_versionone.USE_OAUTH')
     def _test_get_creds(self, name, mock_USE_OAUTH, mock_OAuth2Credentials, oauth_works=False, token_works=True):
@@ -95,10 +134,53 @@ class TestCommands(V1TestCase):
     def test_get_creds_fail_all(self):
         self._test_get_creds('fhqwhgads', oauth_works=False, token_works=False)
 
+    def test_get_creds_cached(self):
+        self.db.v1_oauth.find_one.return_value = {'api_token': 'mahtoken'}
+        self.assertEquals(helga_versionone.get_creds('somename'), 'mahtoken')
+        self.assertEquals(helga_versionone.get_creds('somename'), 'mahtoken')
+        self.assertEquals(self.db.v1_oauth.find_one.call_count, 1)
+
+    def test_get_creds_cached_none(self):
+        self.db.v1_oauth.find_one.return_value = None
+        self.assertEquals(helga_versionone.get_creds('somename|away'), None)
+        self.assertEquals(helga_versionone.get_creds('somename|away'), None)
+        self.assertEquals(self.db.v1_oauth.find_one.call_count, 2)
+
+    def test_forget_creds(self):
+        self.db.v1_oauth.find_one.return_value = None
+        helga_versionone.get_creds('somename|away')
+        helga_versionone.get_creds('othername')
+        helga_versionone.forget_creds('somename')
+        self.assertEquals(helga_versionone.CREDENTIALS.keys(), ['othername'])
+
+    def test_token_forgets_creds(self):
+        self.db.v1_oauth.find_one.return_value = None
+        helga_versionone.get_creds(self.nick)
+        d = self._test_command('token mahtoken')
+        d.addCallback(lambda _: self.assertEquals(helga_versionone.CREDENTIALS.keys(), []))
+        return d
+
     def test_find_all(self):
         numbers = helga_versionone.find_versionone_numbers('Tell me about B-0010')
         self.assertEquals(numbers, ['B-0010'])
 
+    def test_find_none(self):
+        self.assertEquals(helga_versionone.find_versionone_numbers('Nothing to see here'), [])
+        self.assertEquals(helga_versionone.find_versionone_numbers('re-do the thing'), [])
+
+    def test_find_normalised(self):
+        numbers = helga_versionone.find_versionone_numbers('b-0010, tk-3 and B-0010 again, not XB-4')
+        self.assertEquals(numbers, ['B-0010', 'TK-3'])
+
+    def test_find_extra_prefixes(self):
+        self.assertEquals(helga_versionone.find_versionone_numbers('What about ST-12?'), [])
+        self.settings.VERSIONONE_EXTRA_PREFIXES = ('st',)
+        try:
+            numbers = helga_versionone.find_versionone_numbers('What about ST-12?')
+        finally:
+            del self.settings.VERSIONONE_EXTRA_PREFIXES
+        self.assertEquals(numbers, ['ST-12'])
+
     def test_usage(self):
         res = self._test_command('')
         self.assertIn('Usage for versionone', res[0])
@@ -171,6 +253,7 @@ class TestCommands(V1TestCase):
             Name='Issue name',
             Number='B-0010',
             url='http://example.com',
+            idref='Story:10',
         )
         self.v1.Workitem.filter().select.return_value = [w]
 
@@ -201,6 +284,7 @@ class TestCommands(V1TestCase):
             Name='Issue name',
             Number='I-0010',
             url='http://example.com',
+            idref='Issue:10',
         )
         self.v1.Issue.filter().select.return_value = [w]
 
@@ -226,6 +310,362 @@ class TestCommands(V1TestCase):
         d.addCallback(check)
         return d
 
+    def test_versionone_full_descriptions_cached(self):
+        helga_versionone.TICKETS.set_many([{
+            'name': 'Cached name',
+            'number': 'B-0010',
+            'url': 'http://example.com',
+            'idref': 'Story:10',
+        }])
+
+        d = helga_versionone.versionone_full_descriptions(
+            self.v1,
+            self.client,
+            self.channel,
+            self.nick,
+            'Something about b-0010',
+            ['b-0010'],
+        )
+
+        def check(res):
+            self.assertFalse(self.v1.Workitem.filter.called)
+            self.client.msg.assert_called_once_with(
+                self.channel, '[B-0010] Cached name (http://example.com)')
+
+        d.addCallback(check)
+        return d
+
+    def test_commit_invalidates_ticket(self):
+        helga_versionone.TICKETS.set_many([{
+            'name': 'Cached name',
+            'number': 'B-0010',
+            'url': 'http://example.com',
+            'idref': 'Story:10',
+        }])
+        w = stub(idref='Story:10', _v1_asset_type_name='Story', _v1_oid=10)
+
+        with patch('helga_versionone.settings', writeable_settings_stub):
+            helga_versionone.commit_changes(self.v1, (w, 'Name', 'New name'))
+
+        self.assertEqual(helga_versionone.TICKETS.peek('B-0010'), None)
+
+
+class TestFullDescriptionsFanOut(V1TestCase):
+    blocking_call = patch('helga_versionone.blocking_call')
+    reactor = patch('helga_versionone.reactor', new_callable=Clock)
+
+    def setUp(self):
+        super(TestFullDescriptionsFanOut, self).setUp()
+        self.lookups = {}
+        self.blocking_call.side_effect = lambda fn, v1, kind, numbers: self.lookups.setdefault(kind, Deferred())
+
+    def ticket(self, number):
+        return {'name': 'name', 'number': number, 'url': 'url', 'idref': number}
+
+    def describe(self, *matches):
+        return helga_versionone.versionone_full_descriptions(
+            self.v1, self.client, self.channel, self.nick, 'message', list(matches))
+
+    def test_mention_order(self):
+        d = self.describe('I-1', 'B-2', 'R-3')
+        self.assertEqual(sorted(self.lookups), ['Issue', 'Request', 'Workitem'])
+        # Answers in any order
+        self.lookups['Workitem'].callback([self.ticket('B-2')])
+        self.lookups['Request'].callback([self.ticket('R-3')])
+        self.lookups['Issue'].callback([self.ticket('I-1')])
+
+        d.addCallback(lambda _: self.client.msg.assert_called_once_with(
+            self.channel, '[I-1] name (url)\n[B-2] name (url)\n[R-3] name (url)'))
+        return d
+
+    def test_batches(self):
+        self.settings.VERSIONONE_QUERY_BATCH_SIZE = 2
+        try:
+            d = self.describe('B-1', 'B-2', 'B-3', 'b-1')
+        finally:
+            del self.settings.VERSIONONE_QUERY_BATCH_SIZE
+        self.assertEqual(
+            [c[0][3] for c in self.blocking_call.call_args_list],
+            [['B-1', 'B-2'], ['B-3']],
+        )
+        self.lookups['Workitem'].callback([self.ticket('B-1'), self.ticket('B-2'), self.ticket('B-3')])
+        return d
+
+    def test_coalesced(self):
+        d = self.describe('B-1', 'B-2')
+        d2 = self.describe('b-2', 'B-1')
+        self.assertEqual(self.blocking_call.call_count, 1)
+        self.lookups['Workitem'].callback([self.ticket('B-1'), self.ticket('B-2')])
+        return DeferredList([d, d2])
+
+    def test_timeout(self):
+        d = self.describe('I-1', 'B-2')
+        self.lookups['Workitem'].callback([self.ticket('B-2')])
+        self.reactor.advance(10)
+
+        d.addCallback(lambda _: self.client.msg.assert_called_once_with(
+            self.channel, '[I-1] timed out\n[B-2] name (url)'))
+        return d
+
+    def test_some_failed(self):
+        d = self.describe('I-1', 'B-2')
+        self.lookups['Workitem'].callback([self.ticket('B-2')])
+        self.lookups['Issue'].errback(ValueError('nope'))
+
+        d.addCallback(lambda _: self.client.msg.assert_called_once_with(
+            self.channel, '[B-2] name (url)'))
+        return d
+
+    @patch('helga_versionone.TICKETS')
+    def test_no_mongo_on_reactor(self, tickets):
+        tickets.peek.return_value = None
+        d = self.describe('B-1', 'B-2')
+        self.lookups['Workitem'].callback([self.ticket('B-1'), self.ticket('B-2')])
+
+        def check(res):
+            # Only the in process cache, _describe does the rest in blocking_call
+            self.assertEqual([c[0] for c in tickets.method_calls], ['peek', 'peek'])
+
+        return d.addCallback(check)
+
+    def test_all_failed(self):
+        d = self.describe('B-2')
+        self.lookups['Workitem'].errback(HTTPError('url', 401, 'no', {}, None))
+
+        d.addCallback(lambda _: self.client.msg.assert_called_once_with(
+            self.channel, u'{0}, You probably need to reset your token, try "!v1 token"'.format(self.nick)))
+        return d
+
+    def test_all_failed_some_cached(self):
+        helga_versionone.TICKETS.set_many([self.ticket('B-1')])
+        d = self.describe('B-1', 'B-2')
+        self.lookups['Workitem'].errback(HTTPError('url', 401, 'no', {}, None))
+
+        d.addCallback(lambda _: self.assertEqual(self.client.msg.call_args_list, [
+            call(self.channel, '[B-1] name (url)'),
+            call(self.channel, u'{0}, You probably need to reset your token, try "!v1 token"'.format(self.nick)),
+        ]))
+        return d
+
+
+class TestDescribe(V1TestCase):
+    def test_mongo_cached_not_asked_for(self):
+        collection = MagicMock()
+        cached = {'name': 'Cached', 'number': 'D-01', 'url': 'url', 'idref': 'Defect:1'}
+        collection.find.return_value = [{'_id': 'D-01', 'ticket': cached}]
+        v1 = fake_v1({
+            '/meta.v1/Defect': META_WORKITEM,
+            '/rest-1.v1/Data/Defect': '<Assets><Asset id="Defect:2">'
+                                      '<Attribute name="Name">Fetched</Attribute>'
+                                      '<Attribute name="Number">D-02</Attribute>'
+                                      '</Asset></Assets>',
+        })
+        v1.asset_class('Defect')
+
+        with patch('helga_versionone.TICKETS', TicketCache(10, 60, collection=lambda: collection)):
+            tickets = helga_versionone._describe(v1, 'Defect', ['D-01', 'd-02'])
+
+        self.assertEqual([t['name'] for t in tickets], ['Cached', 'Fetched'])
+        path, query = v1.server.requests[-1]
+        self.assertEqual(parse_qs(query)['where'], ["Number='d-02'"])
+        self.assertEqual([w._filter for w in collection.bulk_write.call_args[0][0]], [{'_id': 'D-02'}])
+
+
+class TestSendResponse(V1TestCase):
+    reactor = patch('helga_versionone.reactor', new_callable=Clock)
+
+    def test_short(self):
+        helga_versionone.send_response(self.client, self.channel, 'one\ntwo')
+        self.client.msg.assert_called_once_with(self.channel, 'one\ntwo')
+
+    def test_long(self):
+        lines = [str(i) for i in range(12)]
+        helga_versionone.send_response(self.client, self.channel, '\n'.join(lines))
+        self.client.msg.assert_called_once_with(self.channel, '\n'.join(lines[:5]))
+        self.reactor.advance(1)
+        self.client.msg.assert_called_with(self.channel, '\n'.join(lines[5:10]))
+        self.reactor.advance(1)
+        self.client.msg.assert_called_with(self.channel, '\n'.join(lines[10:]))
+        self.assertEqual(self.client.msg.call_count, 3)
+
+
+class TestBatches(V1TestCase):
+    def test_filter_length(self):
+        numbers = ['B-{0:05d}'.format(i) for i in range(300)]
+        batches = list(helga_versionone._batches(numbers))
+        self.assertEqual(sum(batches, []), numbers)
+        for batch in batches:
+            self.assertLessEqual(len(batch), 50)
+            self.assertLessEqual(
+                len('|'.join("Number='{0}'".format(n) for n in batch)),
+                helga_versionone.MAX_FILTER_LENGTH,
+            )
+
+
+class TestWriteBatching(V1TestCase):
+    def asset(self, idref):
+        asset_type, oid = idref.split(':')
+        return MagicMock(idref=idref, _v1_asset_type_name=asset_type, _v1_oid=oid)
+
+    def test_flush_coalesces(self):
+        story, task = self.asset('Story:1'), self.asset('Task:2')
+        one, two = stub(idref='Member:1'), stub(idref='Member:2')
+
+        outcomes = helga_versionone._flush_writes([
+            (self.v1, ((story, 'Owners', [one]),)),
+            (self.v1, ((story, 'Owners', [two]), (task, 'Name', 'first'))),
+            (self.v1, ((task, 'Name', 'second'),)),
+        ])
+
+        self.assertEqual(outcomes, [None, None, None])
+        self.assertEqual(self.v1.update_asset.call_args_list, [
+            call('Story', '1', {'Owners': [one, two]}),
+            call('Task', '2', {'Name': 'second'}),
+        ])
+
+    def test_flush_by_connection(self):
+        story = self.asset('Story:1')
+        other = MagicMock()
+
+        helga_versionone._flush_writes([
+            (self.v1, ((story, 'Name', 'mine'),)),
+            (other, ((story, 'Name', 'theirs'),)),
+        ])
+
+        self.v1.update_asset.assert_called_once_with('Story', '1', {'Name': 'mine'})
+        other.update_asset.assert_called_once_with('Story', '1', {'Name': 'theirs'})
+
+    def test_flush_error_isolated(self):
+        story, task = self.asset('Story:1'), self.asset('Task:2')
+        error = V1Error('Bad Request')
+
+        def update_asset(asset_type, oid, data):
+            if oid == '1':
+                raise error
+        self.v1.update_asset.side_effect = update_asset
+
+        outcomes = helga_versionone._flush_writes([
+            (self.v1, ((story, 'Name', 'one'),)),
+            (self.v1, ((task, 'Name', 'two'),)),
+        ])
+
+        self.assertEqual(outcomes, [error, None])
+
+    @patch('helga_versionone.workers.current_pool')
+    @patch('helga_versionone.WRITES')
+    def test_batched_error(self, writes, current_pool):
+        current_pool.return_value = 'commands'
+        writes.submit.side_effect = V1Error('Bad Request')
+
+        with patch('helga_versionone.settings', stub(VERSIONONE_READONLY=False, VERSIONONE_WRITE_BATCH_WINDOW=0.1)):
+            with self.assertRaises(helga_versionone.QuitNow) as raised:
+                helga_versionone.commit_changes(self.v1, (self.asset('Story:10'), 'Name', 'New name'))
+
+        self.assertEqual(raised.exception.message, 'Sorry {nick}, writing that to VersionOne failed')
+
+    @patch('helga_versionone.workers.current_pool')
+    @patch('helga_versionone.WRITES')
+    def test_commit_batched(self, writes, current_pool):
+        current_pool.return_value = 'commands'
+        w = stub(idref='Story:10')
+
+        with patch('helga_versionone.settings', stub(VERSIONONE_READONLY=False, VERSIONONE_WRITE_BATCH_WINDOW=0.1)):
+            helga_versionone.commit_changes(self.v1, (w, 'Name', 'New name'))
+
+        writes.submit.assert_called_once_with((self.v1, ((w, 'Name', 'New name'),)), 0.1)
+        self.assertFalse(self.v1.commit.called)
+
+    @patch('helga_versionone.workers.current_pool')
+    @patch('helga_versionone.WRITES')
+    def test_batched_still_readonly(self, writes, current_pool):
+        current_pool.return_value = 'commands'
+
+        with patch('helga_versionone.settings', stub(VERSIONONE_READONLY=True, VERSIONONE_WRITE_BATCH_WINDOW=0.1)):
+            self.assertEqual(
+                helga_versionone.commit_changes(self.v1, (stub(idref='Story:10'), 'Name', 'New name')),
+                'I would, but I\'m not allowed to write :(',
+            )
+
+        self.assertFalse(writes.submit.called)
+
+
+class TestStatsCommand(V1TestCase):
+    def setUp(self):
+        super(TestStatsCommand, self).setUp()
+        stats.registry.clear()
+
+    def test_command_timed(self):
+        self.db.v1_user_map.find_one.return_value = {'v1_nick': 'nickname'}
+        d = self._test_command('alias')
+
+        def check(res):
+            self.assertEqual(stats.snapshot()['timers']['command.alias_command']['count'], 1)
+
+        return d.addCallback(check)
+
+    def test_stats_prefix(self):
+        stats.registry.timing('v1.get', 10.0)
+        stats.registry.timing('mongo.v1_oauth', 1.0)
+        stats.registry.incr('v1.get.errors')
+        d = self._test_command('stats v1')
+
+        def check(res):
+            self.client.msg.assert_called_once_with(
+                self.nick,
+                'v1.get: count=1 max=10.0 p50=10.0 p95=10.0 p99=10.0\n'
+                'counters: v1.get.errors=1',
+            )
+
+        return d.addCallback(check)
+
+    def test_stats_nothing(self):
+        return self._test_command('stats nope', 'No stats for nope yet', to_nick=True)
+
+    @patch('helga_versionone.reactor', new_callable=Clock)
+    def test_stats_all(self, clock):
+        self._test_command('stats')
+        # Long, so some lines are sent later
+        clock.advance(10)
+        lines = '\n'.join(call[0][1] for call in self.client.msg.call_args_list).split('\n')
+        self.assertIn('writes: batches=0 items=0 waiting=0', lines)
+        self.assertTrue(any(line.startswith('scheduler: channels=0 queued=0 rejected=0 ') for line in lines))
+        self.assertIn('cache channels: evictions=0 hits=0 max_len=200 misses=0 size=0', lines)
+        self.assertTrue(any(line.startswith('cache tickets: ') for line in lines))
+
+
+class TestRefreshMetadata(V1TestCase):
+    META_TYPES = patch('helga_versionone.META_TYPES', ('Workitem',))
+    METADATA = patch('helga_versionone.METADATA', new_callable=lambda: MetaSnapshot(settings_stub.VERSIONONE_URL))
+
+    def setUp(self):
+        super(TestRefreshMetadata, self).setUp()
+        self.v1 = fake_v1({
+            '/meta.v1/Workitem': '<AssetType name="Workitem"/>',
+            '/meta.v1/Member': '<AssetType name="Member"/>',
+        })
+        self.get_system_v1.return_value = self.v1
+
+    def test_fetches_known_and_default(self):
+        self.METADATA.set('Member', 'stale')
+        self.METADATA.save = MagicMock()
+        helga_versionone.refresh_metadata()
+
+        self.assertEqual(self.METADATA.get('Member'), '<AssetType name="Member" />')
+        self.assertEqual(self.METADATA.get('Workitem'), '<AssetType name="Workitem" />')
+        self.METADATA.save.assert_called_once_with()
+
+    def test_type_missing(self):
+        def not_exposed(query):
+            raise V1Error('Unknown AssetType: Issue')
+        self.v1.server.responses['/meta.v1/Issue'] = not_exposed
+        self.METADATA.save = MagicMock()
+
+        with patch('helga_versionone.META_TYPES', ('Issue', 'Workitem')):
+            helga_versionone.refresh_metadata()
+
+        self.assertEqual(self.METADATA.names(), ['Workitem'])
+        self.METADATA.save.assert_called_once_with()
+
 
 class TestUserCommand(V1TestCase):
     get_user = patch('helga_versionone.get_user', return_value=stub(
@@ -257,3 +697,81 @@ class TestUserCommand(V1TestCase):
 
         d.addCallback(check)
         return d
+
+
+class TestGetV1(PatchedTestCase):
+    db = patch('helga_versionone.db')
+    settings = patch('helga_versionone.settings', settings_stub)
+    V1Meta = patch('helga_versionone.V1Meta')
+    get_creds = patch('helga_versionone.get_creds')
+
+    def setUp(self):
+        super(TestGetV1, self).setUp()
+        helga_versionone.clear_caches()
+        self.V1Meta.side_effect = lambda **kw: MagicMock()
+
+    def test_token_reused(self):
+        self.get_creds.return_value = 'mahtoken'
+        v1 = helga_versionone.get_v1('me')
+        self.assertIs(helga_versionone.get_v1('me'), v1)
+        self.V1Meta.assert_called_once_with(
+            instance_url=settings_stub.VERSIONONE_URL,
+            password='mahtoken',
+            use_password_as_token=True,
+        )
+
+    def test_tokens_differ(self):
+        self.get_creds.side_effect = ['mahtoken', 'yourtoken']
+        v1 = helga_versionone.get_v1('me')
+        v1_2 = helga_versionone.get_v1('you')
+        self.assertIsNot(v1, v1_2)
+        # But they share assets
+        self.assertIs(v1.global_cache, helga_versionone.ASSETS)
+        self.assertIs(v1_2.global_cache, helga_versionone.ASSETS)
+
+    def test_response_cache(self):
+        self.get_creds.return_value = 'mahtoken'
+        v1 = helga_versionone.get_v1('me')
+        v1.server.use_response_cache.assert_called_once_with(helga_versionone.RESPONSES)
+
+    def test_meta_snapshot(self):
+        self.get_creds.return_value = 'mahtoken'
+        v1 = helga_versionone.get_v1('me')
+        v1.server.use_meta_snapshot.assert_called_once_with(helga_versionone.METADATA)
+
+    def test_service_user(self):
+        self.get_creds.return_value = None
+        v1 = helga_versionone.get_v1('me')
+        self.assertIs(helga_versionone.get_v1('you'), v1)
+        self.V1Meta.assert_called_once_with(
+            instance_url=settings_stub.VERSIONONE_URL,
+            username='username',
+            password='password',
+        )
+
+    def test_oauth_by_refresh_token(self):
+        self.get_creds.side_effect = [
+            stub(refresh_token='one'),
+            stub(refresh_token='one'),
+            stub(refresh_token='two'),
+        ]
+        v1 = helga_versionone.get_v1('me')
+        self.assertIs(helga_versionone.get_v1('me'), v1)
+        self.assertIsNot(helga_versionone.get_v1('you'), v1)
+        self.assertEqual(self.V1Meta.call_count, 2)
+
+    def test_system_v1(self):
+        # Same as the service user with no shared token
+        self.get_creds.return_value = None
+        v1 = helga_versionone.get_system_v1()
+        self.assertFalse(self.get_creds.called)
+        self.assertIs(helga_versionone.get_v1('me'), v1)
+
+    def test_shared_token(self):
+        self.settings.VERSIONONE_SHARED_TOKEN = 'shared'
+        try:
+            v1 = helga_versionone.get_v1('me', use_shared_token=True)
+            self.assertIs(helga_versionone.get_v1('you', use_shared_token=True), v1)
+            self.assertFalse(self.get_creds.called)
+        finally:
+            del self.settings.VERSIONONE_SHARED_TOKEN
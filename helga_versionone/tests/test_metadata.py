@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from unittest import TestCase
+
+from helga_versionone.metadata import FORMAT_VERSION, MetaSnapshot
+
+
+URL = 'http://example.com/EnvKey'
+
+
+class TestMetaSnapshot(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'meta.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_set(self):
+        s = MetaSnapshot(URL)
+        self.assertTrue(s.set('Story', '<AssetType/>'))
+        self.assertFalse(s.set('Story', '<AssetType/>'))
+        self.assertEqual(s.get('Story'), '<AssetType/>')
+        self.assertEqual(s.get('Defect'), None)
+        self.assertEqual(s.revision, 1)
+
+    def test_refresh(self):
+        s = MetaSnapshot(URL)
+        s.set('Story', 'old')
+        s.set('Team', 'same')
+        fetched = {'Story': 'new', 'Team': 'same', 'Member': 'member'}
+        self.assertEqual(s.refresh(fetched.get, names=['Member']), ['Member', 'Story'])
+        self.assertEqual(s.names(), ['Member', 'Story', 'Team'])
+
+    def test_refresh_skips_failures(self):
+        s = MetaSnapshot(URL)
+        s.set('Issue', 'old')
+
+        def fetch(name):
+            if name == 'Issue':
+                raise ValueError('not here')
+            return name.lower()
+
+        self.assertEqual(s.refresh(fetch, names=['Story']), ['Story'])
+        self.assertEqual(s.get('Issue'), 'old')
+
+    def test_round_trip(self):
+        s = MetaSnapshot(URL, self.path)
+        s.set('Story', '<AssetType name="Story"/>')
+        self.assertTrue(s.save())
+        # Nothing new to save
+        self.assertFalse(s.save())
+
+        loaded = MetaSnapshot(URL, self.path)
+        self.assertTrue(loaded.load())
+        self.assertEqual(loaded.get('Story'), '<AssetType name="Story"/>')
+        self.assertEqual(loaded.revision, 1)
+        self.assertFalse(loaded.dirty)
+        self.assertEqual(os.listdir(self.dir), ['meta.json'])
+
+    def test_no_path(self):
+        s = MetaSnapshot(URL)
+        s.set('Story', 'xml')
+        self.assertFalse(s.save())
+        self.assertFalse(s.load())
+
+    def test_missing_file(self):
+        self.assertFalse(MetaSnapshot(URL, self.path).load())
+
+    def test_bad_file(self):
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        self.assertFalse(MetaSnapshot(URL, self.path).load())
+
+    def _write(self, **data):
+        snapshot = {'version': FORMAT_VERSION, 'instance_url': URL, 'types': {'Story': 'xml'}}
+        snapshot.update(data)
+        with open(self.path, 'w') as f:
+            json.dump(snapshot, f)
+
+    def test_other_version(self):
+        self._write(version=FORMAT_VERSION - 1)
+        s = MetaSnapshot(URL, self.path)
+        self.assertFalse(s.load())
+        self.assertEqual(s.names(), [])
+
+    def test_other_instance(self):
+        self._write(instance_url='http://elsewhere.com/EnvKey')
+        self.assertFalse(MetaSnapshot(URL, self.path).load())
+
+    def test_save_fails(self):
+        s = MetaSnapshot(URL, os.path.join(self.dir, 'not', 'there.json'))
+        s.set('Story', 'xml')
+        self.assertFalse(s.save())
+        # Try again next time
+        self.assertTrue(s.dirty)
+
+    @patch('helga_versionone.metadata.time')
+    def test_stats(self, time):
+        time.time.return_value = 100
+        s = MetaSnapshot(URL, self.path)
+        self.assertEqual(s.stats(), {'types': 0, 'revision': 0, 'age': None})
+        s.set('Story', 'xml')
+        s.save()
+        time.time.return_value = 130
+        self.assertEqual(s.stats(), {'types': 1, 'revision': 1, 'age': 30})
@@ -1,7 +1,10 @@
 from mock import call, patch
 from pretend import stub
 
-from oauth2client.client import FlowExchangeError
+from oauth2client.client import AccessTokenRefreshError, FlowExchangeError
+from pymongo import UpdateOne
+
+import helga_versionone
 
 from .util import V1TestCase
 
@@ -67,3 +70,70 @@ class TestOauthCommand(V1TestCase):
 
         d.addCallback(check)
         return d
+
+
+class TestRefreshOauthTokens(V1TestCase):
+    USE_OAUTH = patch('helga_versionone.USE_OAUTH', True)
+    OAuth2Credentials = patch('helga_versionone.OAuth2Credentials')
+    _connect = patch('helga_versionone._connect')
+
+    def setUp(self):
+        super(TestRefreshOauthTokens, self).setUp()
+        self.auth_info = {
+            '_id': 1,
+            'irc_nick': self.nick,
+            'access_token': 'old token',
+            'refresh_token': 'a refresh token',
+            'token_expiry': 'in a minute',
+        }
+        self.db.v1_oauth.find.return_value = [self.auth_info]
+        self.creds = self.OAuth2Credentials.return_value
+
+        def refresh(http):
+            self.creds.access_token = 'new token'
+            self.creds.refresh_token = 'another refresh token'
+            self.creds.token_expiry = 'in an hour'
+        self.creds.refresh.side_effect = refresh
+
+    def test_refreshed(self):
+        helga_versionone.refresh_oauth_tokens()
+
+        self.db.v1_oauth.bulk_write.assert_called_once_with([
+            UpdateOne({'_id': 1}, {'$set': {
+                'access_token': 'new token',
+                'refresh_token': 'another refresh token',
+                'token_expiry': 'in an hour',
+            }}),
+        ], ordered=False)
+
+    def test_warm(self):
+        helga_versionone.CREDENTIALS.set(self.nick, 'stale')
+        helga_versionone.refresh_oauth_tokens()
+
+        self.assertIs(helga_versionone.get_creds(self.nick), self.creds)
+        self.assertFalse(self.db.v1_oauth.find_one.called)
+        self._connect.assert_called_once_with(self.creds)
+        self.assertIs(
+            helga_versionone.CONNECTIONS.get(('oauth', 'another refresh token')), self._connect.return_value)
+
+    def test_only_expiring(self):
+        helga_versionone.refresh_oauth_tokens()
+        query = self.db.v1_oauth.find.call_args[0][0]
+        self.assertEqual(query['api_token'], {'$exists': False})
+        self.assertIn('$lt', query['token_expiry'])
+
+    def test_refresh_fails(self):
+        self.creds.refresh.side_effect = AccessTokenRefreshError('revoked')
+        helga_versionone.refresh_oauth_tokens()
+        self.assertFalse(self.db.v1_oauth.bulk_write.called)
+        self.assertFalse(self._connect.called)
+
+    def test_disabled(self):
+        with patch('helga_versionone.USE_OAUTH', False):
+            helga_versionone.refresh_oauth_tokens()
+        self.assertFalse(self.db.v1_oauth.find.called)
+
+    def test_signon_starts(self):
+        with patch('helga_versionone.start_loop') as start_loop:
+            helga_versionone.start_background_tasks(self.client)
+        start_loop.assert_any_call('oauth', 300, helga_versionone.refresh_oauth_tokens)
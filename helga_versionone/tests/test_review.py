@@ -51,13 +51,10 @@ class TestReviewCommandWithWrite(ReviewMixin, V1TestCase):
         )
 
         def check(res):
-            # Check v1 attr, and commit called
-            self.assertEquals(
-                # self.v1.[w].[cr_field]
-                getattr(w, self.cr_field),
-                ' '.join([self.link, self.new_link]),
+            # Written through this v1
+            self.v1.update_asset.assert_called_once_with(
+                w._v1_asset_type_name, w._v1_oid, {self.cr_field: ' '.join([self.link, self.new_link])},
             )
-            self.v1.commit.assert_called_once_with()
             self.assertAck()
 
         d.addCallback(check)
@@ -70,13 +67,10 @@ class TestReviewCommandWithWrite(ReviewMixin, V1TestCase):
         )
 
         def check(res):
-            # Check v1 attr, and commit called
-            self.assertEquals(
-                # self.v1.[w].[cr_field]
-                getattr(w, self.cr_field),
-                self.new_link,
+            # Written through this v1
+            self.v1.update_asset.assert_called_once_with(
+                w._v1_asset_type_name, w._v1_oid, {self.cr_field: self.new_link},
             )
-            self.v1.commit.assert_called_once_with()
             self.assertAck()
 
         d.addCallback(check)
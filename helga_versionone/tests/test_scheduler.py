@@ -0,0 +1,123 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from unittest import TestCase
+
+from helga_versionone import stats
+from helga_versionone.scheduler import FairScheduler, QueueFull, TokenBucket
+
+
+class TestTokenBucket(TestCase):
+    def test_burst_then_rate(self):
+        b = TokenBucket(2, 3, 0)
+        for _ in range(3):
+            self.assertEqual(b.wait(0), 0)
+            b.take(0)
+        self.assertEqual(b.wait(0), 0.5)
+        self.assertEqual(b.wait(0.5), 0)
+        self.assertFalse(b.full(0.5))
+        self.assertTrue(b.full(10))
+
+
+class TestFairScheduler(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.ran = []
+        self.pending = {}
+        stats.registry.clear()
+
+    def job(self, name):
+        """Record that name ran, finished when self.pending[name] fires"""
+        self.ran.append(name)
+        d = self.pending[name] = Deferred()
+        return d
+
+    def scheduler(self, **kwargs):
+        kwargs.setdefault('concurrency', 1)
+        kwargs.setdefault('max_queued', 10)
+        return FairScheduler(clock=self.clock, **kwargs)
+
+    def test_runs_now(self):
+        s = self.scheduler()
+        results = []
+        s.submit('#a', 'joe', lambda x: x * 2, 21).addCallback(results.append)
+        self.assertEqual(results, [42])
+        self.assertEqual(s.stats(), {'queued': 0, 'running': 0, 'started': 1, 'rejected': 0, 'channels': 0})
+        self.assertEqual(stats.snapshot()['timers']['scheduler.wait']['max'], 0)
+
+    def test_errors_passed_on(self):
+        s = self.scheduler()
+        errors = []
+        s.submit('#a', 'joe', lambda: 1 / 0).addErrback(errors.append)
+        self.assertTrue(errors[0].check(ZeroDivisionError))
+        self.assertEqual(s.running, 0)
+
+    def test_concurrency(self):
+        s = self.scheduler(concurrency=2)
+        for name in 'abc':
+            s.submit('#a', 'joe', self.job, name)
+        self.assertEqual(self.ran, ['a', 'b'])
+        self.assertEqual(s.stats()['queued'], 1)
+
+        self.pending['b'].callback(None)
+        self.assertEqual(self.ran, ['a', 'b', 'c'])
+        self.assertEqual(s.stats()['running'], 2)
+
+    def test_channels_take_turns(self):
+        s = self.scheduler()
+        s.submit('#a', 'joe', self.job, 'first')
+        for name in ('a1', 'a2', 'a3'):
+            s.submit('#a', 'joe', self.job, name)
+        s.submit('#b', 'bob', self.job, 'b1')
+        s.submit('#b', 'bob', self.job, 'b2')
+
+        for name in ('first', 'a1', 'b1', 'a2', 'b2'):
+            self.pending[name].callback(None)
+        self.assertEqual(self.ran, ['first', 'a1', 'b1', 'a2', 'b2', 'a3'])
+
+    def test_nick_rate(self):
+        s = self.scheduler(concurrency=5, nick_rate=1, nick_burst=2)
+        for name in ('a', 'b', 'c'):
+            s.submit('#a', 'joe', self.job, name)
+        s.submit('#a', 'bob', self.job, 'bob')
+        # bob has his own bucket, joe waits for another token
+        self.assertEqual(self.ran, ['a', 'b', 'bob'])
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.ran, ['a', 'b', 'bob'])
+        self.clock.advance(0.5)
+        self.assertEqual(self.ran, ['a', 'b', 'bob', 'c'])
+        self.assertEqual(stats.snapshot()['timers']['scheduler.wait']['max'], 1000)
+
+    def test_channel_rate(self):
+        s = self.scheduler(concurrency=5, channel_rate=0.5, channel_burst=1)
+        s.submit('#a', 'joe', self.job, 'a1')
+        s.submit('#a', 'bob', self.job, 'a2')
+        s.submit('#b', 'joe', self.job, 'b1')
+        self.assertEqual(self.ran, ['a1', 'b1'])
+        self.clock.advance(2)
+        self.assertEqual(self.ran, ['a1', 'b1', 'a2'])
+
+    def test_background_not_limited(self):
+        s = self.scheduler(concurrency=5, nick_rate=1, nick_burst=1, channel_rate=1, channel_burst=1)
+        for name in 'abc':
+            s.submit(None, None, self.job, name)
+        self.assertEqual(self.ran, ['a', 'b', 'c'])
+
+    def test_queue_full(self):
+        s = self.scheduler(max_queued=1)
+        s.submit('#a', 'joe', self.job, 'a')
+        s.submit('#a', 'joe', self.job, 'b')
+        errors = []
+        s.submit('#b', 'bob', self.job, 'c').addErrback(errors.append)
+
+        self.assertTrue(errors[0].check(QueueFull))
+        self.assertEqual(self.ran, ['a'])
+        self.assertEqual(s.stats()['rejected'], 1)
+        self.assertEqual(stats.snapshot()['counters']['scheduler.rejected'], 1)
+
+    def test_clear(self):
+        s = self.scheduler(nick_rate=1, nick_burst=1)
+        s.submit('#a', 'joe', lambda: None)
+        self.assertEqual(len(s.buckets), 1)
+        s.clear()
+        self.assertEqual(s.buckets, {})
@@ -0,0 +1,94 @@
+from mock import MagicMock, patch
+from twisted.internet.defer import Deferred
+from unittest import TestCase
+
+from helga_versionone import stats
+
+
+class TestHistogram(TestCase):
+    def test_empty(self):
+        self.assertEqual(stats.Histogram().summary(), {'count': 0, 'p50': 0, 'p95': 0, 'p99': 0, 'max': 0})
+
+    def test_percentiles(self):
+        h = stats.Histogram()
+        for v in range(100, 0, -1):
+            h.add(v)
+        self.assertEqual(h.summary(), {'count': 100, 'p50': 50, 'p95': 95, 'p99': 99, 'max': 100})
+
+    def test_recent_only(self):
+        h = stats.Histogram(size=10)
+        for v in range(100):
+            h.add(v)
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.percentile(50), 94)
+
+
+class TestRegistry(TestCase):
+    def setUp(self):
+        self.sink = MagicMock()
+        self.registry = stats.Registry(self.sink)
+
+    def test_timer(self):
+        with self.registry.timer('thing'):
+            pass
+        self.assertEqual(self.registry.snapshot()['timers']['thing']['count'], 1)
+        self.assertEqual(self.sink.timing.call_args[0][0], 'thing')
+
+    def test_timer_error(self):
+        def fail():
+            with self.registry.timer('thing'):
+                raise ValueError('boom')
+
+        self.assertRaises(ValueError, fail)
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot['timers']['thing']['count'], 1)
+        self.assertEqual(snapshot['counters'], {'thing.errors': 1})
+        self.sink.incr.assert_called_once_with('thing.errors', 1)
+
+    def test_time_result_deferred(self):
+        d = Deferred()
+        self.registry.time_result('thing', d, 0)
+        self.assertEqual(self.registry.snapshot()['timers'], {})
+        d.callback('ok')
+        self.assertEqual(self.registry.snapshot()['timers']['thing']['count'], 1)
+
+    def test_time_result_failed(self):
+        d = Deferred()
+        self.registry.time_result('thing', d, 0).addErrback(lambda failure: None)
+        d.errback(ValueError('boom'))
+        self.assertEqual(self.registry.snapshot()['counters'], {'thing.errors': 1})
+
+    def test_clear(self):
+        self.registry.incr('thing')
+        self.registry.clear()
+        self.assertEqual(self.registry.snapshot(), {'timers': {}, 'counters': {}})
+
+
+class TestSinks(TestCase):
+    def test_make_sink(self):
+        self.assertEqual(stats.make_sink(None), None)
+        self.assertEqual(stats.make_sink('memory'), None)
+        self.assertIsInstance(stats.make_sink('log'), stats.LogSink)
+        sink = stats.make_sink('statsd://stats.example.com:9125')
+        self.assertEqual(sink.address, ('stats.example.com', 9125))
+        self.assertRaises(ValueError, stats.make_sink, 'carrier-pigeon')
+
+    def test_log(self):
+        log = MagicMock()
+        sink = stats.LogSink(log)
+        sink.timing('thing', 12.34)
+        log.info.assert_called_once_with('stat thing 12.3ms')
+
+    @patch('helga_versionone.stats.socket.socket')
+    def test_statsd(self, socket):
+        sink = stats.StatsdSink('stats.example.com', 9125)
+        sink.timing('thing', 12.5)
+        sink.incr('thing.errors', 1)
+        socket().sendto.assert_any_call('helga.versionone.thing:12.500|ms', ('stats.example.com', 9125))
+        socket().sendto.assert_any_call('helga.versionone.thing.errors:1|c', ('stats.example.com', 9125))
+
+    @patch('helga_versionone.stats.socket.socket')
+    def test_statsd_send_fails(self, socket):
+        socket().sendto.side_effect = stats.socket.error('nope')
+        # Doesn't raise
+        stats.StatsdSink().incr('thing', 1)
@@ -0,0 +1,227 @@
+from copy import copy
+import time
+from urlparse import parse_qs
+
+from mock import patch
+from twisted.internet.task import Clock
+
+import helga_versionone
+from helga_versionone.scheduler import FairScheduler
+
+from .util import META_NAMED, META_WORKITEM, V1TestCase, fake_v1, settings_stub
+
+
+class TestStatusCommand(V1TestCase):
+    def setUp(self):
+        super(TestStatusCommand, self).setUp()
+        self.v1 = fake_v1({
+            '/meta.v1/Workitem': META_WORKITEM,
+            '/meta.v1/Defect': META_WORKITEM,
+            '/meta.v1/StoryStatus': META_NAMED,
+            '/meta.v1/Member': META_NAMED,
+            '/rest-1.v1/Data/Workitem': WORKITEMS,
+        })
+        for name in ('Workitem', 'Defect', 'StoryStatus', 'Member'):
+            self.v1.asset_class(name)
+        del self.v1.server.requests[:]
+        self.db.v1_channel_settings.find_one.return_value = {
+            'name': self.channel, 'teams': {'Blue': 'link', 'Red': 'link'},
+        }
+
+    def test_digest(self):
+        d = self._test_command('status', '\n'.join([
+            'Blue, Red: 3 open, 8.5 points',
+            'In Progress: 2 (8.5 pts) Ann 2, Joe 1',
+            'No status: 1 (0 pts) nobody 1',
+        ]))
+
+        def check(res):
+            path, query = self.v1.server.requests[0]
+            self.assertEqual(path, '/rest-1.v1/Data/Workitem')
+            self.assertEqual(parse_qs(query), {
+                'where': ["Team.Name='Blue','Red';AssetState='64'"],
+                'sel': ['Number,Status,Status.Name,Status.Order,Owners,Owners.Name,Estimate'],
+                'sort': ['Status.Order,Number'],
+                'page': ['100,0'],
+            })
+
+        d.addCallback(check)
+        return d
+
+    def test_cached(self):
+        d = self._test_command('status')
+        d.addCallback(lambda _: self._test_command('status'))
+        d.addCallback(lambda _: self.assertEqual(len(self.v1.server.requests), 1))
+        return d
+
+    def test_refresh(self):
+        d = self._test_command('status')
+        d.addCallback(lambda _: self._test_command('status refresh'))
+        d.addCallback(lambda _: self.assertEqual(len(self.v1.server.requests), 2))
+        return d
+
+    def test_no_teams(self):
+        self.db.v1_channel_settings.find_one.return_value = None
+        return self._test_command(
+            'status',
+            'No teams found for {0}, add some with "!v1 teams add <teamname>"'.format(self.channel),
+        )
+
+    def test_nothing_open(self):
+        self.v1.server.responses['/rest-1.v1/Data/Workitem'] = EMPTY
+        return self._test_command('status', 'No open workitems for Blue, Red')
+
+    def test_pages(self):
+        settings = copy(settings_stub)
+        settings.VERSIONONE_STATUS_PAGE_SIZE = 2
+        pages = {'2,0': assets(*DEFECTS[:2]), '2,2': assets(DEFECTS[2])}
+        self.v1.server.responses['/rest-1.v1/Data/Workitem'] = lambda query: pages[parse_qs(query)['page'][0]]
+
+        patcher = patch('helga_versionone.settings', settings)
+        patcher.start()
+        d = self._test_command('status')
+
+        def check(res):
+            patcher.stop()
+            self.assertEqual(
+                [parse_qs(query)['page'] for path, query in self.v1.server.requests], [['2,0'], ['2,2']])
+            self.assertIn('Blue, Red: 3 open', self.client.msg.call_args[0][1])
+
+        d.addCallback(check)
+        return d
+
+
+DEFECTS = [
+    """
+  <Asset href="/EnvKey/rest-1.v1/Data/Defect/1" id="Defect:1">
+    <Attribute name="Number">B-01</Attribute>
+    <Attribute name="Name">First</Attribute>
+    <Attribute name="Estimate">3</Attribute>
+    <Relation name="Status"><Asset idref="StoryStatus:1"/></Relation>
+    <Attribute name="Status.Name">In Progress</Attribute>
+    <Relation name="Owners"><Asset idref="Member:1"/><Asset idref="Member:2"/></Relation>
+    <Attribute name="Owners.Name"><Value>Joe</Value><Value>Ann</Value></Attribute>
+  </Asset>
+""",
+    """
+  <Asset href="/EnvKey/rest-1.v1/Data/Defect/2" id="Defect:2">
+    <Attribute name="Number">B-02</Attribute>
+    <Attribute name="Name">Second</Attribute>
+    <Attribute name="Estimate">5.5</Attribute>
+    <Relation name="Status"><Asset idref="StoryStatus:1"/></Relation>
+    <Attribute name="Status.Name">In Progress</Attribute>
+    <Relation name="Owners"><Asset idref="Member:2"/></Relation>
+    <Attribute name="Owners.Name"><Value>Ann</Value></Attribute>
+  </Asset>
+""",
+    """
+  <Asset href="/EnvKey/rest-1.v1/Data/Defect/3" id="Defect:3">
+    <Attribute name="Number">B-03</Attribute>
+    <Attribute name="Name">Third</Attribute>
+    <Attribute name="Estimate" />
+    <Relation name="Status" />
+    <Attribute name="Status.Name" />
+    <Relation name="Owners" />
+    <Attribute name="Owners.Name" />
+  </Asset>
+""",
+]
+
+
+def assets(*defects):
+    return '<Assets total="{0}" pageSize="100" pageStart="0">{1}</Assets>'.format(len(defects), ''.join(defects))
+
+
+WORKITEMS = assets(*DEFECTS)
+
+EMPTY = assets()
+
+
+class TestPrewarm(V1TestCase):
+    reactor = patch('helga_versionone.reactor', new_callable=Clock)
+    logger = patch('helga_versionone.logger')
+
+    def setUp(self):
+        super(TestPrewarm, self).setUp()
+        self.pages = {'2,0': assets(*DEFECTS[:2]), '2,2': assets(DEFECTS[2])}
+        self.v1 = fake_v1({
+            '/meta.v1/Workitem': META_WORKITEM,
+            '/meta.v1/Defect': META_WORKITEM,
+            '/rest-1.v1/Data/Workitem': lambda query: self.pages[parse_qs(query)['page'][0]],
+        })
+        self.get_system_v1.return_value = self.v1
+        self.db.v1_channel_settings.find.return_value = [
+            {'name': '#one', 'teams': {'Blue': 'link'}},
+            {'name': '#two', 'teams': {'Blue': 'link', 'Red': 'link'}},
+        ]
+        settings = copy(settings_stub)
+        settings.VERSIONONE_PREWARM_PAGE_SIZE = 2
+        settings.VERSIONONE_PREWARM_DELAY = 5
+        self.patcher = patch('helga_versionone.settings', settings)
+        self.patcher.start()
+        self.addCleanup(self.patcher.stop)
+
+    def test_warms(self):
+        d = helga_versionone.prewarm_tickets()
+        results = []
+        d.addCallback(results.append)
+
+        self.reactor.advance(0)
+        self.reactor.advance(0)
+        # First page is in, the next waits
+        self.assertEqual(helga_versionone.TICKETS.peek('B-02')['idref'], 'Defect:2')
+        self.assertEqual(helga_versionone.TICKETS.peek('B-03'), None)
+        self.reactor.advance(5)
+        self.reactor.advance(0)
+
+        self.assertEqual(results, [3])
+        self.assertEqual(helga_versionone.TICKETS.peek('B-03')['number'], 'B-03')
+        queries = [parse_qs(query) for path, query in self.v1.server.requests if path.startswith('/rest-1.v1')]
+        self.assertEqual([q['page'] for q in queries], [['2,0'], ['2,2']])
+        self.assertEqual(queries[0]['where'], ["Team.Name='Blue','Red';AssetState='64'"])
+        self.assertEqual(queries[0]['sel'], ['Name,Number'])
+        self.assertIn('Warmed 3 tickets for 2 teams', self.logger.info.call_args[0][0])
+
+    def test_scheduled(self):
+        scheduler = FairScheduler(concurrency=1, max_queued=10, clock=self.reactor)
+        with patch('helga_versionone.SCHEDULER', scheduler):
+            helga_versionone.prewarm_tickets()
+            for seconds in (0, 0, 5, 0):
+                self.reactor.advance(seconds)
+
+        # The teams, then each page
+        self.assertEqual(scheduler.stats()['started'], 3)
+
+    def test_no_teams(self):
+        self.db.v1_channel_settings.find.return_value = []
+        d = helga_versionone.prewarm_tickets()
+        results = []
+        d.addCallback(results.append)
+        self.reactor.advance(0)
+        self.assertEqual(results, [0])
+        self.assertEqual(self.v1.server.requests, [])
+
+    def test_capped_and_kept(self):
+        self.pages['1,0'] = assets(DEFECTS[0])
+        with patch.object(helga_versionone.TICKETS.local, 'max_len', 1):
+            helga_versionone.prewarm_tickets()
+            self.reactor.advance(0)
+            self.reactor.advance(0)
+
+        queries = [parse_qs(query) for path, query in self.v1.server.requests if path.startswith('/rest-1.v1')]
+        self.assertEqual([q['page'] for q in queries], [['1,0']])
+        # Outlasts VERSIONONE_DESCRIPTION_TTL
+        expires = helga_versionone.TICKETS.local._data['B-01'][1]
+        self.assertGreater(expires - time.time(), 3000)
+
+    @patch('helga_versionone._prewarmed', False)
+    def test_signon(self):
+        with patch('helga_versionone.prewarm_tickets') as prewarm_tickets, patch('helga_versionone.start_loop'):
+            helga_versionone.start_background_tasks(self.client)
+            self.assertFalse(prewarm_tickets.called)
+
+            self.patcher.new.VERSIONONE_PREWARM = True
+            helga_versionone.start_background_tasks(self.client)
+            # A reconnect doesn't warm again
+            helga_versionone.start_background_tasks(self.client)
+            prewarm_tickets.assert_called_once_with()
@@ -1,6 +1,11 @@
 from mock import patch
+from pretend import stub
+from twisted.internet.defer import Deferred
+from v1pysdk.client import V1Error
 
-from .util import V1TestCase, writeable_settings_stub
+import helga_versionone
+
+from .util import META_NAMED, META_WORKITEM, V1TestCase, fake_v1, writeable_settings_stub
 
 
 class TestTakeCommand(V1TestCase):
@@ -8,8 +13,9 @@ class TestTakeCommand(V1TestCase):
     get_user = patch('helga_versionone.get_user')
 
     def test_in_owners(self):
-        self.get_workitem().Owners = [self.nick, 'fhqwhgads']
-        self.get_user.return_value = self.nick
+        # Not the same object, only the same idref
+        self.get_workitem().Owners = [stub(idref='Member:20'), stub(idref='Member:10')]
+        self.get_user.return_value = stub(idref='Member:10')
 
         return self._test_command(
             'take whatever',
@@ -17,14 +23,44 @@ class TestTakeCommand(V1TestCase):
         )
 
     def test_not_in_owners_write_fail(self):
-        self.get_workitem().Owners = ['fhqwhgads']
-        self.get_user.return_value = self.nick
+        self.get_workitem().Owners = [stub(idref='Member:20')]
+        self.get_user.return_value = stub(idref='Member:10')
 
         return self._test_command(
             'take whatever',
             'I would, but I\'m not allowed to write :('
         )
 
+    def test_user_not_found(self):
+        self.get_workitem().Owners = []
+        self.get_user.side_effect = helga_versionone.QuitNow('No such user {nick}')
+
+        return self._test_command(
+            'take whatever',
+            'No such user {0}'.format(self.nick),
+        )
+
+    def test_lookups_concurrent(self):
+        pending = []
+
+        def blocking_call(fn, *args):
+            d = Deferred()
+            pending.append((d, fn))
+            return d
+
+        with patch('helga_versionone.blocking_call', blocking_call):
+            d = self._test_command('take whatever')
+            # Both asked for before either answered
+            self.assertEqual([fn for _, fn in pending], [self.get_workitem, self.get_user])
+
+            w = stub(Owners=[stub(idref='Member:10')])
+            pending[1][0].callback(stub(idref='Member:10'))
+            pending[0][0].callback(w)
+
+        d.addCallback(lambda _: self.client.msg.assert_called_once_with(
+            self.channel, 'Dude {0}, you already own it!'.format(self.nick)))
+        return d
+
 
 class TestTakeCommandWithWrite(V1TestCase):
     settings = patch('helga_versionone.settings', writeable_settings_stub)
@@ -33,21 +69,49 @@ class TestTakeCommandWithWrite(V1TestCase):
 
     def test_not_in_owners_write_ok(self):
         w = self.get_workitem()
-        w.Owners = ['fhqwhgads']
-        self.get_user.return_value = self.nick
+        w.Owners = [stub(idref='Member:20')]
+        user = self.get_user.return_value = stub(idref='Member:10')
 
         d = self._test_command(
             'take whatever',
         )
 
         def check(res):
-            # Check data and commit called
-            self.assertEquals(
-                w.Owners,
-                [self.nick],
-            )
-            self.v1.commit.assert_called_once_with()
+            # Written through this v1, Owners only adds
+            self.v1.update_asset.assert_called_once_with(w._v1_asset_type_name, w._v1_oid, {'Owners': [user]})
             self.assertAck()
 
         d.addCallback(check)
         return d
+
+    def test_write_failed(self):
+        self.get_workitem().Owners = []
+        self.get_user.return_value = stub(idref='Member:10')
+        self.v1.update_asset.side_effect = V1Error('Not Found')
+
+        return self._test_command(
+            'take whatever',
+            u'Sorry {0}, writing that to VersionOne failed'.format(self.nick),
+        )
+
+
+class TestTakeCommandConnections(V1TestCase):
+    settings = patch('helga_versionone.settings', writeable_settings_stub)
+
+    def test_written_by_own_connection(self):
+        responses = {
+            '/meta.v1/Defect': META_WORKITEM,
+            '/meta.v1/Member': META_NAMED,
+            '/rest-1.v1/Data/Defect/1234': '<Asset id="Defect:1234:5"/>',
+        }
+        mine, theirs = fake_v1(responses), fake_v1(responses)
+        w, user = mine.Defect(1234), mine.Member(10)
+        # Another nick's command uses the same (shared) asset class in between
+        theirs.Defect
+
+        helga_versionone.commit_changes(mine, (w, 'Owners', [user]))
+
+        self.assertIn(('/rest-1.v1/Data/Defect/1234', ''), mine.server.requests)
+        self.assertNotIn(('/rest-1.v1/Data/Defect/1234', ''), theirs.server.requests)
+        self.assertEqual(mine.dirtylist, [])
+        self.assertEqual(theirs.dirtylist, [])
@@ -1,7 +1,7 @@
 from mock import MagicMock
 from pretend import stub
 
-from .util import V1TestCase
+from .util import V1TestCase, fake_v1
 
 
 class TestTeamCommand(V1TestCase):
@@ -25,7 +25,7 @@ class TestTeamCommand(V1TestCase):
         team = MagicMock()
         team.url = 'http://example.com/'
         team.Rooms = []
-        self.v1.Team.where().first.return_value = team
+        self.v1.Team.where().select().__iter__.return_value = iter([team])
         d = self._test_command(
             'teams add team name',
         )
@@ -42,7 +42,7 @@ class TestTeamCommand(V1TestCase):
         self.db.v1_channel_settings.find_one.return_value = None
         team = MagicMock()
         team.Rooms = [stub(intid=3)]
-        self.v1.Team.where().first.return_value = team
+        self.v1.Team.where().select().__iter__.return_value = iter([team])
         d = self._test_command(
             'teams add team name',
         )
@@ -65,7 +65,10 @@ class TestTeamCommand(V1TestCase):
         )
 
     def test_team_remove_ok(self):
-        self.db.v1_channel_settings.find_one().get.return_value = {'this one': 'http://example.com'}
+        self.db.v1_channel_settings.find_one.return_value = {
+            'name': self.channel,
+            'teams': {'this one': 'http://example.com'},
+        }
         d = self._test_command(
             'team remove this one',
         )
@@ -73,8 +76,92 @@ class TestTeamCommand(V1TestCase):
         d.addCallback(lambda _: self.assertAck())
         return d
 
+    def test_teams_cached(self):
+        self.db.v1_channel_settings.find_one.return_value = {'teams': {'teamName': 'link'}}
+        d = self._test_command('teams', u'teamName link')
+        d.addCallback(lambda _: self._test_command('teams list'))
+
+        def check(res):
+            self.client.msg.assert_called_with(self.channel, u'teamName link')
+            self.assertEqual(self.db.v1_channel_settings.find_one.call_count, 1)
+
+        d.addCallback(check)
+        return d
+
+    def test_save_updates_cache(self):
+        self.db.v1_channel_settings.find_one.return_value = None
+        team = MagicMock()
+        team.url = 'http://example.com/'
+        team.Rooms = []
+        self.v1.Team.where().select().__iter__.return_value = iter([team])
+        d = self._test_command('teams add team name')
+        d.addCallback(lambda _: self._test_command('teams'))
+
+        def check(res):
+            self.client.msg.assert_called_with(self.channel, u'team name http://example.com/')
+            self.assertEqual(self.db.v1_channel_settings.find_one.call_count, 1)
+
+        d.addCallback(check)
+        return d
+
     def test_team_no_command(self):
         return self._test_command(
             'team naugty',
             'No {0}, you can\'t naugty!'.format(self.nick),
         )
+
+
+class TestTeamQuery(V1TestCase):
+    """Run team add against a real V1Meta to count requests"""
+
+    def setUp(self):
+        super(TestTeamQuery, self).setUp()
+        self.v1 = fake_v1({
+            '/meta.v1/Team': META_TEAM,
+            '/meta.v1/TeamRoom': META_TEAM_ROOM,
+            '/rest-1.v1/Data/Team': TEAMS,
+        })
+        self.v1.asset_class('Team')
+        self.v1.asset_class('TeamRoom')
+        del self.v1.server.requests[:]
+
+    def test_one_request(self):
+        self.db.v1_channel_settings.find_one.return_value = None
+        d = self._test_command('teams add A Team')
+
+        def check(res):
+            self.assertEqual(len(self.v1.server.requests), 1)
+            self.assertEqual(self.db.v1_channel_settings.save.call_args[0][0]['teams'], {
+                'A Team': '{0}/TeamRoom.mvc/Show/10, {0}/TeamRoom.mvc/Show/11'.format(
+                    self.settings.VERSIONONE_URL),
+            })
+            self.assertAck()
+
+        d.addCallback(check)
+        return d
+
+
+META_TEAM = """
+<AssetType name="Team">
+  <AttributeDefinition name="Name" attributetype="Text" ismultivalue="False"/>
+  <AttributeDefinition name="Rooms" attributetype="Relation" ismultivalue="True"/>
+</AssetType>
+"""
+
+META_TEAM_ROOM = """
+<AssetType name="TeamRoom">
+  <AttributeDefinition name="Name" attributetype="Text" ismultivalue="False"/>
+</AssetType>
+"""
+
+TEAMS = """
+<Assets total="1" pageSize="2147483647" pageStart="0">
+  <Asset href="/EnvKey/rest-1.v1/Data/Team/3" id="Team:3">
+    <Attribute name="Name">A Team</Attribute>
+    <Relation name="Rooms">
+      <Asset href="/EnvKey/rest-1.v1/Data/TeamRoom/10" idref="TeamRoom:10"/>
+      <Asset href="/EnvKey/rest-1.v1/Data/TeamRoom/11" idref="TeamRoom:11"/>
+    </Relation>
+  </Asset>
+</Assets>
+"""
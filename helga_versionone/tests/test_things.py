@@ -1,7 +1,11 @@
 from mock import patch
 from pretend import stub
+from unittest import TestCase
+from urlparse import parse_qs
 
-from .util import V1TestCase, writeable_settings_stub
+import helga_versionone
+
+from .util import V1TestCase, fake_v1, settings_stub, writeable_settings_stub
 
 # Tests for both tests and tasks as they are the same code path
 
@@ -19,25 +23,28 @@ def make_thing(name, num, status_name, status_order):
 
 class TestThingCommand(V1TestCase):
     get_workitem = patch('helga_versionone.get_workitem')
+    _get_things = patch('helga_versionone._get_things', return_value=[])
 
     def setUp(self):
         super(TestThingCommand, self).setUp()
+        # Sorted by the server
         self.results = [
-            make_thing('thing', 1, 'Done', 99),
             make_thing('thing', 2, 'None', 0),
             make_thing('thing', 3, 'In Progress', 50),
+            make_thing('thing', 1, 'Done', 99),
         ]
-        self.results_ordered = [self.results[i] for i in [1, 2, 0]]
-        self.v1.Task.where().select.return_value = self.results
 
     def test_list_tasks(self):
-        return self._test_command(
+        self._get_things.return_value = self.results
+        d = self._test_command(
             'tasks whatever',
             '\n'.join([
                 '[{0}] {1} {2}'.format(t.Status.Name, t.Name, t.url)
-                for t in self.results_ordered
+                for t in self.results
             ]),
         )
+        d.addCallback(lambda _: self._get_things.assert_called_once_with(self.v1.Task, 'whatever'))
+        return d
 
     def test_list_tests_none(self):
         return self._test_command(
@@ -73,9 +80,9 @@ class TestThingCommandWithWrite(V1TestCase):
         name = 'Do a little dance'
         url = 'http://example.com'
 
-        self.v1.Test.create.return_value = stub(
-            Name=name,
+        self.v1.create_asset.return_value = stub(
             url=url,
+            idref='Test:4',
         )
 
         d = self._test_command(
@@ -84,11 +91,73 @@ class TestThingCommandWithWrite(V1TestCase):
         )
 
         def check(res):
-            # Check data and commit called
-            self.v1.Test.create.assert_called_once_with(
-                Name=name,
-                Parent=3,
+            # Created through this v1
+            self.v1.create_asset.assert_called_once_with(
+                self.v1.Test._v1_asset_type_name,
+                {'Name': name, 'Parent': 3},
             )
 
         d.addCallback(check)
         return d
+
+
+class TestThingQuery(TestCase):
+    def setUp(self):
+        self.v1 = fake_v1({
+            '/meta.v1/Task': META_TASK,
+            '/meta.v1/TaskStatus': META_TASK_STATUS,
+            '/rest-1.v1/Data/Task': TASKS,
+        })
+        # Asset classes are built once, from metadata, not per query
+        self.v1.asset_class('Task')
+        self.v1.asset_class('TaskStatus')
+        del self.v1.server.requests[:]
+
+    def test_one_request(self):
+        res = helga_versionone._list_or_add_things(self.v1, 'Task', 'B-0010')
+
+        self.assertEqual(res, '\n'.join([
+            '[None] First {0}/assetdetail.v1?oid=Task%3A1001'.format(settings_stub.VERSIONONE_URL),
+            '[Done] Second {0}/assetdetail.v1?oid=Task%3A1002'.format(settings_stub.VERSIONONE_URL),
+        ]))
+        self.assertEqual(len(self.v1.server.requests), 1)
+        path, query = self.v1.server.requests[0]
+        self.assertEqual(path, '/rest-1.v1/Data/Task')
+        self.assertEqual(parse_qs(query), {
+            'where': ["Parent.Number='B-0010'"],
+            'sel': ['Name,Status,Status.Name,Status.Order'],
+            'sort': ['Status.Order'],
+        })
+
+
+META_TASK = """
+<AssetType name="Task">
+  <AttributeDefinition name="Name" attributetype="Text" ismultivalue="False"/>
+  <AttributeDefinition name="Status" attributetype="Relation" ismultivalue="False"/>
+  <AttributeDefinition name="Parent" attributetype="Relation" ismultivalue="False"/>
+</AssetType>
+"""
+
+META_TASK_STATUS = """
+<AssetType name="TaskStatus">
+  <AttributeDefinition name="Name" attributetype="Text" ismultivalue="False"/>
+  <AttributeDefinition name="Order" attributetype="Rank" ismultivalue="False"/>
+</AssetType>
+"""
+
+TASKS = """
+<Assets total="2" pageSize="2147483647" pageStart="0">
+  <Asset href="/EnvKey/rest-1.v1/Data/Task/1001" id="Task:1001">
+    <Attribute name="Name">First</Attribute>
+    <Relation name="Status"><Asset href="/EnvKey/rest-1.v1/Data/TaskStatus/1" idref="TaskStatus:1"/></Relation>
+    <Attribute name="Status.Name">None</Attribute>
+    <Attribute name="Status.Order">0</Attribute>
+  </Asset>
+  <Asset href="/EnvKey/rest-1.v1/Data/Task/1002" id="Task:1002">
+    <Attribute name="Name">Second</Attribute>
+    <Relation name="Status"><Asset href="/EnvKey/rest-1.v1/Data/TaskStatus/2" idref="TaskStatus:2"/></Relation>
+    <Attribute name="Status.Name">Done</Attribute>
+    <Attribute name="Status.Order">99</Attribute>
+  </Asset>
+</Assets>
+"""
@@ -1,8 +1,24 @@
+import gzip
+import httplib
+import urllib2
+import zlib
+
 from mock import patch, MagicMock
+from pretend import stub
+from StringIO import StringIO
 from unittest import TestCase
 from httplib2 import HttpLib2ErrorWithResponse
+from urllib2 import HTTPError
+from v1pysdk.client import V1AssetNotFoundError, V1Error
+from xml.etree import ElementTree
 
-from helga_versionone.v1_wrapper import property_required, HelgaOauthV1Server
+from helga_versionone import stats
+from helga_versionone.cache import ResponseCache
+from helga_versionone.metadata import MetaSnapshot
+from helga_versionone.v1_wrapper import (
+    first, property_required, iter_asset_elements, stream_query,
+    CachingHandler, HelgaOauthV1Server, HelgaV1Meta, HelgaV1Server,
+)
 
 
 class TestPropertyRequired(TestCase):
@@ -57,9 +73,15 @@ class TestHelgaOauthV1Server(TestCase):
         s = HelgaOauthV1Server(instance_url='http://example.com/instance_name', credentials=creds)
         creds.authorize.call_args.assert_called_once_with(s.httpclient)
 
+    def test_token_timed(self):
+        s = HelgaOauthV1Server(instance_url='http://example.com/instance_name',
+                               password='token', use_password_as_token=True)
+        self.assertIs(type(s), HelgaV1Server)
+
 
 class TestHelgaOauthV1ServerWithInstance(TestCase):
     def setUp(self):
+        stats.registry.clear()
         self.url = 'http://example.com/instance_name'
         self.server = HelgaOauthV1Server(instance_url=self.url)
         self.server.httpclient = MagicMock()
@@ -87,3 +109,281 @@ class TestHelgaOauthV1ServerWithInstance(TestCase):
         self.assertEqual(e, error)
         self.assertEqual(c, 'error content')
         self.assertEqual(e.response, response)
+
+    def test_fetch_timed(self):
+        self.server.fetch('/test')
+        self.server.fetch('/test', postdata={'q': 'query'})
+        self.server.httpclient.request.side_effect = HttpLib2ErrorWithResponse('desc', MagicMock(), 'error')
+        self.server.fetch('/test')
+
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['timers']['v1.get']['count'], 2)
+        self.assertEqual(snapshot['timers']['v1.post']['count'], 1)
+        self.assertEqual(snapshot['counters'], {'v1.get.errors': 1})
+
+
+ASSETS = """<Assets total="2" pageSize="2" pageStart="0">
+  <Asset href="/EnvKey/rest-1.v1/Data/Story/1" id="Story:1">
+    <Attribute name="Name">One</Attribute>
+    <Relation name="Owners"><Asset href="/EnvKey/rest-1.v1/Data/Member/20" idref="Member:20"/></Relation>
+  </Asset>
+  <Asset href="/EnvKey/rest-1.v1/Data/Story/2" id="Story:2">
+    <Attribute name="Name">Two</Attribute>
+  </Asset>
+</Assets>"""
+
+META_STORY = """<AssetType name="Story">
+  <AttributeDefinition name="Name" attributetype="Text" ismultivalue="False"/>
+  <AttributeDefinition name="Owners" attributetype="Relation" ismultivalue="True"/>
+</AssetType>"""
+
+
+class TestIterAssetElements(TestCase):
+    def test_top_level_only(self):
+        names = []
+        for asset in iter_asset_elements(StringIO(ASSETS)):
+            names.append((asset.get('id'), asset.find('Attribute').text))
+        self.assertEqual(names, [('Story:1', 'One'), ('Story:2', 'Two')])
+
+    def test_cleared(self):
+        assets = iter_asset_elements(StringIO(ASSETS))
+        first = next(assets)
+        self.assertEqual(len(first), 2)
+        next(assets)
+        self.assertEqual(len(first), 0)
+
+
+class TestMetaSnapshot(TestCase):
+    def setUp(self):
+        stats.registry.clear()
+        self.server = HelgaV1Server(instance_url='http://example.com/EnvKey')
+        self.server.fetch = MagicMock(return_value=(None, META_STORY))
+        self.snapshot = MetaSnapshot('http://example.com/EnvKey')
+        self.server.use_meta_snapshot(self.snapshot)
+
+    def test_fetched_once(self):
+        first = self.server.get_meta_xml('Story')
+        second = self.server.get_meta_xml('Story')
+        self.server.fetch.assert_called_once_with('/meta.v1/Story', query='', postdata=None)
+        self.assertEqual(
+            [a.get('name') for a in second.findall('AttributeDefinition')],
+            [a.get('name') for a in first.findall('AttributeDefinition')],
+        )
+        self.assertEqual(stats.snapshot()['counters']['v1.meta.snapshot'], 1)
+
+    def test_from_snapshot(self):
+        self.snapshot.set('Story', META_STORY)
+        self.assertEqual(self.server.get_meta_xml('Story').get('name'), 'Story')
+        self.assertFalse(self.server.fetch.called)
+
+    def test_no_snapshot(self):
+        self.server.use_meta_snapshot(None)
+        self.server.get_meta_xml('Story')
+        self.server.get_meta_xml('Story')
+        self.assertEqual(self.server.fetch.call_count, 2)
+
+    def test_oauth(self):
+        server = HelgaOauthV1Server(instance_url='http://example.com/EnvKey')
+        server.fetch = MagicMock(return_value=(None, META_STORY))
+        server.use_meta_snapshot(self.snapshot)
+        server.get_meta_xml('Story')
+        self.assertEqual(self.snapshot.names(), ['Story'])
+
+
+class TestStreamAssets(TestCase):
+    def setUp(self):
+        self.server = HelgaV1Server(instance_url='http://example.com/EnvKey')
+        self.server.http_get = MagicMock()
+
+    def test_stream(self):
+        response = self.server.http_get.return_value = MagicMock(wraps=StringIO(ASSETS))
+        ids = [a.get('id') for a in self.server.stream_assets('/rest-1.v1/Data/Story', query='sel=Name')]
+        self.assertEqual(ids, ['Story:1', 'Story:2'])
+        self.server.http_get.assert_called_once_with('http://example.com/EnvKey/rest-1.v1/Data/Story?sel=Name')
+        response.close.assert_called_once_with()
+
+    def test_not_found(self):
+        body = StringIO('<Error href="/EnvKey/rest-1.v1/Data/Nope"><Message>Not Found</Message></Error>')
+        self.server.http_get.side_effect = HTTPError('url', 404, 'Not Found', {}, body)
+        self.assertRaises(V1AssetNotFoundError, list, self.server.stream_assets('/rest-1.v1/Data/Nope'))
+
+    def test_unauthorized(self):
+        self.server.http_get.side_effect = HTTPError('url', 401, 'Unauthorized', {}, StringIO(''))
+        self.assertRaises(HTTPError, list, self.server.stream_assets('/rest-1.v1/Data/Story'))
+
+    def test_oauth(self):
+        server = HelgaOauthV1Server(instance_url='http://example.com/EnvKey')
+        server.httpclient = MagicMock()
+        server.httpclient.request.return_value = ('response', ASSETS)
+        self.assertEqual(len(list(server.stream_assets('/rest-1.v1/Data/Story'))), 2)
+
+
+class TestStreamQuery(TestCase):
+    def setUp(self):
+        self.v1 = HelgaV1Meta(instance_url='http://example.com/EnvKey')
+        self.v1.server = HelgaV1Server(instance_url='http://example.com/EnvKey')
+        self.v1.server.get_meta_xml = MagicMock(return_value=ElementTree.fromstring(META_STORY))
+        self.v1.server.http_get = MagicMock(return_value=StringIO(ASSETS))
+
+    def test_streamed(self):
+        stories = list(stream_query(self.v1, self.v1.Story.where(Name='One').select('Name', 'Owners')))
+
+        self.assertEqual([s.Name for s in stories], ['One', 'Two'])
+        self.assertEqual(stories[0].Owners[0].idref, 'Member:20')
+        url = self.v1.server.http_get.call_args[0][0]
+        self.assertIn('sel=Name%2COwners', url)
+        self.assertIn('where=Name%3D%27One%27', url)
+
+    def test_own_connection(self):
+        query = self.v1.Story.select('Name')
+        other = HelgaV1Meta(instance_url='http://example.com/EnvKey')
+        other.server = MagicMock()
+        # Another nick's command uses the same (shared) asset class in between
+        other.Story
+
+        self.assertEqual(len(list(stream_query(self.v1, query))), 2)
+        self.assertFalse(other.server.stream_assets.called)
+
+    def test_not_streaming(self):
+        self.v1.server = MagicMock(spec=['get_xml'])
+        self.v1.server.get_xml.return_value = ElementTree.fromstring(ASSETS)
+        stories = list(stream_query(self.v1, self.v1.Story.select('Name')))
+        self.assertEqual([s.Name for s in stories], ['One', 'Two'])
+        self.v1.server.get_xml.assert_called_once_with('/rest-1.v1/Data/Story', query='sel=Name')
+
+    def test_not_a_query(self):
+        self.assertEqual(list(stream_query(self.v1, ['thing'])), ['thing'])
+
+    def test_first(self):
+        self.assertEqual(first(self.v1, self.v1.Story.select('Name')).Name, 'One')
+        self.assertRaises(IndexError, first, self.v1, [])
+
+
+class FakeHTTPHandler(urllib2.BaseHandler):
+    """Answers every request with the next of responses: (code, headers dict, body)"""
+    handler_order = 100
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def http_open(self, request):
+        self.requests.append(request)
+        code, headers, body = self.responses.pop(0)
+        message = httplib.HTTPMessage(StringIO(''.join(
+            '{0}: {1}\r\n'.format(k, v) for k, v in headers.items())))
+        response = urllib2.addinfourl(StringIO(body), message, request.get_full_url(), code)
+        response.msg = 'whatever'
+        return response
+
+
+def gzipped(data):
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class TestCachingHandler(TestCase):
+    url = 'http://example.com/EnvKey/rest-1.v1/Data/Story'
+
+    def setUp(self):
+        stats.registry.clear()
+        self.cache = ResponseCache(10, 1000)
+
+    def opener(self, *responses):
+        self.http = FakeHTTPHandler(list(responses))
+        return urllib2.build_opener(self.http, CachingHandler(self.cache))
+
+    def test_gzip(self):
+        body = '<Assets>' + '<Asset/>' * 50 + '</Assets>'
+        response = self.opener((200, {'Content-Encoding': 'gzip'}, gzipped(body))).open(self.url)
+
+        self.assertEqual(response.read(), body)
+        self.assertEqual(self.http.requests[0].unredirected_hdrs['Accept-encoding'], 'gzip, deflate')
+        self.assertNotIn('content-encoding', response.info())
+        self.assertEqual(
+            stats.snapshot()['counters']['v1.saved_bytes.compressed'], len(body) - len(gzipped(body)))
+
+    def test_gzip_streamed(self):
+        response = self.opener((200, {'Content-Encoding': 'gzip'}, gzipped(ASSETS))).open(self.url)
+        self.assertEqual(len(list(iter_asset_elements(response))), 2)
+
+    def test_deflate(self):
+        for compress in (zlib.compressobj(), zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)):
+            data = compress.compress(ASSETS) + compress.flush()
+            response = self.opener((200, {'Content-Encoding': 'deflate'}, data)).open(self.url)
+            self.assertEqual(response.read(), ASSETS)
+
+    def test_gzipped_error(self):
+        error = '<Error><Message>Bad Request</Message></Error>'
+        opener = self.opener((400, {'Content-Encoding': 'gzip'}, gzipped(error)))
+        with self.assertRaises(HTTPError) as raised:
+            opener.open(self.url)
+        self.assertEqual(raised.exception.code, 400)
+        self.assertEqual(raised.exception.read(), error)
+
+    def test_gzipped_error_raised_as_v1(self):
+        error = '<Error><Message>Not Found</Message></Error>'
+        server = HelgaV1Server(instance_url='http://example.com/EnvKey')
+        server.use_response_cache(self.cache)
+        server.opener.add_handler(FakeHTTPHandler([
+            (400, {'Content-Encoding': 'gzip', 'Content-Type': 'text/xml'}, gzipped(error)),
+            (404, {'Content-Encoding': 'gzip', 'Content-Type': 'text/xml'}, gzipped(error)),
+        ]))
+
+        self.assertRaises(V1Error, server.get_xml, '/rest-1.v1/Data/Story/1', postdata='<Asset/>')
+        self.assertRaises(V1AssetNotFoundError, list, server.stream_assets('/rest-1.v1/Data/Nope'))
+
+    def test_not_modified(self):
+        opener = self.opener(
+            (200, {'ETag': '"v1"', 'Content-Type': 'text/xml'}, ASSETS),
+            (304, {'ETag': '"v1"'}, ''),
+        )
+        self.assertEqual(opener.open(self.url).read(), ASSETS)
+        second = opener.open(self.url)
+
+        self.assertEqual(second.code, 200)
+        self.assertEqual(second.read(), ASSETS)
+        self.assertEqual(self.http.requests[1].unredirected_hdrs['If-none-match'], '"v1"')
+        self.assertEqual(stats.snapshot()['counters']['v1.saved_bytes.not_modified'], len(ASSETS))
+
+    def test_last_modified(self):
+        opener = self.opener(
+            (200, {'Last-Modified': 'Sat, 17 Oct 2026 01:00:00 GMT'}, ASSETS),
+            (304, {}, ''),
+        )
+        opener.open(self.url).read()
+        self.assertEqual(opener.open(self.url).read(), ASSETS)
+        self.assertEqual(
+            self.http.requests[1].unredirected_hdrs['If-modified-since'], 'Sat, 17 Oct 2026 01:00:00 GMT')
+
+    def test_partly_read_not_kept(self):
+        opener = self.opener((200, {'ETag': '"v1"'}, ASSETS))
+        response = opener.open(self.url)
+        response.read(10)
+        response.close()
+        self.assertEqual(self.cache.keys(), [])
+
+    def test_too_big_not_kept(self):
+        self.cache.max_bytes = 10
+        self.opener((200, {'ETag': '"v1"'}, ASSETS)).open(self.url).read()
+        self.assertEqual(self.cache.keys(), [])
+
+    def test_changed(self):
+        opener = self.opener(
+            (200, {'ETag': '"v1"'}, 'old'),
+            (200, {'ETag': '"v2"'}, 'new'),
+        )
+        opener.open(self.url).read()
+        self.assertEqual(opener.open(self.url).read(), 'new')
+        self.assertEqual(self.cache.get(('urllib2', self.url))[0], '"v2"')
+
+    def test_oauth_from_cache(self):
+        server = HelgaOauthV1Server(instance_url='http://example.com/EnvKey', credentials=MagicMock())
+        server.use_response_cache(self.cache)
+        self.assertIs(server.httpclient.cache, self.cache)
+        server.httpclient.request = MagicMock(return_value=(stub(fromcache=True), ASSETS))
+
+        server.fetch('/rest-1.v1/Data/Story')
+        self.assertEqual(stats.snapshot()['counters']['v1.saved_bytes.not_modified'], len(ASSETS))
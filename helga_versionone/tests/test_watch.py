@@ -0,0 +1,244 @@
+from urlparse import parse_qs
+
+from mock import MagicMock, patch
+from pymongo import UpdateOne
+
+import helga_versionone
+
+from .util import META_NAMED, META_WORKITEM, V1TestCase, fake_v1
+
+
+class TestWatchCommand(V1TestCase):
+    forget = patch('helga_versionone.FEED.forget')
+
+    def test_not_watching(self):
+        self.db.v1_channel_settings.find_one.return_value = None
+        return self._test_command('watch', '{0} is not watching its teams'.format(self.channel))
+
+    def test_watching(self):
+        self.db.v1_channel_settings.find_one.return_value = {'name': self.channel, 'watch': True}
+        return self._test_command('watch', '{0} is watching its teams'.format(self.channel))
+
+    def test_on(self):
+        self.db.v1_channel_settings.find_one.return_value = {'name': self.channel, 'teams': {'Blue': 'link'}}
+        d = self._test_command('watch on')
+
+        def check(res):
+            self.assertTrue(self.db.v1_channel_settings.save.call_args[0][0]['watch'])
+            self.assertAck()
+
+        d.addCallback(check)
+        return d
+
+    def test_on_no_teams(self):
+        self.db.v1_channel_settings.find_one.return_value = None
+        return self._test_command(
+            'watch on',
+            'No teams found for {0}, add some with "!v1 teams add <teamname>"'.format(self.channel),
+        )
+
+    def test_off(self):
+        self.db.v1_channel_settings.find_one.return_value = {'name': self.channel, 'watch': True}
+        d = self._test_command('watch off')
+
+        def check(res):
+            self.assertNotIn('watch', self.db.v1_channel_settings.save.call_args[0][0])
+            self.forget.assert_called_once_with(self.channel)
+            self.assertAck()
+
+        d.addCallback(check)
+        return d
+
+    def test_no_command(self):
+        return self._test_command('watch naugty', 'No {0}, you can\'t naugty!'.format(self.nick))
+
+
+class TestChangeFeed(V1TestCase):
+    reactor = patch('helga_versionone.reactor')
+
+    def setUp(self):
+        super(TestChangeFeed, self).setUp()
+        self.v1 = fake_v1({
+            '/meta.v1/Workitem': META_WORKITEM,
+            '/meta.v1/Defect': META_WORKITEM,
+            '/meta.v1/StoryStatus': META_NAMED,
+            '/meta.v1/Member': META_NAMED,
+            '/meta.v1/Team': META_NAMED,
+            '/rest-1.v1/Data/Workitem': CHANGED,
+        })
+        for name in ('Workitem', 'Defect', 'StoryStatus', 'Member', 'Team'):
+            self.v1.asset_class(name)
+        del self.v1.server.requests[:]
+        self.get_system_v1.return_value = self.v1
+        helga_versionone.FEED.client = self.client
+        self.addCleanup(setattr, helga_versionone.FEED, 'client', None)
+
+        self.db.v1_channel_settings.find.return_value = [
+            {'name': '#blue', 'watch': True, 'teams': {'Blue': 'link'}},
+            {'name': '#both', 'watch': True, 'teams': {'Blue': 'link', 'Red': 'link'}},
+        ]
+        self.db.v1_change_feed.find.return_value = [
+            {'channel': '#blue', 'change_date': '2026-10-17T09:00:00.000'},
+            {'channel': '#both', 'change_date': '2026-10-17T10:30:00.000'},
+        ]
+        self.db.v1_change_feed_tickets.find.return_value = [
+            {'number': 'B-01', 'status': 'Ready', 'owners': ['Joe'], 'reviews': 'http://cr/1'},
+            {'number': 'B-02', 'status': 'Done', 'owners': [], 'reviews': ''},
+        ]
+
+    def announced(self):
+        return dict(
+            (c[0][2], c[0][3].split('\n'))
+            for c in self.reactor.callFromThread.call_args_list
+        )
+
+    def test_one_query(self):
+        helga_versionone.FEED.poll()
+
+        self.assertEqual(len(self.v1.server.requests), 1)
+        path, query = self.v1.server.requests[0]
+        params = parse_qs(query)
+        self.assertEqual(params['where'], ["Team.Name='Blue','Red';ChangeDate>'2026-10-17T09:00:00.000'"])
+        self.assertEqual(params['sort'], ['ChangeDate'])
+        self.assertIn('field_one', params['sel'][0].split(','))
+
+    def test_deltas(self):
+        helga_versionone.FEED.poll()
+
+        self.assertEqual(self.announced(), {
+            '#blue': [
+                'B-01 First: now In Progress (was Ready), +Ann, CR http://cr/2',
+            ],
+            '#both': [
+                # B-01 changed before #both last looked
+                'B-03 Third: new, no status, owned by nobody',
+            ],
+        })
+        self.reactor.callFromThread.assert_called_with(
+            helga_versionone.send_response, self.client, '#both', 'B-03 Third: new, no status, owned by nobody')
+
+    def test_saves(self):
+        helga_versionone.FEED.poll()
+
+        tickets = self.db.v1_change_feed_tickets.bulk_write.call_args[0][0]
+        self.assertIn(UpdateOne({'number': 'B-01'}, {'$set': {
+            'status': 'In Progress',
+            'owners': ['Ann', 'Joe'],
+            'reviews': 'http://cr/1 http://cr/2',
+        }}, upsert=True), tickets)
+        self.db.v1_change_feed.bulk_write.assert_called_once_with([
+            UpdateOne({'channel': '#blue'}, {'$max': {'change_date': '2026-10-17T11:00:00.000'}}, upsert=True),
+            UpdateOne({'channel': '#both'}, {'$max': {'change_date': '2026-10-17T11:00:00.000'}}, upsert=True),
+        ], ordered=False)
+
+    def test_new_channel(self):
+        self.db.v1_change_feed.find.return_value = []
+        helga_versionone.FEED.poll()
+
+        path, query = self.v1.server.requests[0]
+        self.assertEqual(parse_qs(query)['where'], ["Team.Name='Blue','Red';AssetState='64'"])
+        # Only remembered
+        self.assertFalse(self.reactor.callFromThread.called)
+        self.assertTrue(self.db.v1_change_feed_tickets.bulk_write.called)
+        self.assertTrue(self.db.v1_change_feed.bulk_write.called)
+
+    def test_new_channel_shares_team(self):
+        self.db.v1_channel_settings.find.return_value = [
+            {'name': '#blue', 'watch': True, 'teams': {'Blue': 'link'}},
+            {'name': '#new', 'watch': True, 'teams': {'Blue': 'link'}},
+        ]
+        self.db.v1_change_feed.find.return_value = [
+            {'channel': '#blue', 'change_date': '2026-10-17T09:00:00.000'},
+        ]
+        # Like mongo, what's saved is what is found next
+        saved = dict((t['number'], t) for t in self.db.v1_change_feed_tickets.find.return_value)
+        self.db.v1_change_feed_tickets.find.side_effect = lambda q: [
+            saved[n] for n in q['number']['$in'] if n in saved]
+        self.db.v1_change_feed_tickets.bulk_write.side_effect = lambda ops, ordered: saved.update(
+            (op._filter['number'], dict(op._doc['$set'], number=op._filter['number'])) for op in ops)
+        self.v1.server.responses['/rest-1.v1/Data/Workitem'] = '<Assets total="2">{0}{1}</Assets>'.format(
+            FIRST, SECOND)
+
+        helga_versionone.FEED.poll()
+
+        self.assertEqual(self.announced(), {
+            '#blue': ['B-01 First: now In Progress (was Ready), +Ann, CR http://cr/2'],
+        })
+        self.assertEqual(saved['B-01']['status'], 'In Progress')
+
+    def test_nobody_watching(self):
+        self.db.v1_channel_settings.find.return_value = []
+        helga_versionone.FEED.poll()
+        self.assertEqual(self.v1.server.requests, [])
+
+    def test_unchanged(self):
+        self.v1.server.responses['/rest-1.v1/Data/Workitem'] = '<Assets total="1">{0}</Assets>'.format(SECOND)
+        helga_versionone.FEED.poll()
+        self.assertFalse(self.reactor.callFromThread.called)
+
+    def test_signon_starts(self):
+        with patch('helga_versionone.start_loop') as start_loop:
+            helga_versionone.start_background_tasks(self.client)
+        start_loop.assert_any_call('changes', 60, helga_versionone.FEED.poll)
+        self.assertIs(helga_versionone.FEED.client, self.client)
+
+    def test_reconnect(self):
+        reconnected = MagicMock()
+        with patch('helga_versionone.start_loop'):
+            helga_versionone.start_background_tasks(self.client)
+            helga_versionone.start_background_tasks(reconnected)
+        helga_versionone.FEED.poll()
+
+        self.assertEqual(set(c[0][1] for c in self.reactor.callFromThread.call_args_list), set([reconnected]))
+
+    def test_new_channel_nothing_open(self):
+        self.db.v1_change_feed.find.return_value = []
+        self.v1.server.responses['/rest-1.v1/Data/Workitem'] = lambda query: (
+            '<Assets total="0"/>' if 'AssetState' in query else '<Assets total="1">{0}</Assets>'.format(SECOND))
+        helga_versionone.FEED.poll()
+
+        path, query = self.v1.server.requests[1]
+        self.assertEqual(parse_qs(query)['sort'], ['-ChangeDate'])
+        self.db.v1_change_feed.bulk_write.assert_called_once_with([
+            UpdateOne({'channel': '#blue'}, {'$max': {'change_date': '2026-10-17T10:45:00.000'}}, upsert=True),
+            UpdateOne({'channel': '#both'}, {'$max': {'change_date': '2026-10-17T10:45:00.000'}}, upsert=True),
+        ], ordered=False)
+
+    def test_no_workitems_ever(self):
+        self.db.v1_change_feed.find.return_value = []
+        self.v1.server.responses['/rest-1.v1/Data/Workitem'] = '<Assets total="0"/>'
+        helga_versionone.FEED.poll()
+        self.assertEqual(self.db.v1_change_feed.bulk_write.call_count, 1)
+
+
+TEAMS = {'Blue': 1, 'Red': 2}
+
+
+def defect(oid, number, name, team, change_date, status=None, owners=(), review=''):
+    return """
+  <Asset href="/EnvKey/rest-1.v1/Data/Defect/{oid}" id="Defect:{oid}">
+    <Attribute name="Number">{number}</Attribute>
+    <Attribute name="Name">{name}</Attribute>
+    <Relation name="Team"><Asset idref="Team:{team_oid}"/></Relation>
+    <Attribute name="Team.Name">{team}</Attribute>
+    <Relation name="Status">{status_ref}</Relation>
+    <Attribute name="Status.Name">{status}</Attribute>
+    <Relation name="Owners">{owner_refs}</Relation>
+    <Attribute name="Owners.Name">{owner_names}</Attribute>
+    <Attribute name="field_one">{review}</Attribute>
+    <Attribute name="ChangeDate">{change_date}</Attribute>
+  </Asset>""".format(
+        oid=oid, number=number, name=name, team=team, team_oid=TEAMS[team], change_date=change_date, review=review,
+        status=status or '',
+        status_ref='<Asset idref="StoryStatus:1"/>' if status else '',
+        owner_refs=''.join('<Asset idref="Member:{0}"/>'.format(i) for i, o in enumerate(owners)),
+        owner_names=''.join('<Value>{0}</Value>'.format(o) for o in owners),
+    )
+
+
+FIRST = defect(1, 'B-01', 'First', 'Blue', '2026-10-17T10:00:00.000', 'In Progress', ('Joe', 'Ann'),
+               'http://cr/1 http://cr/2')
+SECOND = defect(2, 'B-02', 'Second', 'Blue', '2026-10-17T10:45:00.000', 'Done')
+THIRD = defect(3, 'B-03', 'Third', 'Red', '2026-10-17T11:00:00.000')
+
+CHANGED = '<Assets total="3">{0}{1}{2}</Assets>'.format(FIRST, SECOND, THIRD)
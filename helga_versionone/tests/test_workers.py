@@ -0,0 +1,183 @@
+import threading
+
+from copy import copy
+from mock import patch
+from twisted.internet.defer import Deferred, gatherResults
+from twisted.trial import unittest
+
+from helga_versionone import workers
+
+from .util import V1TestCase, settings_stub
+
+
+threaded_settings_stub = copy(settings_stub)
+threaded_settings_stub.VERSIONONE_WORKER_THREADS = 2
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(workers.stop_pools)
+
+    def test_no_size_no_pool(self):
+        self.assertEqual(workers.get_pool('test', 0), None)
+        self.assertEqual(workers.stats(), {})
+
+    def test_same_pool(self):
+        p = workers.get_pool('test', 2)
+        self.assertIs(workers.get_pool('test', 2), p)
+
+    def test_resize(self):
+        p = workers.get_pool('test', 2)
+        p2 = workers.get_pool('test', 3)
+        self.assertIsNot(p, p2)
+        self.assertEqual(p2.size, 3)
+
+    def test_resize_doesnt_block(self):
+        p = workers.get_pool('test', 2)
+        with patch.object(workers.reactor, 'callInThread') as call_in_thread:
+            workers.get_pool('test', 3)
+            workers.get_pool('test', 0)
+        self.assertEqual(call_in_thread.call_count, 2)
+        self.assertEqual(call_in_thread.call_args_list[0][0], (p._pool.stop,))
+        for args, kwargs in call_in_thread.call_args_list:
+            args[0]()
+
+    def test_turn_off(self):
+        workers.get_pool('test', 2)
+        self.assertEqual(workers.get_pool('test', 0), None)
+        self.assertEqual(workers.stats(), {})
+
+    def test_stop_twice(self):
+        p = workers.get_pool('test', 2)
+        p.stop()
+        workers.stop_pools()
+        self.assertEqual(workers.stats(), {})
+
+    def test_runs_in_thread(self):
+        pool = workers.get_pool('test', 2)
+        d = pool.run(lambda: threading.current_thread().name)
+
+        def check(name):
+            self.assertNotEqual(name, threading.current_thread().name)
+            self.assertEqual(
+                workers.stats()['test'],
+                {'size': 2, 'queued': 0, 'active': 0, 'completed': 1, 'failed': 0},
+            )
+
+        return d.addCallback(check)
+
+    def test_failure(self):
+        pool = workers.get_pool('test', 1)
+
+        def boom():
+            raise ValueError('boom')
+
+        d = pool.run(boom)
+        d = self.assertFailure(d, ValueError)
+        d.addCallback(lambda _: self.assertEqual(pool.stats()['failed'], 1))
+        return d
+
+
+class TestThreadedCommand(V1TestCase):
+    settings = patch('helga_versionone.settings', threaded_settings_stub)
+
+    def setUp(self):
+        super(TestThreadedCommand, self).setUp()
+        self.addCleanup(workers.stop_pools)
+
+    def test_command_in_pool(self):
+        self.db.v1_user_map.find_one.return_value = {'v1_nick': 'nickname'}
+        d = self._test_command(
+            'alias',
+            '{0} is known as nickname in V1'.format(self.nick),
+        )
+        d.addCallback(lambda _: self.assertEqual(workers.stats()['commands']['completed'], 1))
+        return d
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.flights = workers.SingleFlight()
+        self.calls = []
+
+    def fn(self, *args):
+        d = Deferred()
+        self.calls.append((args, d))
+        return d
+
+    def test_shared(self):
+        one = self.flights.run('key', self.fn, 1)
+        two = self.flights.run('key', self.fn, 1)
+        self.assertEqual(len(self.calls), 1)
+        self.calls[0][1].callback('result')
+        self.assertEqual(self.successResultOf(one), 'result')
+        self.assertEqual(self.successResultOf(two), 'result')
+        self.assertEqual(self.flights.stats(), {'in_flight': 0, 'started': 1, 'joined': 1})
+
+    def test_different_keys(self):
+        self.flights.run('one', self.fn, 1)
+        self.flights.run('two', self.fn, 2)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_landed(self):
+        self.flights.run('key', self.fn, 1)
+        self.calls[0][1].callback('result')
+        self.flights.run('key', self.fn, 1)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failure_shared(self):
+        one = self.flights.run('key', self.fn)
+        two = self.flights.run('key', self.fn)
+        self.calls[0][1].errback(ValueError('boom'))
+        self.failureResultOf(one, ValueError)
+        self.failureResultOf(two, ValueError)
+
+    def test_synchronous(self):
+        self.assertEqual(self.successResultOf(self.flights.run('key', lambda: 'now')), 'now')
+
+
+class TestBatcher(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(workers.stop_pools)
+        self.flushed = []
+
+        def flush(items):
+            self.flushed.append(items)
+            return [ValueError(item) if item == 'bad' else item.upper() for item in items]
+
+        self.batcher = workers.Batcher(flush)
+        self.pool = workers.get_pool('test', 3)
+
+    def submit(self, item):
+        return self.pool.run(self.batcher.submit, item, 0.2)
+
+    def test_current_pool(self):
+        self.assertEqual(workers.current_pool(), None)
+        return self.pool.run(workers.current_pool).addCallback(self.assertEqual, 'test')
+
+    def test_one_flush(self):
+        d = gatherResults([self.submit('a'), self.submit('b'), self.submit('c')])
+
+        def check(results):
+            self.assertEqual(results, ['A', 'B', 'C'])
+            self.assertEqual(len(self.flushed), 1)
+            self.assertEqual(sorted(self.flushed[0]), ['a', 'b', 'c'])
+            self.assertEqual(self.batcher.stats(), {'batches': 1, 'items': 3, 'waiting': 0})
+
+        return d.addCallback(check)
+
+    def test_own_error(self):
+        good = self.submit('a')
+        bad = self.assertFailure(self.submit('bad'), ValueError)
+        return gatherResults([good, bad]).addCallback(
+            lambda results: self.assertEqual(results[0], 'A'))
+
+    def test_flush_fails(self):
+        def flush(items):
+            raise ValueError('boom')
+
+        self.batcher.flush = flush
+        return gatherResults([
+            self.assertFailure(self.submit('a'), ValueError),
+            self.assertFailure(self.submit('b'), ValueError),
+        ])
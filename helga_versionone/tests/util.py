@@ -7,9 +7,11 @@ from mock.mock import _patch as Patch
 from pretend import stub
 from twisted.internet.defer import Deferred
 from twisted.trial import unittest
+from v1pysdk.client import V1Server
 
 import helga_versionone
 from helga.plugins import ACKS
+from helga_versionone.v1_wrapper import HelgaV1Meta
 
 
 logger = logging.getLogger(__name__)
@@ -27,6 +29,51 @@ writeable_settings_stub = copy(settings_stub)
 writeable_settings_stub.VERSIONONE_READONLY = False
 
 
+class FakeV1Server(V1Server):
+    """A V1Server that answers from canned XML bodies by path, and remembers requests.
+       A body can also be a function of the query string
+    """
+
+    def __init__(self, responses):
+        super(FakeV1Server, self).__init__(instance_url=settings_stub.VERSIONONE_URL)
+        self.responses = responses
+        self.requests = []
+
+    def fetch(self, path, query='', postdata=None):
+        self.requests.append((path, query))
+        body = self.responses[path]
+        return (None, body(query) if callable(body) else body)
+
+
+# v1pysdk builds each asset class once per process, from whichever test asks first,
+# so tests that query workitems share these
+META_WORKITEM = """
+<AssetType name="Workitem">
+  <AttributeDefinition name="Name" attributetype="Text" ismultivalue="False"/>
+  <AttributeDefinition name="Number" attributetype="Text" ismultivalue="False"/>
+  <AttributeDefinition name="Estimate" attributetype="Numeric" ismultivalue="False"/>
+  <AttributeDefinition name="ChangeDate" attributetype="Date" ismultivalue="False"/>
+  <AttributeDefinition name="field_one" attributetype="LongText" ismultivalue="False"/>
+  <AttributeDefinition name="Status" attributetype="Relation" ismultivalue="False"/>
+  <AttributeDefinition name="Team" attributetype="Relation" ismultivalue="False"/>
+  <AttributeDefinition name="Owners" attributetype="Relation" ismultivalue="True"/>
+</AssetType>
+"""
+
+META_NAMED = """
+<AssetType name="Named">
+  <AttributeDefinition name="Name" attributetype="Text" ismultivalue="False"/>
+</AssetType>
+"""
+
+
+def fake_v1(responses):
+    """A real V1Meta, talking to FakeV1Server(responses)"""
+    v1 = HelgaV1Meta(instance_url=settings_stub.VERSIONONE_URL)
+    v1.server = FakeV1Server(responses)
+    return v1
+
+
 class deferred_patch(object):
     """Patches target until the deferred returns, appends patched object to args"""
     def __init__(self, target):
@@ -117,7 +164,7 @@ class PatchedTestCase(unittest.TestCase):
 
 class V1TestCase(PatchedTestCase):
     """Base class for all helga_versionone tests
-       helga_versionone.get_v1 is always patched to return self.v1 - a MagicMock()
+       helga_versionone.get_v1 and get_system_v1 are always patched to return self.v1 - a MagicMock()
        helga_versionone.settings is always patched to settings_stub
        helga_versionone.db is always patched
     """
@@ -128,14 +175,17 @@ class V1TestCase(PatchedTestCase):
     db = patch('helga_versionone.db')
     settings = patch('helga_versionone.settings', settings_stub)
     get_v1 = patch('helga_versionone.get_v1')
+    get_system_v1 = patch('helga_versionone.get_system_v1')
 
     def setUp(self):
         # Starts the patches
         super(V1TestCase, self).setUp()
+        helga_versionone.clear_caches()
 
         self.v1 = MagicMock()
         # Depends on "get_v1" being in patches above
         self.get_v1.return_value = self.v1
+        self.get_system_v1.return_value = self.v1
 
         # client is mocked, but doesn't have to be patched.
         self.client = MagicMock()
@@ -3,21 +3,31 @@
 import logging
 import httplib2
 import urllib2
+import zlib
 
 from urllib import urlencode
-from urllib2 import HTTPBasicAuthHandler, HTTPCookieProcessor
+from urllib2 import HTTPBasicAuthHandler, HTTPCookieProcessor, HTTPError
 
 from expiringdict import ExpiringDict
 from functools import wraps
+from StringIO import StringIO
 from urlparse import urlparse
-from v1pysdk.client import V1Server
+from v1pysdk.client import V1AssetNotFoundError, V1Error, V1Server
+from v1pysdk.query import V1Query
 from v1pysdk.v1meta import V1Meta
 
+from helga_versionone import stats
+
 try:
     from xml.etree import ElementTree
 except ImportError:  # pragma: no cover
     from elementtree import ElementTree
 
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:  # pragma: no cover
+    iterparse = ElementTree.iterparse
+
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +54,326 @@ class property_required(object):
         return wrapped_fn
 
 
+class HelgaV1Query(V1Query):
+    """V1Query that can have the server sort and page results"""
+
+    def __init__(self, *args, **kw):
+        super(HelgaV1Query, self).__init__(*args, **kw)
+        self.sort_list = []
+        self.page_spec = None
+
+    def sort(self, *args):
+        """Add attribute names to sort by, prefix with - for descending"""
+        self.sort_list.extend(args)
+        return self
+
+    def page(self, size, start=0):
+        """Only find size results, skipping the first start"""
+        self.page_spec = '{0},{1}'.format(size, start)
+        return self
+
+    def url_params(self):
+        """What this adds to V1Query's url parameters"""
+        url_params = {}
+        if self.sort_list:
+            url_params['sort'] = ','.join(self.sort_list)
+        if self.page_spec:
+            url_params['page'] = self.page_spec
+        return url_params
+
+    def run_single_query(self, url_params={}, api='Data'):
+        url_params = dict(url_params, **self.url_params())
+        return super(HelgaV1Query, self).run_single_query(url_params, api=api)
+
+
+def iter_asset_elements(source):
+    """Yield each top level <Asset> from the file like source as soon as it is parsed.
+       Each one is cleared after use, so the tree never holds more than one
+    """
+    depth = 0
+    root = None
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = elem
+            continue
+        depth -= 1
+        if depth == 1 and elem.tag == 'Asset':
+            yield elem
+            elem.clear()
+            root.clear()
+
+
+def raise_for_response(exception, body):
+    """Raise what V1Server.get_xml would for an error response"""
+    code = getattr(exception, 'code', None) or exception.response.status
+    if code >= 500:
+        # No XML to parse
+        raise exception
+    exception.xmldoc = ElementTree.fromstring(body)
+    if code == 404:
+        raise V1AssetNotFoundError(exception)
+    elif code == 400:
+        raise V1Error('\n' + body)
+    raise V1Error(exception)
+
+
+def stream_query(v1, query):
+    """Iterate over the assets query finds, parsing them as they arrive when
+       the server can stream. Unlike iterating the query, it is not kept,
+       so each call asks the server again.
+       Asked through v1, v1pysdk shares each asset class between connections, and the query's
+       own connection is whichever used the class last, maybe on another thread for another nick.
+    """
+    if not isinstance(query, V1Query) or query.query_has_run or query.asof_list:
+        return iter(query)
+
+    url_params = {}
+    if query.get_sel_string() or query.empty_sel:
+        url_params['sel'] = query.get_sel_string()
+    if query.get_where_string():
+        url_params['where'] = query.get_where_string()
+    # Not getattr, V1Query would take an unknown attribute for one to select and run
+    if isinstance(query, HelgaV1Query):
+        url_params.update(query.url_params())
+    path = '/rest-1.v1/Data/{0}'.format(query.asset_class._v1_asset_type_name)
+    if hasattr(v1.server, 'stream_assets'):
+        assets = v1.server.stream_assets(path, query=urlencode(url_params))
+    else:
+        assets = v1.server.get_xml(path, query=urlencode(url_params)).findall('Asset')
+    return (query.asset_class.from_query_select(asset) for asset in assets)
+
+
+def first(v1, query):
+    """The first asset query finds, asked through v1 like stream_query. IndexError if there isn't one"""
+    for asset in stream_query(v1, query):
+        return asset
+    raise IndexError('No {0} found'.format(getattr(query, 'asset_class', query)))
+
+
+# Bytes read from the wire at a time, when asked for everything
+CHUNK_SIZE = 64 * 1024
+
+
+class DecodedResponse(object):
+    """A urllib2 response, with its Content-Encoding undone as it is read.
+       on_complete is called with the whole body, if it is read to the end
+    """
+
+    def __init__(self, fp, headers, url, code=200, msg='OK', encoding=None, on_complete=None):
+        self.fp = fp
+        self.headers = headers
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.encoding = encoding
+        self.decoder = None
+        self.on_complete = on_complete
+        self.parts = [] if on_complete else None
+        self.received = 0
+        self.decoded = 0
+        self.finished = False
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def _decode(self, data):
+        if self.encoding is None:
+            return data
+        if self.decoder is None:
+            if self.encoding == 'gzip':
+                wbits = 16 + zlib.MAX_WBITS
+            # deflate should be zlib wrapped, but some servers send it raw
+            elif len(data) > 1 and (ord(data[0]) * 256 + ord(data[1])) % 31 == 0:
+                wbits = zlib.MAX_WBITS
+            else:
+                wbits = -zlib.MAX_WBITS
+            self.decoder = zlib.decompressobj(wbits)
+        return self.decoder.decompress(data)
+
+    def read(self, size=-1):
+        if size < 0:
+            return ''.join(iter(lambda: self.read(CHUNK_SIZE), ''))
+        while not self.finished:
+            data = self.fp.read(size)
+            self.received += len(data)
+            if not data:
+                out = self.decoder.flush() if self.decoder else ''
+                self._keep(out)
+                self._finish()
+                return out
+            out = self._decode(data)
+            # A little compressed input can decode to nothing yet, and '' means the end
+            if out:
+                self._keep(out)
+                return out
+        return ''
+
+    def _keep(self, out):
+        self.decoded += len(out)
+        if self.parts is not None:
+            self.parts.append(out)
+
+    def _finish(self):
+        self.finished = True
+        if self.encoding is not None and self.decoded > self.received:
+            stats.incr('v1.saved_bytes.compressed', self.decoded - self.received)
+        if self.on_complete is not None:
+            self.on_complete(''.join(self.parts))
+
+    def close(self):
+        self.parts = None
+        self.fp.close()
+
+
+class CachingHandler(urllib2.BaseHandler):
+    """Ask for compressed responses, and revalidate GETs of anything in cache (a ResponseCache)
+       with their ETag or Last-Modified, so an unchanged response is a 304 without a body.
+    """
+
+    # Before HTTPErrorProcessor, which turns a 304 into http_error_304
+    handler_order = 900
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def _key(self, request):
+        return ('urllib2', request.get_full_url())
+
+    def http_request(self, request):
+        request.add_unredirected_header('Accept-Encoding', 'gzip, deflate')
+        if request.get_method() == 'GET':
+            cached = self.cache.get(self._key(request))
+            if cached is not None:
+                etag, last_modified, headers, body = cached
+                if etag:
+                    request.add_unredirected_header('If-None-Match', etag)
+                if last_modified:
+                    request.add_unredirected_header('If-Modified-Since', last_modified)
+        return request
+
+    def http_response(self, request, response):
+        headers = response.info()
+        encoding = headers.get('Content-Encoding', '').lower() or None
+        if encoding not in (None, 'gzip', 'deflate'):
+            return response
+        if response.code != 200:
+            if encoding is None:
+                return response
+            # An error, small and read whole by whoever catches it, so decode it all now
+            body = DecodedResponse(response, headers, response.geturl(), encoding=encoding).read()
+            response.close()
+            self._decoded(headers)
+            decoded = urllib2.addinfourl(StringIO(body), headers, response.geturl(), response.code)
+            decoded.msg = response.msg
+            return decoded
+
+        on_complete = None
+        validators = headers.get('ETag'), headers.get('Last-Modified')
+        if request.get_method() == 'GET' and any(validators):
+            key = self._key(request)
+            on_complete = lambda body: self.cache.set(key, validators + (headers, body))
+        elif encoding is None:
+            return response
+
+        if encoding is not None:
+            self._decoded(headers)
+        return DecodedResponse(
+            response, headers, response.geturl(), response.code, response.msg, encoding, on_complete)
+
+    def _decoded(self, headers):
+        # It won't be encoded, once we're done with it
+        for name in ('Content-Encoding', 'Content-Length'):
+            if name in headers:
+                del headers[name]
+
+    def http_error_304(self, request, fp, code, msg, headers):
+        cached = self.cache.get(self._key(request))
+        if cached is None:
+            # Not ours, let it be an error
+            return None
+        etag, last_modified, cached_headers, body = cached
+        stats.incr('v1.saved_bytes.not_modified', len(body))
+        return DecodedResponse(StringIO(body), cached_headers, request.get_full_url())
+
+    https_request = http_request
+    https_response = http_response
+
+
+def timed_fetch(fetch):
+    """Time fetch as v1.get or v1.post, and count error responses"""
+
+    @wraps(fetch)
+    def wrapped_fetch(herself, path, query='', postdata=None):
+        name = 'v1.get' if postdata is None else 'v1.post'
+        with stats.timer(name):
+            res = fetch(herself, path, query=query, postdata=postdata)
+        if res[0] is not None:
+            stats.incr(name + '.errors')
+        return res
+
+    return wrapped_fetch
+
+
+def snapshot_meta(get_meta_xml):
+    """Answer get_meta_xml from the server's meta_snapshot (a MetaSnapshot) when it can,
+       and keep what is fetched there
+    """
+
+    @wraps(get_meta_xml)
+    def wrapped_get_meta_xml(herself, asset_type_name):
+        snapshot = herself.meta_snapshot
+        if snapshot is None:
+            return get_meta_xml(herself, asset_type_name)
+        xml = snapshot.get(asset_type_name)
+        if xml is not None:
+            stats.incr('v1.meta.snapshot')
+            return ElementTree.fromstring(xml)
+        document = get_meta_xml(herself, asset_type_name)
+        snapshot.set(asset_type_name, ElementTree.tostring(document))
+        return document
+
+    return wrapped_get_meta_xml
+
+
+class HelgaV1Server(V1Server):
+    """V1Server with its requests timed"""
+
+    meta_snapshot = None
+
+    fetch = timed_fetch(V1Server.fetch.im_func)
+    get_meta_xml = snapshot_meta(V1Server.get_meta_xml.im_func)
+
+    def use_meta_snapshot(self, snapshot):
+        """Build asset classes from snapshot, rather than asking V1 each time"""
+        self.meta_snapshot = snapshot
+
+    def use_response_cache(self, cache):
+        """Compress and revalidate responses, keeping them in cache"""
+        self.opener.add_handler(CachingHandler(cache))
+
+    def stream_assets(self, path, query=''):
+        """The <Asset>s of a GET, parsed while the response is read"""
+        url = self.build_url(path, query=query)
+        try:
+            with stats.timer('v1.get'):
+                response = self.http_get(url)
+        except HTTPError, e:
+            if e.code == 401:
+                raise
+            stats.incr('v1.get.errors')
+            raise_for_response(e, e.fp.read())
+        try:
+            for asset in iter_asset_elements(response):
+                yield asset
+        finally:
+            response.close()
+
+
 class HelgaV1Meta(V1Meta):  # pragma: no cover
     def __init__(self, *args, **kw):
         # Coppied from V1Meta, but use our own Server class
@@ -82,6 +412,7 @@ class HelgaOauthV1Server(V1Server):
             self.instance_url = self.build_url('')
 
         self.httpclient = None
+        self.response_cache = None
 
         if credentials is not None:
             self.set_credentials(credentials)
@@ -93,7 +424,7 @@ class HelgaOauthV1Server(V1Server):
             self.use_password_as_token = use_password_as_token
             self._install_opener()
             # Become the parent class (for opener style get/post methods
-            self.__class__ = V1Server
+            self.__class__ = HelgaV1Server
 
     def _install_opener(self):
         base_url = self.build_url('')
@@ -109,17 +440,35 @@ class HelgaOauthV1Server(V1Server):
 
     def set_credentials(self, creds):
         # If there are memory leaks, they might come from here
-        self.httpclient = httplib2.Http()
+        self.httpclient = httplib2.Http(cache=self.response_cache)
         creds.authorize(self.httpclient)
 
+    meta_snapshot = None
+
+    get_meta_xml = snapshot_meta(V1Server.get_meta_xml.im_func)
+
+    def use_meta_snapshot(self, snapshot):
+        """Build asset classes from snapshot, rather than asking V1 each time"""
+        self.meta_snapshot = snapshot
+
+    def use_response_cache(self, cache):
+        """httplib2 already asks for compressed responses, give it somewhere to keep them for revalidation"""
+        self.response_cache = cache
+        if self.httpclient is not None:
+            self.httpclient.cache = cache
+
     @property_required('httpclient')
     def http_get(self, url):
-        return self.httpclient.request(url, method='GET')  # pragma: no cover
+        response, body = self.httpclient.request(url, method='GET')
+        if getattr(response, 'fromcache', False):
+            stats.incr('v1.saved_bytes.not_modified', len(body))
+        return response, body
 
     @property_required('httpclient')
     def http_post(self, url, data=''):
         return self.httpclient.request(url, method='POST', body=data)  # pragma: no cover
 
+    @timed_fetch
     def fetch(self, path, query='', postdata=None):
         "Perform an HTTP GET or POST depending on whether postdata is present"
         url = self.build_url(path, query=query)
@@ -137,6 +486,13 @@ class HelgaOauthV1Server(V1Server):
             body = e.content
             return (e, body)
 
+    def stream_assets(self, path, query=''):
+        """The <Asset>s of a GET, httplib2 reads the whole body but the tree is never all built"""
+        exception, body = self.fetch(path, query=query)
+        if exception is not None:
+            raise_for_response(exception, body)
+        return iter_asset_elements(StringIO(body))
+
     def get_asset_xml(self, asset_type_name, oid):
         path = self.API_PATH + '/Data/{0}/{1}'.format(asset_type_name, oid)
         return self.get_xml(path)
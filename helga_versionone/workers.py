@@ -0,0 +1,225 @@
+"""Run blocking VersionOne calls off the reactor thread"""
+
+import logging
+import threading
+import time
+
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+
+logger = logging.getLogger(__name__)
+
+# Pools by name, created on demand by get_pool
+_pools = {}
+# Worker threads know which pool they belong to
+_local = threading.local()
+
+
+class WorkerPool(object):
+    """A bounded thread pool that keeps count of queued and running work"""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(minthreads=0, maxthreads=size, name='versionone-{0}'.format(name))
+        self._shutdown_trigger = None
+
+    def start(self):
+        self._pool.start()
+        self._shutdown_trigger = reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self, wait=True):
+        """Stop the threads once they finish what's queued. Without wait, they finish
+           in a thread of their own, so the reactor doesn't block joining them.
+        """
+        if self._shutdown_trigger is not None:
+            try:
+                reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            except (ValueError, KeyError):
+                # Already fired, we are being called by the trigger
+                pass
+            self._shutdown_trigger = None
+        # Stopping twice (at shutdown and by stop_pools) is fine
+        if self._pool.joined:
+            return
+        if wait:
+            self._pool.stop()
+        else:
+            reactor.callInThread(self._pool.stop)
+
+    def run(self, fn, *args, **kwargs):
+        """Call fn in a worker thread, returns a Deferred that fires in the reactor thread"""
+
+        def work():
+            _local.pool = self.name
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                res = fn(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+            return res
+
+        with self._lock:
+            self.queued += 1
+        logger.debug('Queued {0} on pool {1} ({2} waiting)'.format(
+            getattr(fn, '__name__', fn), self.name, self.queued))
+        return threads.deferToThreadPool(reactor, self._pool, work)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+
+class SingleFlight(object):
+    """Callers asking for the same key while a call is in flight share its result,
+       instead of each making their own. Use from the reactor thread.
+    """
+
+    def __init__(self):
+        self.started = 0
+        self.joined = 0
+        self._flights = {}
+
+    def run(self, key, fn, *args, **kwargs):
+        """Returns a Deferred for fn's result, fn is only called if key isn't already in flight"""
+        waiter = Deferred()
+        if key in self._flights:
+            self.joined += 1
+            self._flights[key].append(waiter)
+        else:
+            self.started += 1
+            self._flights[key] = [waiter]
+            maybeDeferred(fn, *args, **kwargs).addBoth(self._land, key)
+        return waiter
+
+    def _land(self, result, key):
+        for waiter in self._flights.pop(key):
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    def stats(self):
+        return {
+            'in_flight': len(self._flights),
+            'started': self.started,
+            'joined': self.joined,
+        }
+
+
+class _Pending(object):
+    __slots__ = ('item', 'outcome', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.outcome = None
+        self.done = threading.Event()
+
+
+class Batcher(object):
+    """Gathers items submitted from worker threads, and hands them to flush together.
+       The first submitter waits window seconds for others to join, then calls
+       flush(items), which returns a result or exception instance per item.
+       Every submitter blocks until the flush, and gets the outcome for its own item.
+    """
+
+    def __init__(self, flush):
+        self.flush = flush
+        self.batches = 0
+        self.items = 0
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def submit(self, item, window):
+        pending = _Pending(item)
+        with self._lock:
+            leader = self._batch is None
+            if leader:
+                self._batch = []
+            self._batch.append(pending)
+
+        if leader:
+            time.sleep(window)
+            with self._lock:
+                batch, self._batch = self._batch, None
+                self.batches += 1
+                self.items += len(batch)
+            try:
+                outcomes = self.flush([p.item for p in batch])
+            except Exception as e:
+                logger.exception('Flushing {0} items failed'.format(len(batch)))
+                outcomes = [e] * len(batch)
+            for p, outcome in zip(batch, outcomes):
+                p.outcome = outcome
+                p.done.set()
+
+        pending.done.wait()
+        if isinstance(pending.outcome, Exception):
+            raise pending.outcome
+        return pending.outcome
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'waiting': len(self._batch or ()),
+            }
+
+
+def current_pool():
+    """Name of the pool running the current thread, None outside worker threads"""
+    return getattr(_local, 'pool', None)
+
+
+def get_pool(name, size):
+    """Get the named pool, None if size is not positive.
+       The pool is (re)started when first asked for, or when size changes.
+       Called from the reactor, so a replaced pool drains without being waited on
+    """
+    pool = _pools.get(name)
+    if not size or size <= 0:
+        if pool is not None:
+            pool.stop(wait=False)
+            del _pools[name]
+        return None
+
+    if pool is None or pool.size != size:
+        if pool is not None:
+            pool.stop(wait=False)
+        logger.info('Starting VersionOne worker pool {0} with {1} threads'.format(name, size))
+        pool = _pools[name] = WorkerPool(name, size)
+        pool.start()
+    return pool
+
+
+def stop_pools():
+    for name in list(_pools):
+        _pools.pop(name).stop()
+
+
+def stats():
+    """Queue depth and counts for each pool, by name"""
+    return dict((name, pool.stats()) for name, pool in _pools.items())